@@ -1,8 +1,15 @@
 import argparse
 import asyncio
+import contextlib
+import json
 import logging
+import multiprocessing
+import os
+import signal
+import sys
 import time
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional
 
 import aiohttp
 import asyncpgsa
@@ -10,14 +17,48 @@ import psycopg2
 from asyncpg.pool import Pool
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
-from .tables import encounters, observations, patients, procedures
+from . import download
+from .download import DownloadCache
+from .eventloop import EVENT_LOOPS, loop_name, new_event_loop
+from .memory import MemoryBudget, MemoryTracker
+from .profiling import SamplingProfiler
+from .progress import Progress
+from .reload import ShadowReload
+from .ranges import ByteRange, load_range, read_range_lines, source_size, split
+from .row_cache import RowCache
+from .sharding import Shard, merge_stats, read_stats, write_stats
+from .sinks import (
+    SINKS, DatabaseProfile, FileSink, MemorySink, PostgresSink, Sink, StatementStats, format_statements,
+    timed_connection,
+)
+from .tables import encounters, extract, observations, patients, procedures
 from .tables.basic_batcher import Batcher
+from .tracing import Tracer
+from .tune import Tuner, write_entity_settings
 from .settings import settings
 
 
 logger = logging.getLogger(__name__)
 
 
+def config_logging(verbose: bool) -> None:
+    # tuning trials create many apps, handler is added once
+    if logger.handlers:
+        return
+
+    logger.setLevel(logging.DEBUG)
+    ch = logging.StreamHandler()
+
+    if verbose:
+        ch.setLevel(logging.DEBUG)
+    else:
+        ch.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('[%(asctime)s - %(name)s - %(levelname)s] %(message)s')
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+
 class App:
 
     def __init__(
@@ -26,134 +67,373 @@ class App:
     ):
         self._settings = settings
         self._loop = loop
-        self._queue: asyncio.Queue = asyncio.Queue(maxsize=settings['MAX_QUEUE_SIZE'])
         self.stats: dict = {}
 
+        # progress of the entity being loaded, status of all of them is written to PROGRESS_STATUS_PATH
+        self.progress: Optional[Progress] = None
+        self.progress_status: dict = {}
+        # statements run on the pool, by shape
+        self.statements: Optional[StatementStats] = None
+        # spans of every entity, batch and sampled item, exported to TRACE_PATH
+        self.tracer = Tracer(
+            settings['TRACE_PATH'], settings['TRACE_RECORD_SAMPLE_RATE'], settings['TRACE_BATCH_SAMPLE_RATE'],
+        )
+        # per-entity sampling profiles of `--profile` runs
+        self.profiles: dict = {}
+
         self.command_line_args = command_line_args
 
         self._config_logging()
 
     def _config_logging(self) -> None:
-        logger.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-
-        if self.command_line_args.verbose:
-            ch.setLevel(logging.DEBUG)
-        else:
-            ch.setLevel(logging.INFO)
+        config_logging(self.command_line_args.verbose)
 
-        formatter = logging.Formatter('[%(asctime)s - %(name)s - %(levelname)s] %(message)s')
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
-
-    async def _worker(self, name: str, queue: asyncio.Queue, batcher: Batcher, pool: Pool) -> None:
+    async def _worker(self, name: str, queue: asyncio.Queue, batcher: Batcher) -> None:
         logger.debug(f"Worker {name} START")
 
-        async with pool.acquire() as conn:
+        with self.tracer.span("worker", worker=name):
             while True:
                 item = await queue.get()
-                await batcher.process(conn, item)
+                await batcher.process(item)
+                if batcher.budget is not None:
+                    batcher.budget.release(sys.getsizeof(item))
                 queue.task_done()
 
-    async def _prepare_data(self, queue: asyncio.Queue, url: str) -> None:
-        async with aiohttp.ClientSession(loop=self._loop) as session:
-            async with session.get(url) as response:
-                while True:
-                    chunk = await response.content.readline()
-                    if not chunk:
-                        logger.debug("EOF reached")
-                        break
+    async def _prepare_data(
+        self, queue: asyncio.Queue, url: str, transfer: dict, byte_range: Optional[ByteRange] = None,
+        budget: Optional[MemoryBudget] = None,
+    ) -> None:
+        cache = None
+        if self._settings['DOWNLOAD_CACHE']:
+            cache = DownloadCache(self._settings['DOWNLOAD_CACHE_PATH'])
+
+        # compressed sources are decoded incrementally by `download.read_lines`
+        with self.tracer.span("download", url=url) as span:
+            async with aiohttp.ClientSession(loop=self._loop, auto_decompress=False) as session:
+                if byte_range is not None:
+                    lines = read_range_lines(session, url, byte_range, transfer)
+                else:
+                    lines = download.read_lines(session, url, cache, transfer)
+                async for chunk in lines:
+                    if budget is not None:
+                        await budget.acquire(sys.getsizeof(chunk))
                     await queue.put(chunk)
-
-    async def _resolve_data(self, batcher: Batcher, url: str, pool: Pool) -> None:
-
-        batcher_task = self._loop.create_task(batcher.work())
-
-        tasks = []
-        for i in range(self._settings['QUEUE_WORKERS_AMOUNT']):
-            task = self._loop.create_task(
-                self._worker(f'queue-{i}', self._queue, batcher, pool)
-            )
-            tasks.append(task)
-
-        await self._prepare_data(self._queue, url)
-
-        await self._queue.join()
-
+            span.set(**{f"transfer.{key}": value for key, value in transfer.items() if value is not None})
+        logger.debug("EOF reached")
+
+    def entity_settings(self, entity: str) -> dict:
+        """Settings with per-entity values written by `etl-tool tune` applied."""
+        return {**self._settings, **self._settings['ENTITY_SETTINGS'].get(entity, {})}
+
+    @contextlib.asynccontextmanager
+    async def _track_progress(self, batcher: Batcher, queue: Optional[asyncio.Queue]) -> AsyncIterator[Progress]:
+        progress = Progress(
+            batcher.table.name, batcher, queue, self._settings['PROGRESS_INTERVAL'],
+            self.progress_status, self._settings['PROGRESS_STATUS_PATH'],
+        )
+        self.progress = progress
+        task = self._loop.create_task(progress.run()) if progress.interval > 0 else None
+        try:
+            yield progress
+        finally:
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            self.progress = None
+
+        if task is not None:
+            progress.report("done")
+
+    @contextlib.contextmanager
+    def _profile(self, entity: str) -> Iterator[None]:
+        if not self._settings['PROFILE']:
+            yield
+            return
+
+        profiler = SamplingProfiler(self._settings['PROFILE_INTERVAL'])
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            files = profiler.write(self._settings['PROFILE_PATH'], entity)
+            self.profiles[entity] = {
+                "samples": profiler.total,
+                "files": files,
+                "top": profiler.top(self._settings['PROFILE_TOP']),
+            }
+            logger.debug(f"{entity} profile of {profiler.total} samples written to {', '.join(files)}")
+
+    @contextlib.contextmanager
+    def _track_memory(self, batcher: Batcher) -> Iterator[MemoryTracker]:
+        tracker = MemoryTracker(
+            batcher.table.name, self._settings['MEMORY_TRACE'],
+            self._settings['MEMORY_TRACE_FRAMES'], self._settings['MEMORY_TOP'],
+        )
+        batcher.memory = tracker
+        tracker.start()
+        try:
+            yield tracker
+        finally:
+            tracker.stop()
+
+        if tracker.trace and self._settings['MEMORY_REPORT_PATH']:
+            tracker.write(self._settings['MEMORY_REPORT_PATH'])
+
+    def dump_stats(self) -> None:
+        """Logs progress and statistics collected so far, SIGUSR1 handler."""
+        if self.progress is not None:
+            self.progress.report()
+        logger.info(f"Statistics: {json.dumps(self.stats, default=str)}")
+
+    async def _replay_data(self, batcher: Batcher, cache: RowCache, key: str) -> None:
+        logger.debug("Replaying rows from cache")
+        async with self._track_progress(batcher, None):
+            batcher_task = self._loop.create_task(batcher.work())
+
+            try:
+                for i, rows in enumerate(cache.read(batcher.table.name, key)):
+                    await batcher.replay(rows)
+                    # reading the cache doesn't suspend, let the batcher flush meanwhile
+                    if i % batcher.settings['MAX_QUEUE_SIZE'] == 0:
+                        await asyncio.sleep(0)
+
+                await batcher.finish()
+            except BaseException:
+                await self._abort(batcher, [batcher_task])
+                raise
+            batcher_task.cancel()
+            await asyncio.gather(batcher_task, return_exceptions=True)
+
+    async def _abort(self, batcher: Batcher, tasks: List[asyncio.Task]) -> None:
+        """Stops tasks of a failed or cancelled load, open transaction is rolled back."""
         for task in tasks:
             task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await batcher.abort()
+
+    async def _resolve_data(self, batcher: Batcher, url: str) -> None:
+        batcher.tracer = self.tracer
+        try:
+            with self._profile(batcher.table.name), self._track_memory(batcher):
+                with self.tracer.span("resolve", entity=batcher.table.name, url=url) as span:
+                    await self._resolve_cached_data(batcher, url)
+                    span.set(
+                        processed_items=batcher.processed_items, inserted_records=batcher.inserted_records,
+                        failed_records=batcher.failed_records,
+                    )
+        finally:
+            self.tracer.flush()
+
+    async def _resolve_cached_data(self, batcher: Batcher, url: str) -> None:
+        if self._settings['READ_PROCESSES'] > 1 and not self._settings['ROW_CACHE']:
+            if (ranges := await self._split_source(url)) is not None:
+                await self._load_ranges(batcher, url, ranges)
+                return
+
+        if self._settings['ROW_CACHE']:
+            cache = RowCache(self._settings['ROW_CACHE_PATH'])
+            if (key := await cache.key(url)) is not None:
+                if cache.has(batcher.table.name, key):
+                    await self._replay_data(batcher, cache, key)
+                    return
+                batcher.cache_writer = cache.writer(batcher.table.name, key)
+
+        try:
+            await self._load_data(batcher, url)
+        except BaseException:
+            if batcher.cache_writer is not None:
+                batcher.cache_writer.discard()
+            raise
+
+        if batcher.cache_writer is not None:
+            batcher.cache_writer.commit()
+
+    async def _split_source(self, url: str) -> Optional[List[ByteRange]]:
+        if (sink := self._settings['SINK']) != "postgres":
+            # rows of `memory` or `files` sink of a worker process are lost with it, later entities can't find them
+            logger.warning("Source isn't split between processes, `%s` sink can't be shared", sink)
+            return None
+        async with aiohttp.ClientSession(loop=self._loop) as session:
+            size = await source_size(session, url)
+        if not size:
+            logger.info("Source can't be read by byte ranges, it's loaded by single process")
+            return None
+        return split(size, self._settings['READ_PROCESSES'])
+
+    def range_settings(self, index: int) -> dict:
+        """Settings of a worker process, it shares the pool budget and doesn't write files of the main one."""
+        pool_size = max(self._settings['POSTGRES_MAX_CONNECTION_POOL_SIZE'] // self._settings['READ_PROCESSES'], 1)
+        reject_path, dead_letter_path = self._settings['REJECT_PATH'], self._settings['DEAD_LETTER_PATH']
+        return {
+            **self._settings,
+            'POSTGRES_MAX_CONNECTION_POOL_SIZE': pool_size,
+            'REJECT_PATH': reject_path and os.path.join(reject_path, f"range-{index}"),
+            'DEAD_LETTER_PATH': dead_letter_path and os.path.join(dead_letter_path, f"range-{index}"),
+            'PROGRESS_STATUS_PATH': "",
+            'TRACE_PATH': "",
+            'THROTTLE_SHARE': self._settings['THROTTLE_SHARE'] / self._settings['READ_PROCESSES'],
+        }
+
+    async def _load_ranges(self, batcher: Batcher, url: str, ranges: List[ByteRange]) -> None:
+        """Loads byte ranges of the source in worker processes, their stats are merged into `batcher`."""
+        logger.debug(f"Loading {len(ranges)} byte ranges in worker processes")
+        entity = batcher.table.name
+        verbose = self.command_line_args.verbose
+        # fresh interpreters, forked ones would inherit the running loop
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(ranges), mp_context=context) as executor:
+            batcher.worker_stats = await asyncio.gather(*(
+                self._loop.run_in_executor(
+                    executor, load_range, self.range_settings(i), entity, url, byte_range, verbose,
+                )
+                for i, byte_range in enumerate(ranges)
+            ))
+
+    async def _load_data(
+        self, batcher: Batcher, url: str, sample: Optional[List[bytes]] = None,
+        byte_range: Optional[ByteRange] = None,
+    ) -> None:
+        """
+        Loads source at `url` into batcher, `sample` lines are loaded instead of it by tuning trials,
+        only lines starting in `byte_range` by worker processes.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=batcher.settings['MAX_QUEUE_SIZE'])
+
+        async with self._track_progress(batcher, queue):
+            batcher_task = self._loop.create_task(batcher.work())
+
+            tasks = []
+            for i in range(batcher.settings['QUEUE_WORKERS_AMOUNT']):
+                task = self._loop.create_task(
+                    self._worker(f'queue-{i}', queue, batcher)
+                )
+                tasks.append(task)
+
+            try:
+                if sample is None:
+                    await self._prepare_data(queue, url, batcher.transfer, byte_range, batcher.budget)
+                else:
+                    for line in sample:
+                        if batcher.budget is not None:
+                            await batcher.budget.acquire(sys.getsizeof(line))
+                        await queue.put(line)
+
+                await queue.join()
+
+                for task in tasks:
+                    task.cancel()
+
+                await batcher.finish()
+            except BaseException:
+                await self._abort(batcher, [*tasks, batcher_task])
+                raise
+            batcher_task.cancel()
+
+            await asyncio.gather(*tasks, batcher_task, return_exceptions=True)
+
+    async def create_pool(self, profile: Optional[DatabaseProfile] = None) -> Pool:
+        profile = profile or DatabaseProfile.from_settings(self._settings)
+
+        max_size = self._settings['POSTGRES_MAX_CONNECTION_POOL_SIZE']
+        options = profile.pool_options(min(self._settings['POSTGRES_MIN_CONNECTION_POOL_SIZE'], max_size), max_size)
+        if self._settings['RELOAD']:
+            # unqualified table names resolve to shadow tables
+            options['server_settings'] = {'search_path': self._settings['SHADOW_SCHEMA']}
+        if self._settings['DB_STATEMENT_STATS']:
+            self.statements = StatementStats(self._settings['SLOW_STATEMENT_SECONDS'])
+            options['connection_class'] = timed_connection(self.statements)
 
-        await batcher.proccess_batch()
-        batcher_task.cancel()
-
-        await asyncio.gather(*tasks, batcher_task, return_exceptions=True)
-
-    async def create_pool(self) -> Pool:
         return await asyncpgsa.create_pool(
             host=self._settings['POSTGRES_DATABASE_HOST'],
             database=self._settings['POSTGRES_DATABASE_NAME'],
             user=self._settings['POSTGRES_DATABASE_USERNAME'],
             password=self._settings['POSTGRES_DATABASE_PASSWORD'],
-            min_size=self._settings['POSTGRES_MIN_CONNECTION_POOL_SIZE'],
-            max_size=self._settings['POSTGRES_MAX_CONNECTION_POOL_SIZE'],
             loop=self._loop,
+            **options,
         )
 
-    async def resolve_patients(self, pool: Optional[Pool] = None) -> None:
+    async def create_sink(self) -> Sink:
+        if self._settings['SINK'] == "memory":
+            return MemorySink()
+        if self._settings['SINK'] == "files":
+            return FileSink(
+                self._settings['EXPORT_PATH'], self._settings['EXPORT_FORMAT'], self._settings['EXPORT_ROW_GROUP_SIZE'],
+            )
+        profile = DatabaseProfile.from_settings(self._settings)
+        self.stats['db_profile'] = profile.name
+        return PostgresSink(await self.create_pool(profile), profile)
+
+    async def resolve_patients(self, sink: Optional[Sink] = None) -> None:
         logger.info("Resolving Patients")
         started_at = time.monotonic()
-        if pool is None:
-            pool = await self.create_pool()
+        if sink is None:
+            sink = await self.create_sink()
 
-        batcher: patients.PatientsBatching = patients.PatientsBatching(pool, self._settings)
-        await self._resolve_data(batcher, self._settings['PATIENTS_PATH'], pool)
-        self.stats['patients'] = batcher.get_stats()
-        logger.info(f"Patients resolving time: {(time.monotonic() - started_at):.4f} s")
+        batcher: patients.PatientsBatching = patients.PatientsBatching(sink, self.entity_settings('patients'))
+        await self._resolve_data(batcher, self._settings['PATIENTS_PATH'])
+        self.stats['patients'] = {**batcher.get_stats(), 'seconds': time.monotonic() - started_at}
+        logger.info(f"Patients resolving time: {self.stats['patients']['seconds']:.4f} s")
 
-    async def resolve_encounters(self, pool: Optional[Pool] = None) -> None:
+    async def resolve_encounters(self, sink: Optional[Sink] = None) -> None:
         logger.info("Resolving Encounters")
         started_at = time.monotonic()
-        if pool is None:
-            pool = await self.create_pool()
+        if sink is None:
+            sink = await self.create_sink()
 
-        batcher: encounters.EncountersBatching = encounters.EncountersBatching(pool, self._settings)
-        await self._resolve_data(batcher, self._settings['ENCOUNTERS_PATH'], pool)
-        self.stats['encounters'] = batcher.get_stats()
-        logger.info(f"Encounters resolving time: {(time.monotonic() - started_at):.4f} s")
+        batcher: encounters.EncountersBatching = encounters.EncountersBatching(sink, self.entity_settings('encounters'))
+        await self._resolve_data(batcher, self._settings['ENCOUNTERS_PATH'])
+        self.stats['encounters'] = {**batcher.get_stats(), 'seconds': time.monotonic() - started_at}
+        logger.info(f"Encounters resolving time: {self.stats['encounters']['seconds']:.4f} s")
 
-    async def resolve_procedures(self, pool: Optional[Pool] = None) -> None:
+    async def resolve_procedures(self, sink: Optional[Sink] = None) -> None:
         logger.info("Resolving Procedures")
         started_at = time.monotonic()
-        if pool is None:
-            pool = await self.create_pool()
+        if sink is None:
+            sink = await self.create_sink()
 
-        batcher: procedures.ProceduresBatching = procedures.ProceduresBatching(pool, self._settings)
-        await self._resolve_data(batcher, self._settings['PROCEDURES_PATH'], pool)
-        self.stats['procedures'] = batcher.get_stats()
-        logger.info(f"Procedures resolving time: {(time.monotonic() - started_at):.4f} s")
+        batcher: procedures.ProceduresBatching = procedures.ProceduresBatching(sink, self.entity_settings('procedures'))
+        await self._resolve_data(batcher, self._settings['PROCEDURES_PATH'])
+        self.stats['procedures'] = {**batcher.get_stats(), 'seconds': time.monotonic() - started_at}
+        logger.info(f"Procedures resolving time: {self.stats['procedures']['seconds']:.4f} s")
 
-    async def resolve_observations(self, pool: Optional[Pool] = None) -> None:
+    async def resolve_observations(self, sink: Optional[Sink] = None) -> None:
         logger.info("Resolving Observations")
         started_at = time.monotonic()
-        if pool is None:
-            pool = await self.create_pool()
+        if sink is None:
+            sink = await self.create_sink()
 
-        batcher: observations.ObservationsBatching = observations.ObservationsBatching(pool, self._settings)
-        await self._resolve_data(batcher, self._settings['OBSERVATIONS_PATH'], pool)
-        self.stats['observations'] = batcher.get_stats()
-        logger.info(f"Observations resolving time: {(time.monotonic() - started_at):.4f} s")
-
-    async def post_run_stats(self, pool: Pool) -> None:
-        self.stats['patients_genders'] = await patients.patients_by_gender(pool)
-        self.stats['most_popular_procedures'] = await procedures.most_popular_procedures(pool)
-        self.stats['popular_start_encounters_days'] = await encounters.popular_start_encounters_days(pool)
-        self.stats['popular_end_encounters_days'] = await encounters.popular_end_encounters_days(pool)
+        batcher: observations.ObservationsBatching = observations.ObservationsBatching(
+            sink, self.entity_settings('observations'),
+        )
+        await self._resolve_data(batcher, self._settings['OBSERVATIONS_PATH'])
+        self.stats['observations'] = {**batcher.get_stats(), 'seconds': time.monotonic() - started_at}
+        logger.info(f"Observations resolving time: {self.stats['observations']['seconds']:.4f} s")
+
+    async def post_run_stats(self, sink: Sink) -> None:
+        # additional statistics are computed by the database
+        if (pool := sink.pool) is not None:
+            self.stats['patients_genders'] = await patients.patients_by_gender(pool)
+            self.stats['most_popular_procedures'] = await procedures.most_popular_procedures(pool)
+            self.stats['popular_start_encounters_days'] = await encounters.popular_start_encounters_days(pool)
+            self.stats['popular_end_encounters_days'] = await encounters.popular_end_encounters_days(pool)
+        if self.statements is not None:
+            self.stats['statements'] = self.statements.get_stats()
 
         self.print_final_report()
 
     def print_final_report(self) -> None:
         print("- Final Report -")
 
+        if (profile := self.stats.get('db_profile')):
+            print(f"Database profile: {profile}")
+        if (event_loop := self.stats.get('event_loop')):
+            print(f"Event loop: {event_loop}")
+        if (shard := self.stats.get('shard')):
+            print(f"Shard: {shard}")
+        if (shards := self.stats.get('shards')):
+            print(f"Merged shards: {', '.join(str(shard) for shard in shards)}")
+
         print("Batchers statistics:")
         print(f"\tPatients item processed:       {self.stats.get('patients', {}).get('processed_items', 0):8}")
         print(f"\tPatients records inserted:     {self.stats.get('patients', {}).get('inserted_records', 0):8}")
@@ -164,46 +444,161 @@ class App:
         print(f"\tObservations item processed:   {self.stats.get('observations', {}).get('processed_items', 0):8}")
         print(f"\tObservations records inserted: {self.stats.get('observations', {}).get('inserted_records', 0):8}")
 
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (skipped := self.stats.get(entity, {}).get("skipped_items")):
+                print(f"\t{entity.capitalize()} items of other shards: {skipped}")
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (failed := self.stats.get(entity, {}).get("failed_records")):
+                print(f"\t{entity.capitalize()} records failed: {failed}")
+                if (reject_file := self.stats[entity].get("reject_file")):
+                    print(f"\t\trejected rows written to {reject_file}")
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (duplicates := self.stats.get(entity, {}).get("duplicates")) is not None:
+                print(
+                    f"\t{entity.capitalize()} duplicates dropped: {duplicates}, "
+                    f"dedupe memory: {self.stats[entity]['dedupe_memory'] / 2 ** 20:.1f} MiB"
+                )
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (rejections := self.stats.get(entity, {}).get("rejections")):
+                print(f"\t{entity.capitalize()} items rejected: {sum(rejections.values())}")
+                for reason, count in sorted(rejections.items(), key=lambda item: item[1], reverse=True):
+                    print(f"\t\t{reason:>28} {count:8}")
+                if (dead_letter_file := self.stats[entity].get("dead_letter_file")):
+                    print(f"\t\trejected items written to {dead_letter_file}")
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (sizes := self.stats.get(entity, {}).get("batch_sizes")):
+                chosen = [size for _, size in sizes]
+                print(
+                    f"\t{entity.capitalize()} batch size: {chosen[-1]} "
+                    f"(min {min(chosen)}, max {max(chosen)}, {len(chosen) - 1} changes)"
+                )
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (budget := self.stats.get(entity, {}).get("memory_budget")):
+                line = (
+                    f"\t{entity.capitalize()} memory budget: peak {budget['peak'] / 2 ** 20:.1f} "
+                    f"of {budget['limit'] / 2 ** 20:.1f} MiB, download waited {budget['waited']:.1f} s"
+                )
+                if (spilled := budget.get("spilled_rows")):
+                    line += f", {spilled} rows spilled, up to {budget['spill_peak_size'] / 2 ** 20:.1f} MiB on disk"
+                print(line)
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (throttle := self.stats.get(entity, {}).get("throttle")):
+                print(
+                    f"\t{entity.capitalize()} throttled: {throttle['waited']:.1f} s waited, "
+                    f"{throttle['backoffs']} backoffs, "
+                    f"final limits {throttle['rows_per_second'] or 'unlimited'} rows/s, "
+                    f"{throttle['flushes_per_second'] or 'unlimited'} flushes/s"
+                )
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (timings := self.stats.get(entity, {}).get("extraction_timings")):
+                print(f"{entity.capitalize()} extraction timings:")
+                for name, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+                    print(f"\t{name:>20} {seconds:8.4f} s")
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (transfer := self.stats.get(entity, {}).get("transfer")):
+                print(
+                    f"{entity.capitalize()} source bytes: {transfer['compressed_bytes']} compressed, "
+                    f"{transfer['uncompressed_bytes']} uncompressed"
+                )
+
+        for entity in ("patients", "encounters", "procedures", "observations"):
+            if (memory := self.stats.get(entity, {}).get("memory")) and memory["peak_rss"] is not None:
+                line = f"{entity.capitalize()} peak RSS: {memory['peak_rss'] / 2 ** 20:.1f} MiB"
+                if "traced_peak" in memory:
+                    line += (
+                        f", traced peak: {memory['traced_peak'] / 2 ** 20:.1f} MiB, "
+                        f"{memory['batch_rows_at_snapshot']} batch rows at largest snapshot"
+                    )
+                print(line)
+                for site in memory.get("top_sites", []):
+                    print(f"\t{site['size'] / 2 ** 20:8.1f} MiB {site['count']:9} blocks  {site['site']}")
+
+        if (statements := self.stats.get('statements')):
+            print("Database statements taking most time:")
+            print(f"\t{'count':>8} {'rows':>9} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'slow':>5}  statement")
+            for line in format_statements(statements):
+                print(f"\t{line}")
+
+        for entity, profile in self.profiles.items():
+            print(f"{entity.capitalize()} profile, {profile['samples']} samples in {', '.join(profile['files'])}:")
+            print(f"\t{'own':>6} {'total':>6}  function")
+            for label, own, inclusive in profile['top']:
+                print(f"\t{own:6.1%} {inclusive:6.1%}  {label}")
+
         print("Additional statistics:")
 
         print("\tPatients by gender:")
-        for item in self.stats['patients_genders'].items():
+        for item in self.stats.get('patients_genders', {}).items():
             print(f"\t{item[0]:>20} {item[1]:8}")
 
         print("\t10 most popular procedures:")
-        for item in self.stats['most_popular_procedures'].items():
+        for item in self.stats.get('most_popular_procedures', {}).items():
             print(f"\t{item[0]:>20} {item[1]:8}")
 
         print("\tMost popular start encounter days of week:")
-        for item in self.stats['popular_start_encounters_days'].items():
+        for item in self.stats.get('popular_start_encounters_days', {}).items():
             print(f"\t{item[0]:>20} {item[1]:8}")
 
         print("\tMost popular end encounter days of week:")
-        for item in self.stats['popular_end_encounters_days'].items():
+        for item in self.stats.get('popular_end_encounters_days', {}).items():
             print(f"\t{item[0]:>20} {item[1]:8}")
 
-    async def main_single_entity(self, pool: Pool, entity: str) -> None:
+    async def main_single_entity(self, sink: Sink, entity: str) -> None:
         if entity == "patients":
-            await self.resolve_patients(pool)
+            await self.resolve_patients(sink)
         elif entity == "encounters":
-            await self.resolve_encounters(pool)
+            await self.resolve_encounters(sink)
         elif entity == "procedures":
-            await self.resolve_procedures(pool)
+            await self.resolve_procedures(sink)
         elif entity == "observations":
-            await self.resolve_observations(pool)
+            await self.resolve_observations(sink)
 
     async def main(self) -> None:
-        pool = await self.create_pool()
+        self.stats['event_loop'] = loop_name(self._loop)
+        if (shard := Shard.from_spec(self._settings['SHARD'])) is not None:
+            self.stats['shard'] = str(shard)
+        if self._settings['READ_PROCESSES'] > 1 and self._settings['DEDUPE'] and not self._settings['ROW_CACHE']:
+            logger.warning(
+                "Every one of %s processes has its own DEDUPE filter, duplicates in different ranges are inserted",
+                self._settings['READ_PROCESSES'],
+            )
+        if self._settings['SELECTIVE_EXTRACTION'] and extract.simdjson is None:
+            logger.warning(
+                "SELECTIVE_EXTRACTION without pysimdjson decodes whole resources, "
+                "slower than SELECTIVE_EXTRACTION=0 (full decode)"
+            )
+
+        # SIGUSR1 isn't available on Windows
+        with contextlib.suppress(AttributeError, NotImplementedError):
+            self._loop.add_signal_handler(signal.SIGUSR1, self.dump_stats)
+
+        sink = await self.create_sink()
 
         if (entity := self.command_line_args.entity):
-            await self.main_single_entity(pool, entity)
+            await self.main_single_entity(sink, entity)
         else:
-            await self.resolve_patients(pool)
-            await self.resolve_encounters(pool)
-            await self.resolve_procedures(pool)
-            await self.resolve_observations(pool)
+            await self.resolve_patients(sink)
+            await self.resolve_encounters(sink)
+            await self.resolve_procedures(sink)
+            await self.resolve_observations(sink)
+
+        await self.post_run_stats(sink)
+        await sink.close()
+        self.tracer.close()
+
+        if self._settings['STATS_PATH']:
+            write_stats(self._settings['STATS_PATH'], {**self.stats, 'finished_at': time.time()})
 
-        await self.post_run_stats(pool)
+        with contextlib.suppress(AttributeError, NotImplementedError):
+            self._loop.remove_signal_handler(signal.SIGUSR1)
 
 
 def clear_data() -> None:
@@ -219,6 +614,34 @@ def clear_data() -> None:
             cur1.execute(file.read())
 
 
+def run_tuning(loop: asyncio.AbstractEventLoop, args: argparse.Namespace) -> None:
+    config_logging(args.verbose)
+    tuner = Tuner(loop, settings, args, sample_size=args.sample, rounds=args.rounds, repeats=args.repeats)
+    tuned = loop.run_until_complete(tuner.run())
+    write_entity_settings(args.output, tuned)
+    print(f"Tuned settings written to {args.output}:")
+    print(json.dumps(tuned, indent=4, sort_keys=True))
+
+
+def run_merge_stats(loop: asyncio.AbstractEventLoop, args: argparse.Namespace) -> None:
+    app = init_app(loop=loop, settings=settings, command_line_args=args)
+    app.stats = merge_stats(read_stats(args.files))
+    app.print_final_report()
+
+
+def run_rollback(args: argparse.Namespace) -> None:
+    config_logging(args.verbose)
+    ShadowReload.from_settings(settings).rollback()
+
+
+def parse_shard(spec: str) -> str:
+    try:
+        Shard.from_spec(spec)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return spec
+
+
 def init_app(
     loop: asyncio.AbstractEventLoop,
     settings: dict,
@@ -242,16 +665,101 @@ def start() -> None:
         '-e', '--entity', choices=["patients", "encounters", "procedures", "observations"],
         help="Run app for single entity.",
     )
+    parser.add_argument(
+        '-s', '--sink', choices=SINKS, default=settings['SINK'],
+        help=(
+            "Storage for loaded data, `memory` keeps rows in process memory and requires no database, "
+            "`files` exports rows into EXPORT_PATH directory."
+        ),
+    )
+    parser.add_argument(
+        '--reload', action='store_true', default=settings['RELOAD'],
+        help=(
+            "Load into shadow tables swapped with live ones at the end, readers see old data until then, "
+            "previous tables are kept for `rollback`"
+        ),
+    )
+    parser.add_argument(
+        '--loop', choices=EVENT_LOOPS, default=settings['EVENT_LOOP'],
+        help="Event loop implementation, uvloop requires `pip install -e .[speedups]`",
+    )
+    parser.add_argument(
+        '--executor-workers', type=int, default=settings['EXECUTOR_WORKERS'],
+        help="Threads of the loop's default executor writing files, 0 keeps the stock size",
+    )
+    parser.add_argument(
+        '-j', '--processes', type=int, default=settings['READ_PROCESSES'],
+        help="Split uncompressed local or range-capable HTTP sources into byte ranges loaded by this many processes",
+    )
+    parser.add_argument(
+        '--shard', type=parse_shard, default=settings['SHARD'], metavar='k/N',
+        help="Load only k-th of N hash partitions of every entity, by patient id, shards may run on many machines",
+    )
+    parser.add_argument(
+        '--stats', default=settings['STATS_PATH'], metavar='PATH',
+        help="Write statistics of the run as JSON, files of all shards are merged by `merge-stats`",
+    )
+    parser.add_argument(
+        '--profile', action='store_true', default=settings['PROFILE'],
+        help="Profile the run by sampling, per-entity pstats and collapsed stacks are written to PROFILE_PATH",
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    tune_parser = subparsers.add_parser(
+        'tune', help="Search queue, worker and batcher settings by timed trials on a scratch database",
+    )
+    tune_parser.add_argument(
+        '--sample', type=int, default=settings['TUNE_SAMPLE_SIZE'], help="Items of every entity loaded in trials",
+    )
+    tune_parser.add_argument('--rounds', type=int, default=1, help="Passes over all searched settings")
+    tune_parser.add_argument('--repeats', type=int, default=1, help="Runs of every trial, the fastest one counts")
+    tune_parser.add_argument(
+        '-o', '--output', default=settings['TUNED_SETTINGS_PATH'], help="File tuned settings are written to",
+    )
+    merge_parser = subparsers.add_parser('merge-stats', help="Print final report of statistics written by shards")
+    merge_parser.add_argument('files', nargs='+', help="Files written with --stats")
+    subparsers.add_parser('rollback', help="Swap tables replaced by the last --reload back in")
     args = parser.parse_args()
 
-    if args.clean:
-        clear_data()
+    if args.clean and args.shard:
+        parser.error("-c can't be used with --shard, clear the database before starting shards")
+    if args.reload and (args.clean or args.shard or args.entity or args.sink != "postgres"):
+        parser.error("--reload replaces all entities in postgres, it can't be used with -c, -e, -s or --shard")
 
     started_at = time.monotonic()
 
-    loop = asyncio.new_event_loop()
+    loop = new_event_loop(args.loop, args.executor_workers)
     asyncio.set_event_loop(loop)
-    app = init_app(loop=loop, settings=settings, command_line_args=args)
+
+    if args.command == 'tune':
+        run_tuning(loop, args)
+        return
+    if args.command == 'merge-stats':
+        run_merge_stats(loop, args)
+        return
+    if args.command == 'rollback':
+        run_rollback(args)
+        return
+
+    if args.clean and args.sink == "postgres":
+        clear_data()
+    reload = None
+    if args.reload:
+        config_logging(args.verbose)
+        reload = ShadowReload.from_settings(settings)
+        reload.prepare()
+
+    app = init_app(
+        loop=loop,
+        settings={
+            **settings, 'SINK': args.sink, 'PROFILE': args.profile, 'SHARD': args.shard, 'STATS_PATH': args.stats,
+            'READ_PROCESSES': args.processes, 'EVENT_LOOP': args.loop, 'EXECUTOR_WORKERS': args.executor_workers,
+            'RELOAD': args.reload,
+        },
+        command_line_args=args,
+    )
     loop.run_until_complete(app.main())
+    # failed runs leave live tables untouched, shadow ones are dropped by the next reload
+    if reload is not None:
+        reload.finish()
 
     logger.info(f"TOTAL TIME: {(time.monotonic() - started_at):.4f} s")
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import logging
+import os
+import zlib
+from typing import IO, Any, AsyncIterable, AsyncIterator, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 64 * 1024
+ACCEPT_ENCODING = "gzip, deflate, zstd" if zstandard is not None else "gzip, deflate"
+
+_WRITE_BUFFER_SIZE = 1024 * 1024
+_CONTENT_ENCODINGS = {'gzip': 'gzip', 'x-gzip': 'gzip', 'deflate': 'gzip', 'zstd': 'zstd'}
+_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'\x28\xb5\x2f\xfd', 'zstd'))
+_MAGIC_SIZE = max(len(magic) for magic, _ in _MAGIC)
+
+
+class Decompressor:
+    """Incremental decoder of gzip (or zlib) and zstd streams, concatenated members included."""
+
+    def __init__(self, encoding: str) -> None:
+        if encoding == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd compressed source requires `zstandard`, `pip install -e .[speedups]`")
+        self.encoding = encoding
+        self._decoder = self._new()
+        self._in_member = False
+
+    def _new(self) -> Any:
+        if self.encoding == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        # 32 + MAX_WBITS detects gzip or zlib header
+        return zlib.decompressobj(wbits=32 + zlib.MAX_WBITS)
+
+    def decompress(self, data: bytes) -> bytes:
+        parts = []
+        while data:
+            parts.append(self._decoder.decompress(data))
+            self._in_member = not self._decoder.eof
+            if self._in_member:
+                break
+            data = self._decoder.unused_data
+            self._decoder = self._new()
+        return b''.join(parts)
+
+    def finish(self) -> None:
+        if self._in_member:
+            raise ValueError(f"truncated {self.encoding} stream")
+
+
+def content_decompressor(content_encoding: Optional[str]) -> Optional[Decompressor]:
+    encoding = _CONTENT_ENCODINGS.get((content_encoding or "").strip().lower())
+    return Decompressor(encoding) if encoding is not None else None
+
+
+def sniff_decompressor(head: bytes) -> Optional[Decompressor]:
+    """File level compression (`.ndjson.gz`, `.ndjson.zst`) recognised by its magic bytes."""
+    for magic, encoding in _MAGIC:
+        if head.startswith(magic):
+            return Decompressor(encoding)
+    return None
+
+
+async def decode_lines(
+    chunks: AsyncIterable[bytes], content_encoding: Optional[str], transfer: dict,
+) -> AsyncIterator[bytes]:
+    """
+    Splits raw body into lines, undoing transfer (`Content-Encoding`) and file level compression on the fly.
+
+    `transfer` counts `compressed_bytes` read and `uncompressed_bytes` decoded.
+    """
+    decompressors = []
+    if (decompressor := content_decompressor(content_encoding)) is not None:
+        decompressors.append(decompressor)
+
+    transfer.setdefault('compressed_bytes', 0)
+    transfer.setdefault('uncompressed_bytes', 0)
+
+    head: Optional[bytes] = b''
+    pending = b''
+
+    async for chunk in chunks:
+        transfer['compressed_bytes'] += len(chunk)
+        for decompressor in decompressors:
+            chunk = decompressor.decompress(chunk)
+
+        if head is not None:
+            # buffer until there are enough bytes to recognise file level compression
+            head += chunk
+            if len(head) < _MAGIC_SIZE:
+                continue
+            chunk, head = head, None
+            if (decompressor := sniff_decompressor(chunk)) is not None:
+                decompressors.append(decompressor)
+                chunk = decompressor.decompress(chunk)
+
+        transfer['uncompressed_bytes'] += len(chunk)
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+
+    for decompressor in decompressors:
+        decompressor.finish()
+
+    if head:
+        transfer['uncompressed_bytes'] += len(head)
+        pending += head
+    if pending:
+        yield pending
+
+
+class CachedBodyWriter:
+    """Tees downloaded body into a temporary file, that replaces the cached copy on `commit`."""
+
+    def __init__(self, body_path: str, meta_path: str, meta: dict) -> None:
+        self._body_path = body_path
+        self._meta_path = meta_path
+        self._meta = meta
+        self._tmp_path = f"{body_path}.tmp"
+        self._file = open(self._tmp_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+
+    def commit(self) -> None:
+        self._file.close()
+        os.replace(self._tmp_path, self._body_path)
+        with open(self._meta_path, 'w') as file:
+            json.dump(self._meta, file)
+
+    def discard(self) -> None:
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+class DownloadCache:
+    """
+    Local copies of downloaded sources with their `ETag` and `Last-Modified` headers.
+
+    They are sent back as `If-None-Match` and `If-Modified-Since`, on `304 Not Modified`
+    the source is read from the local copy. Bodies are kept as received, still compressed.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _paths(self, url: str) -> Tuple[str, str]:
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.path, f"{name}.body"), os.path.join(self.path, f"{name}.json")
+
+    def meta(self, url: str) -> Optional[dict]:
+        body_path, meta_path = self._paths(url)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path) as file:
+            return json.load(file)
+
+    def conditional_headers(self, url: str) -> dict:
+        headers: dict = {}
+        if (meta := self.meta(url)) is None:
+            return headers
+
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def writer(self, url: str, headers: CIMultiDictProxy) -> Optional[CachedBodyWriter]:
+        """Returns writer for cacheable response, None when response can't be validated later."""
+        etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return None
+
+        body_path, meta_path = self._paths(url)
+        meta = {
+            'url': url, 'etag': etag, 'last_modified': last_modified,
+            'content_encoding': headers.get('Content-Encoding'),
+        }
+        return CachedBodyWriter(body_path, meta_path, meta)
+
+    def open(self, url: str) -> IO[bytes]:
+        return open(self._paths(url)[0], 'rb')
+
+
+def local_path(url: str) -> Optional[str]:
+    """Path of a local source, given as a path or `file://` URL."""
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return parsed.path
+    if not parsed.scheme and os.path.exists(url):
+        return url
+    return None
+
+
+async def _read_file(file: IO[bytes]) -> AsyncIterator[bytes]:
+    while (chunk := file.read(CHUNK_SIZE)):
+        yield chunk
+
+
+async def _tee(chunks: AsyncIterable[bytes], writer: CachedBodyWriter) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        writer.write(chunk)
+        yield chunk
+
+
+async def read_lines(
+    session: aiohttp.ClientSession, url: str, cache: Optional[DownloadCache] = None,
+    transfer: Optional[dict] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields lines of the source at `url`, `session` must be created with `auto_decompress=False`.
+    Local files are read directly, given as a path or `file://` URL.
+
+    With `cache` the raw body is teed into it from the same stream.
+    """
+    transfer = transfer if transfer is not None else {}
+    if (path := local_path(url)) is not None:
+        with open(path, 'rb') as file:
+            transfer['content_length'] = os.fstat(file.fileno()).st_size
+            async for line in decode_lines(_read_file(file), None, transfer):
+                yield line
+        return
+
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    if cache is not None:
+        headers.update(cache.conditional_headers(url))
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304 and cache is not None:
+            logger.debug("Source not modified, reading cached copy")
+            meta = cache.meta(url) or {}
+            with cache.open(url) as cached:
+                transfer['content_length'] = os.fstat(cached.fileno()).st_size
+                async for line in decode_lines(_read_file(cached), meta.get('content_encoding'), transfer):
+                    yield line
+            return
+
+        content_encoding = response.headers.get('Content-Encoding')
+        transfer['content_length'] = response.content_length
+
+        chunks: AsyncIterable[bytes] = response.content.iter_chunked(CHUNK_SIZE)
+        writer = None
+        if cache is not None and response.status == 200:
+            writer = cache.writer(url, response.headers)
+        if writer is not None:
+            chunks = _tee(chunks, writer)
+
+        try:
+            async for line in decode_lines(chunks, content_encoding, transfer):
+                yield line
+        except BaseException:
+            if writer is not None:
+                writer.discard()
+            raise
+
+        if writer is not None:
+            writer.commit()
@@ -0,0 +1,38 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None  # type: ignore
+
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOOPS = ("asyncio", "uvloop")
+
+
+def new_event_loop(name: str = "asyncio", executor_workers: int = 0) -> asyncio.AbstractEventLoop:
+    """
+    Event loop of `name` implementation, uvloop requires `uvloop` (`pip install -e .[speedups]`),
+    stock loop is used when it isn't installed.
+
+    With `executor_workers` the default executor, running file writes of sinks and dead letters,
+    gets this many threads instead of the stock `min(32, cpu_count + 4)`. Decoding and extraction
+    aren't offloaded to it, they hold the GIL, processes of `READ_PROCESSES` run them in parallel.
+    """
+    if name not in EVENT_LOOPS:
+        raise ValueError(f"unknown event loop {name!r}, expected one of {EVENT_LOOPS}")
+    if name == "uvloop" and uvloop is None:
+        logger.warning("uvloop isn't installed, stock asyncio event loop is used")
+        name = "asyncio"
+
+    loop = uvloop.new_event_loop() if name == "uvloop" else asyncio.new_event_loop()
+    if executor_workers:
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="executor"))
+    return loop
+
+
+def loop_name(loop: asyncio.AbstractEventLoop) -> str:
+    return "uvloop" if type(loop).__module__.startswith("uvloop") else "asyncio"
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import List, Optional
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # type: ignore
+
+
+logger = logging.getLogger(__name__)
+
+# new allocation snapshot is taken only when traced memory grew by this factor since the last one
+SNAPSHOT_GROWTH = 1.1
+
+_IGNORED_TRACES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def current_rss() -> Optional[int]:
+    """Resident set size of the process in bytes, peak one where current isn't available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:  # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryTracker:
+    """
+    Memory used while an entity is loaded, sampled by the batcher at batch boundaries.
+
+    Peak RSS is always sampled. With `trace` enabled `tracemalloc` runs for the whole entity and
+    allocation snapshots are taken at the batches raising traced memory, sites holding most memory
+    at the highest one are reported. Tracing slows allocations down considerably.
+    """
+
+    def __init__(self, entity: str, trace: bool = False, frames: int = 1, top: int = 10) -> None:
+        self.entity = entity
+        self.trace = trace
+        self.frames = frames
+        self.top = top
+
+        self.samples = 0
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        self.traced_peak = 0
+        self.batch_rows_at_snapshot = 0
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_size = 0
+
+    def start(self) -> None:
+        if self.trace:
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        self.sample(0)
+        if self.trace:
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    def sample(self, batch_rows: int) -> None:
+        self.samples += 1
+        if (rss := current_rss()) is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+        if not self.trace or not tracemalloc.is_tracing():
+            return
+        traced, _ = tracemalloc.get_traced_memory()
+        if traced > self._snapshot_size * SNAPSHOT_GROWTH:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._snapshot_size = traced
+            self.batch_rows_at_snapshot = batch_rows
+
+    def top_sites(self) -> List[dict]:
+        """Allocation sites holding most memory at the highest snapshot."""
+        if self._snapshot is None:
+            return []
+        snapshot = self._snapshot.filter_traces(_IGNORED_TRACES)
+        group = "traceback" if self.frames > 1 else "lineno"
+        return [
+            {
+                "site": " <- ".join(f"{frame.filename}:{frame.lineno}" for frame in reversed(stat.traceback)),
+                "size": stat.size,
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics(group)[:self.top]
+        ]
+
+    def get_stats(self) -> dict:
+        stats: dict = {"peak_rss": self.peak_rss, "start_rss": self.start_rss, "samples": self.samples}
+        if self.trace:
+            stats["traced_peak"] = self.traced_peak
+            stats["snapshot_size"] = self._snapshot_size
+            stats["batch_rows_at_snapshot"] = self.batch_rows_at_snapshot
+            stats["top_sites"] = self.top_sites()
+        return stats
+
+    def write(self, path: str) -> str:
+        """Writes stats to `<path>/<entity>.json`, returns its path."""
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, f"{self.entity}.json")
+        with open(file_path, "w") as file:
+            json.dump(self.get_stats(), file, indent=4)
+        logger.debug("%s memory report written to %s", self.entity, file_path)
+        return file_path
+
+
+def rows_size(rows: List[dict]) -> int:
+    """Estimated bytes held by mapped rows of a resource, they share the shape of the first one."""
+    if not rows:
+        return 0
+    row = rows[0]
+    return len(rows) * (sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values()))
+
+
+class MemoryBudget:
+    """
+    Bytes of source lines waiting in the queue plus rows waiting in the batch, bounded by `limit`.
+
+    Lines are charged by `acquire`, which waits while the budget is exceeded, and released once
+    processed. Rows are charged without waiting, queue workers would hold lines meanwhile; the batcher
+    flushes or spills them when the budget is exceeded instead.
+    """
+
+    def __init__(self, limit: int, spill: bool = False) -> None:
+        self.limit = limit
+        self.spill = spill
+        self.used = 0
+        self.peak = 0
+        self.waits = 0
+        self.waited = 0.0
+        # lines waiting in `acquire`
+        self.waiting = 0
+        self._freed: Optional[asyncio.Event] = None
+        self._pressure: Optional[asyncio.Event] = None
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> Optional['MemoryBudget']:
+        if not settings['MEMORY_BUDGET_MB']:
+            return None
+        if settings['MEMORY_BUDGET_MODE'] not in ("backpressure", "spill"):
+            raise ValueError(f"unknown MEMORY_BUDGET_MODE {settings['MEMORY_BUDGET_MODE']!r}")
+        return cls(int(settings['MEMORY_BUDGET_MB'] * 2 ** 20), settings['MEMORY_BUDGET_MODE'] == "spill")
+
+    @property
+    def exceeded(self) -> bool:
+        """Over the limit or lines are waiting for rows to be released."""
+        return self.used > self.limit or self.waiting > 0
+
+    async def acquire(self, size: int) -> None:
+        """Charges `size` bytes, waits for others to be released first unless nothing is charged."""
+        if self.used and self.used + size > self.limit:
+            if self._freed is None:
+                self._freed = asyncio.Event()
+            self.waits += 1
+            self.waiting += 1
+            if self._pressure is not None:
+                self._pressure.set()
+            started_at = time.monotonic()
+            try:
+                while self.used and self.used + size > self.limit:
+                    self._freed.clear()
+                    await self._freed.wait()
+            finally:
+                self.waiting -= 1
+                self.waited += time.monotonic() - started_at
+        self.charge(size)
+
+    async def wait_pressure(self, timeout: float) -> None:
+        """Sleeps up to `timeout` seconds, wakes up early when lines start waiting."""
+        if self._pressure is None:
+            self._pressure = asyncio.Event()
+        # lines already waiting don't wake the caller again, it always yields
+        self._pressure.clear()
+        try:
+            await asyncio.wait_for(self._pressure.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def charge(self, size: int) -> None:
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def release(self, size: int) -> None:
+        self.used -= size
+        if self._freed is not None:
+            self._freed.set()
+
+    def get_stats(self) -> dict:
+        return {"limit": self.limit, "peak": self.peak, "waits": self.waits, "waited": self.waited}
@@ -0,0 +1,144 @@
+import collections
+import os
+import pstats
+import sys
+import threading
+from types import FrameType
+from typing import Counter, Dict, List, Optional, Tuple
+
+# (filename, first line, function name), the key `pstats` uses
+Function = Tuple[str, int, str]
+Stack = Tuple[Function, ...]
+
+# the event loop waiting in `select` is time spent on the network or the database
+IDLE = ("~", 0, "<waiting for I/O>")
+
+
+def _function(frame: FrameType) -> Function:
+    code = frame.f_code
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _label(function: Function) -> str:
+    filename, line, name = function
+    if filename == "~":
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class _SampledStats:
+    """Sampled stacks in the shape `pstats.Stats` loads from `cProfile.Profile`."""
+
+    def __init__(self, samples: Counter[Stack], interval: float) -> None:
+        self.stats: dict = {}
+        entries: Dict[Function, list] = {}
+        callers: Dict[Function, Dict[Function, list]] = collections.defaultdict(dict)
+
+        for stack, count in samples.items():
+            seconds = count * interval
+            # recursive functions count once per stack towards inclusive time
+            for function in dict.fromkeys(stack):
+                entries.setdefault(function, [0, 0.0, 0.0])[2] += seconds
+            for i, function in enumerate(stack):
+                entries[function][0] += count
+                if i:
+                    caller = callers[function].setdefault(stack[i - 1], [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[3] += seconds
+            entries[stack[-1]][1] += seconds
+            if len(stack) > 1:
+                callers[stack[-1]][stack[-2]][2] += seconds
+
+        for function, (count, own, total) in entries.items():
+            self.stats[function] = (
+                count, count, own, total, {caller: tuple(values) for caller, values in callers[function].items()},
+            )
+
+    def create_stats(self) -> None:
+        pass
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the thread running the event loop.
+
+    A daemon thread samples the loop thread's stack every `interval` seconds, so the profiled code runs
+    unmodified and overhead doesn't grow with the number of calls. Whatever coroutine the loop is
+    resuming is on that stack; samples of the loop blocked in `select` are counted as waiting for I/O.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples: Counter[Stack] = collections.Counter()
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if (frame := sys._current_frames().get(self._thread_id)) is not None:
+                self.sample(frame)
+
+    def sample(self, frame: Optional[FrameType]) -> None:
+        stack: List[Function] = []
+        while frame is not None:
+            stack.append(_function(frame))
+            frame = frame.f_back
+        stack.reverse()
+        if stack and stack[-1][2] == "select" and stack[-1][0].endswith("selectors.py"):
+            stack.append(IDLE)
+        self.samples[tuple(stack)] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.samples.values())
+
+    def stats(self) -> pstats.Stats:
+        return pstats.Stats(_SampledStats(self.samples, self.interval))  # type: ignore
+
+    def collapsed(self) -> List[str]:
+        """Stacks in the folded format of `flamegraph.pl` and speedscope, root first."""
+        return [
+            f"{';'.join(_label(function) for function in stack)} {count}"
+            for stack, count in sorted(self.samples.items())
+        ]
+
+    def top(self, limit: int) -> List[Tuple[str, float, float]]:
+        """`limit` functions with most samples on top of the stack, with share of own and inclusive samples."""
+        own: Counter[Function] = collections.Counter()
+        inclusive: Counter[Function] = collections.Counter()
+        for stack, count in self.samples.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                inclusive[function] += count
+
+        total = self.total or 1
+        return [
+            (_label(function), count / total, inclusive[function] / total)
+            for function, count in own.most_common(limit)
+        ]
+
+    def write(self, path: str, name: str) -> List[str]:
+        """Writes `<name>.pstats` and `<name>.collapsed` into `path`, returns written files."""
+        os.makedirs(path, exist_ok=True)
+        pstats_path = os.path.join(path, f"{name}.pstats")
+        collapsed_path = os.path.join(path, f"{name}.collapsed")
+
+        if self.samples:
+            self.stats().dump_stats(pstats_path)
+        with open(collapsed_path, "w") as file:
+            file.writelines(f"{line}\n" for line in self.collapsed())
+        return [pstats_path, collapsed_path] if self.samples else [collapsed_path]
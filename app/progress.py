@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from .tables.basic_batcher import Batcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def _format_bytes(value: float) -> str:
+    return f"{value / 2 ** 20:.1f} MiB"
+
+
+class Progress:
+    """
+    Periodic progress of one entity load, sampled from counters batcher and download already keep.
+
+    Every `interval` seconds a line is logged and `status` (shared by all entities) is written
+    to `status_path` as JSON.
+    """
+
+    def __init__(
+        self, entity: str, batcher: Batcher, queue: Optional[asyncio.Queue],
+        interval: float, status: dict, status_path: str = "",
+    ) -> None:
+        self.entity = entity
+        self.batcher = batcher
+        self.queue = queue
+        self.interval = interval
+        self.status = status
+        self.status_path = status_path
+
+        self.started_at = time.monotonic()
+        self._last = (self.started_at, 0, 0)
+
+    def snapshot(self, state: str = "running") -> dict:
+        now = time.monotonic()
+        elapsed = now - self.started_at
+        lines, rows = self.batcher.read_items, self.batcher.inserted_records
+
+        last_at, last_lines, last_rows = self._last
+        interval = max(now - last_at, 1e-9)
+        self._last = (now, lines, rows)
+
+        bytes_read = self.batcher.transfer.get('compressed_bytes', 0)
+        bytes_total = self.batcher.transfer.get('content_length')
+        eta = None
+        if bytes_total and bytes_read and state == "running":
+            eta = round((bytes_total - bytes_read) / (bytes_read / elapsed), 1)
+
+        return {
+            "state": state,
+            "elapsed": round(elapsed, 1),
+            "bytes_read": bytes_read,
+            "bytes_total": bytes_total,
+            "lines": lines,
+            "lines_per_second": round((lines - last_lines) / interval, 1),
+            "rows_inserted": rows,
+            "rows_per_second": round((rows - last_rows) / interval, 1),
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "flushes_in_flight": self.batcher.flushes_in_flight,
+            "eta": eta,
+        }
+
+    def format(self, snapshot: dict) -> str:
+        read = _format_bytes(snapshot["bytes_read"])
+        if snapshot["bytes_total"]:
+            read += f" / {_format_bytes(snapshot['bytes_total'])}"
+        eta = f"{snapshot['eta']:.0f} s" if snapshot["eta"] is not None else "-"
+        return (
+            f"{self.entity.capitalize()}: {read}, {snapshot['lines']} lines ({snapshot['lines_per_second']:.0f}/s), "
+            f"{snapshot['rows_inserted']} rows ({snapshot['rows_per_second']:.0f}/s), "
+            f"queue {snapshot['queue_depth']}, flushing {snapshot['flushes_in_flight']}, ETA {eta}"
+        )
+
+    def report(self, state: str = "running") -> dict:
+        snapshot = self.snapshot(state)
+        self.status[self.entity] = snapshot
+        logger.info(self.format(snapshot))
+        if self.status_path:
+            self.write_status()
+        return snapshot
+
+    def write_status(self) -> None:
+        tmp_path = f"{self.status_path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.status, file, indent=4)
+        os.replace(tmp_path, self.status_path)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
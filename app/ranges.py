@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import logging
+import os
+from typing import AsyncIterable, AsyncIterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .download import _MAGIC_SIZE, CHUNK_SIZE, local_path, sniff_decompressor
+from .eventloop import new_event_loop
+
+
+logger = logging.getLogger(__name__)
+
+ByteRange = Tuple[int, int]
+
+_COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+
+async def source_size(session: aiohttp.ClientSession, url: str) -> Optional[int]:
+    """
+    Size of an uncompressed source that can be read by byte ranges, None for any other.
+
+    Compressed sources can't be split, HTTP ones must send `Content-Length` and `Accept-Ranges: bytes`.
+    """
+    if (path := local_path(url)) is not None:
+        with open(path, "rb") as file:
+            if sniff_decompressor(file.read(_MAGIC_SIZE)) is not None:
+                return None
+            return os.fstat(file.fileno()).st_size
+
+    if urlparse(url).path.endswith(_COMPRESSED_SUFFIXES):
+        return None
+    async with session.head(url, allow_redirects=True, headers={"Accept-Encoding": "identity"}) as response:
+        if (
+            response.status != 200
+            or response.headers.get("Accept-Ranges") != "bytes"
+            or response.headers.get("Content-Encoding", "identity") != "identity"
+        ):
+            return None
+        return response.content_length
+
+
+def split(size: int, parts: int) -> List[ByteRange]:
+    """Splits `size` bytes into `parts` ranges of similar size, empty ones are left out."""
+    bounds = [size * i // parts for i in range(parts + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+async def _read_file(path: str, offset: int) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while (chunk := file.read(CHUNK_SIZE)):
+            yield chunk
+
+
+async def _read_http(session: aiohttp.ClientSession, url: str, offset: int) -> AsyncIterator[bytes]:
+    headers = {"Range": f"bytes={offset}-", "Accept-Encoding": "identity"}
+    async with session.get(url, headers=headers) as response:
+        if response.status != 206:
+            raise ValueError(f"{url} ignored byte range request, status {response.status}")
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            yield chunk
+
+
+async def read_range_lines(
+    session: aiohttp.ClientSession, url: str, byte_range: ByteRange, transfer: Optional[dict] = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields lines of an uncompressed source starting within `byte_range`.
+
+    Reading starts a byte before the range, the line in progress there belongs to the previous range,
+    and goes past its end to finish the last line started in it. Adjacent ranges yield every line once.
+    """
+    start, end = byte_range
+    transfer = transfer if transfer is not None else {}
+    transfer['content_length'] = end - start
+    transfer.setdefault('compressed_bytes', 0)
+    transfer.setdefault('uncompressed_bytes', 0)
+
+    offset = max(start - 1, 0)
+    chunks: AsyncIterable[bytes]
+    if (path := local_path(url)) is not None:
+        chunks = _read_file(path, offset)
+    else:
+        chunks = _read_http(session, url, offset)
+
+    position = offset
+    pending = b''
+    # line in progress a byte before the range is skipped up to its newline
+    skipping = start > 0
+    async for chunk in chunks:
+        transfer['compressed_bytes'] += len(chunk)
+        transfer['uncompressed_bytes'] += len(chunk)
+        if skipping:
+            if (newline := chunk.find(b'\n')) < 0:
+                position += len(chunk)
+                continue
+            position += newline + 1
+            chunk = chunk[newline + 1:]
+            skipping = False
+
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if position >= end:
+                return
+            yield line
+            position += len(line) + 1
+        if position >= end:
+            return
+
+    if pending and not skipping and position < end:
+        yield pending
+
+
+def load_range(settings: dict, entity: str, url: str, byte_range: ByteRange, verbose: bool) -> dict:
+    """Loads lines of `byte_range` in a worker process with its own loop, pool and batcher, returns its stats."""
+    # the app imports this module
+    from . import App, config_logging
+    from .tune import BATCHERS
+
+    config_logging(verbose)
+    loop = new_event_loop(settings['EVENT_LOOP'], settings['EXECUTOR_WORKERS'])
+    asyncio.set_event_loop(loop)
+    app = App(loop, settings, argparse.Namespace(verbose=verbose, entity=entity))
+
+    async def load() -> dict:
+        sink = await app.create_sink()
+        batcher = BATCHERS[entity](sink, app.entity_settings(entity))
+        try:
+            await app._load_data(batcher, url, byte_range=byte_range)
+        finally:
+            await sink.close()
+        return batcher.get_stats()
+
+    try:
+        return loop.run_until_complete(load())
+    finally:
+        loop.close()
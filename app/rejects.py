@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+from typing import IO, Any, Dict, List, Optional, Union
+
+
+class RejectFile:
+    """NDJSON file of rows refused by the sink, every one with the error, created on first reject."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.count = 0
+        self._file: Optional[IO[str]] = None
+
+    def write(self, row: dict, error: str) -> None:
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a")
+
+        # dates are written in ISO format, like in the source
+        self._file.write(json.dumps({"row": row, "error": error}, default=str) + "\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class DeadLetterFile:
+    """
+    NDJSON file of rejected source items with the reason, created on first write.
+
+    Lines are buffered and appended by an executor thread once `buffer_size` of them is collected,
+    writes happen one after another, so the order is kept. `close` writes the rest.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1000) -> None:
+        self.path = path
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._buffer: List[str] = []
+        self._pending: Optional[asyncio.Future] = None
+
+    def write(self, reason: str, item: Union[str, bytes, None] = None, rows: Optional[List[dict]] = None) -> None:
+        if isinstance(item, bytes):
+            item = item.decode(errors="replace")
+        entry: Dict[str, Any] = {"reason": reason, "item": item} if rows is None else {"reason": reason, "rows": rows}
+        self._buffer.append(json.dumps(entry, default=str) + "\n")
+        self.count += 1
+
+        if len(self._buffer) >= self.buffer_size:
+            self._pending = asyncio.ensure_future(self._write(self._pending, self._take()))
+
+    def _take(self) -> List[str]:
+        lines, self._buffer = self._buffer, []
+        return lines
+
+    def _append(self, lines: List[str]) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as file:
+            file.writelines(lines)
+
+    async def _write(self, previous: Optional[asyncio.Future], lines: List[str]) -> None:
+        if previous is not None:
+            await previous
+        await asyncio.get_event_loop().run_in_executor(None, self._append, lines)
+
+    async def close(self) -> None:
+        self._pending = asyncio.ensure_future(self._write(self._pending, self._take()))
+        await self._pending
+        self._pending = None
@@ -0,0 +1,150 @@
+import logging
+import time
+from typing import List
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+
+logger = logging.getLogger(__name__)
+
+# dependency order, referenced tables first
+TABLES = ("patients", "encounters", "procedures", "observations")
+LIVE_SCHEMA = "public"
+
+
+def _connect(settings: dict) -> connection:
+    return psycopg2.connect(
+        database=settings['POSTGRES_DATABASE_NAME'],
+        host=settings['POSTGRES_DATABASE_HOST'],
+        user=settings['POSTGRES_DATABASE_USERNAME'],
+        password=settings['POSTGRES_DATABASE_PASSWORD'],
+    )
+
+
+def _move_tables(cur: psycopg2.extensions.cursor, source: str, target: str) -> None:
+    """Moves tables between schemas, their sequences, indexes and constraints move along."""
+    for table in TABLES:
+        cur.execute(
+            sql.SQL("ALTER TABLE IF EXISTS {}.{} SET SCHEMA {}").format(
+                sql.Identifier(source), sql.Identifier(table), sql.Identifier(target),
+            )
+        )
+
+
+class ShadowReload:
+    """
+    Full reload into shadow tables swapped with the live ones at the end, readers see old data until then.
+
+    `prepare` creates tables of `schema_path` in `shadow` schema and drops their indexes and constraints,
+    the run loads into them through the connection `search_path`. `finish` builds indexes and constraints,
+    analyzes tables and in one transaction moves live tables into `previous` schema and shadow ones into
+    their place. The previous generation is kept until the next reload, `rollback` swaps it back.
+    Privileges and views of live tables stay with the previous generation.
+    """
+
+    def __init__(
+        self, settings: dict, shadow: str = "etl_shadow", previous: str = "etl_previous",
+        schema_path: str = "sql_scripts/schema.sql",
+    ) -> None:
+        self.settings = settings
+        self.shadow = shadow
+        self.previous = previous
+        self.schema_path = schema_path
+        # statements building indexes and constraints dropped by `prepare`, in order
+        self.deferred: List[str] = []
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> 'ShadowReload':
+        return cls(settings, settings['SHADOW_SCHEMA'], settings['PREVIOUS_SCHEMA'])
+
+    def prepare(self) -> None:
+        with _connect(self.settings) as conn, conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}").format(
+                sql.Identifier(self.shadow),
+            ))
+            cur.execute("SELECT set_config('search_path', %s, true)", (self.shadow,))
+            with open(self.schema_path) as file:
+                cur.execute(file.read())
+            cur.execute("SELECT set_config('search_path', %s, true)", (LIVE_SCHEMA,))
+            self.deferred = self._drop_indexes(cur)
+        conn.close()
+        logger.info(f"Shadow tables created in {self.shadow}, {len(self.deferred)} indexes and constraints deferred")
+
+    def _drop_indexes(self, cur: psycopg2.extensions.cursor) -> List[str]:
+        """Drops indexes and key constraints of shadow tables, returns statements creating them again."""
+        cur.execute(
+            """
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid), contype
+            FROM pg_constraint
+            WHERE connamespace = %s::regnamespace AND contype IN ('p', 'u', 'x', 'f')
+            ORDER BY contype = 'f', conrelid, conname
+            """,
+            (self.shadow,),
+        )
+        constraints = cur.fetchall()
+        cur.execute(
+            """
+            SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid)
+            FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indrelid
+            WHERE pg_class.relnamespace = %s::regnamespace
+            AND NOT EXISTS (SELECT FROM pg_constraint WHERE conindid = indexrelid)
+            ORDER BY indexrelid
+            """,
+            (self.shadow,),
+        )
+        indexes = cur.fetchall()
+
+        # foreign keys depend on keys, they're dropped first and created last
+        for table, name, _, _ in reversed(constraints):
+            cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(sql.SQL(table), sql.Identifier(name)))
+        for index, _ in indexes:
+            cur.execute(sql.SQL("DROP INDEX {}").format(sql.SQL(index)))
+
+        keys: List[sql.Composable] = []
+        foreign: List[sql.Composable] = []
+        for table, name, definition, kind in constraints:
+            statement = sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                sql.SQL(table), sql.Identifier(name), sql.SQL(definition),
+            )
+            (foreign if kind == 'f' else keys).append(statement)
+        create = [sql.SQL(definition) for _, definition in indexes]
+        return [statement.as_string(cur) for statement in [*keys, *create, *foreign]]
+
+    def finish(self) -> None:
+        """Builds deferred indexes and constraints, then swaps shadow tables in."""
+        started_at = time.monotonic()
+        with _connect(self.settings) as conn, conn.cursor() as cur:
+            for statement in self.deferred:
+                cur.execute(statement)
+            for table in TABLES:
+                cur.execute(sql.SQL("ANALYZE {}.{}").format(sql.Identifier(self.shadow), sql.Identifier(table)))
+        conn.close()
+        logger.info(f"Shadow indexes and constraints built in {time.monotonic() - started_at:.4f} s")
+
+        with _connect(self.settings) as conn, conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}").format(
+                sql.Identifier(self.previous),
+            ))
+            _move_tables(cur, LIVE_SCHEMA, self.previous)
+            _move_tables(cur, self.shadow, LIVE_SCHEMA)
+            cur.execute(sql.SQL("DROP SCHEMA {}").format(sql.Identifier(self.shadow)))
+        conn.close()
+        logger.info(f"Shadow tables swapped in, previous generation kept in {self.previous}")
+
+    def rollback(self) -> None:
+        """Swaps the previous generation back in, the replaced one becomes previous."""
+        with _connect(self.settings) as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM pg_tables WHERE schemaname = %s", (self.previous,))
+            if cur.fetchone()[0] == 0:
+                raise ValueError(f"no previous generation in {self.previous}")
+            cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}").format(
+                sql.Identifier(self.shadow),
+            ))
+            _move_tables(cur, LIVE_SCHEMA, self.shadow)
+            _move_tables(cur, self.previous, LIVE_SCHEMA)
+            _move_tables(cur, self.shadow, self.previous)
+            cur.execute(sql.SQL("DROP SCHEMA {}").format(sql.Identifier(self.shadow)))
+        conn.close()
+        logger.info(f"Previous generation swapped back in, replaced one kept in {self.previous}")
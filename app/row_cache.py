@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+from typing import Any, BinaryIO, Iterator, List, Optional
+
+import aiohttp
+import msgpack
+
+from .download import local_path
+
+
+logger = logging.getLogger(__name__)
+
+
+_DATETIME_EXT = 1
+_WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(_DATETIME_EXT, value.isoformat().encode())
+    raise TypeError(f"can't serialize {type(value)}")
+
+
+def _decode(code: int, data: bytes) -> Any:
+    if code == _DATETIME_EXT:
+        return datetime.datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+class RowCacheWriter:
+    """Appends mapped rows of every resource to a temporary file, that becomes the cache on `commit`."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        self._packer = msgpack.Packer(default=_encode)
+
+    def write(self, rows: List[dict]) -> None:
+        self._file.write(self._packer.pack(rows))
+
+    def commit(self) -> None:
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        logger.debug("Rows cached in %s", self.path)
+
+    def discard(self) -> None:
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+class RowSpill:
+    """
+    Append-only file of rows that didn't fit the memory budget, read back in the order they were written.
+
+    Rows of every resource are one msgpack frame, the file is created on first write and removed
+    whenever all rows written to it were read.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # rows written and not read yet
+        self.pending = 0
+        self.spilled_rows = 0
+        self.peak_size = 0
+        self._writer: Optional[BinaryIO] = None
+        self._reader: Optional[BinaryIO] = None
+        self._packer = msgpack.Packer(default=_encode)
+        self._unpacker = msgpack.Unpacker(ext_hook=_decode)
+
+    def write(self, rows: List[dict]) -> None:
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._writer = open(self.path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+            self._reader = open(self.path, 'rb')
+        self._writer.write(self._packer.pack(rows))
+        self.pending += len(rows)
+        self.spilled_rows += len(rows)
+
+    def read(self, limit: int) -> List[dict]:
+        """Oldest rows, whole resources until at least `limit` rows or all pending ones."""
+        if self._writer is None or self._reader is None:
+            return []
+        self._writer.flush()
+        self.peak_size = max(self.peak_size, self._writer.tell())
+
+        rows: List[dict] = []
+        while len(rows) < limit and self.pending:
+            try:
+                resource = self._unpacker.unpack()
+            except msgpack.OutOfData:
+                self._unpacker.feed(self._reader.read(_WRITE_BUFFER_SIZE))
+                continue
+            rows.extend(resource)
+            self.pending -= len(resource)
+
+        if not self.pending:
+            self.close()
+        return rows
+
+    def close(self) -> None:
+        if self._writer is None or self._reader is None:
+            return
+        self._writer.close()
+        self._reader.close()
+        self._writer = self._reader = None
+        self._unpacker = msgpack.Unpacker(ext_hook=_decode)
+        os.remove(self.path)
+
+
+class RowCache:
+    """
+    On-disk cache of mapped rows, one msgpack file per entity and source version.
+
+    Source version is identified by its URL, `ETag` and `Content-Length`, sources that don't send
+    both headers or can't be reached are never cached, local files by their path, size and mtime.
+    Rows are cached before references are resolved, so replays work against any database state.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    async def key(self, url: str) -> Optional[str]:
+        if (path := local_path(url)) is not None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            version = f"{os.path.abspath(path)}\n{stat.st_size}\n{stat.st_mtime_ns}"
+            return hashlib.sha256(version.encode()).hexdigest()
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.head(url, allow_redirects=True) as response:
+                    etag = response.headers.get('ETag')
+                    length = response.headers.get('Content-Length')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            logger.warning("Source %s isn't cached, its version is unknown: %s", url, error)
+            return None
+
+        if response.status != 200 or not etag or not length:
+            return None
+        return hashlib.sha256(f"{url}\n{etag}\n{length}".encode()).hexdigest()
+
+    def file_path(self, entity: str, key: str) -> str:
+        return os.path.join(self.path, f"{entity}-{key}.msgpack")
+
+    def has(self, entity: str, key: str) -> bool:
+        return os.path.exists(self.file_path(entity, key))
+
+    def writer(self, entity: str, key: str) -> RowCacheWriter:
+        return RowCacheWriter(self.file_path(entity, key))
+
+    def read(self, entity: str, key: str) -> Iterator[List[dict]]:
+        with open(self.file_path(entity, key), 'rb') as file:
+            yield from msgpack.Unpacker(file, ext_hook=_decode)
@@ -1,3 +1,5 @@
+import importlib.util
+import json
 import os
 
 from dotenv import load_dotenv
@@ -20,10 +22,144 @@ settings = dict(
     POSTGRES_MIN_CONNECTION_POOL_SIZE=int(os.getenv("POSTGRES_MIN_CONNECTION_POOL_SIZE", 1)),
     POSTGRES_MAX_CONNECTION_POOL_SIZE=int(os.getenv("POSTGRES_MAX_CONNECTION_POOL_SIZE", 20)),
 
+    # database connection profile, `safe` keeps server defaults, `bulk` tunes sessions for bulk loads
+    DB_PROFILE=os.getenv("DB_PROFILE", "safe"),
+    BULK_WORK_MEM=os.getenv("BULK_WORK_MEM", "64MB"),
+    BULK_STATEMENT_CACHE_SIZE=int(os.getenv("BULK_STATEMENT_CACHE_SIZE", 1024)),
+    BULK_SET_LOCAL=bool(int(os.getenv("BULK_SET_LOCAL", 0))),
+
+    # latency histogram of every statement shape, slower ones are logged with their plan
+    DB_STATEMENT_STATS=bool(int(os.getenv("DB_STATEMENT_STATS", 0))),
+    SLOW_STATEMENT_SECONDS=float(os.getenv("SLOW_STATEMENT_SECONDS", 1)),
+
+    # storage for loaded data: postgres, memory, files
+    SINK=os.getenv("SINK", "postgres"),
+
+    # `files` sink output, parquet format requires pyarrow
+    EXPORT_PATH=os.getenv("EXPORT_PATH", "export"),
+    EXPORT_FORMAT=os.getenv("EXPORT_FORMAT", "parquet"),
+    EXPORT_ROW_GROUP_SIZE=int(os.getenv("EXPORT_ROW_GROUP_SIZE", 65536)),
+
+    # cache mapped rows on disk, unchanged sources are replayed from it instead of downloaded
+    ROW_CACHE=bool(int(os.getenv("ROW_CACHE", 0))),
+    ROW_CACHE_PATH=os.getenv("ROW_CACHE_PATH", ".cache/rows"),
+
+    # keep downloaded sources locally, download again only when they changed
+    DOWNLOAD_CACHE=bool(int(os.getenv("DOWNLOAD_CACHE", 0))),
+    DOWNLOAD_CACHE_PATH=os.getenv("DOWNLOAD_CACHE_PATH", ".cache/downloads"),
+
+    # `--reload` loads into tables of SHADOW_SCHEMA swapped with live ones at the end, previous ones are kept
+    # in PREVIOUS_SCHEMA until the next reload, `etl-tool rollback` swaps them back
+    RELOAD=bool(int(os.getenv("RELOAD", 0))),
+    SHADOW_SCHEMA=os.getenv("SHADOW_SCHEMA", "etl_shadow"),
+    PREVIOUS_SCHEMA=os.getenv("PREVIOUS_SCHEMA", "etl_previous"),
+
+    # `k/N` loads only k-th of N hash partitions of every entity, empty loads all
+    SHARD=os.getenv("SHARD", ""),
+    # statistics of the run are written here as JSON, shards' files are merged by `etl-tool merge-stats`
+    STATS_PATH=os.getenv("STATS_PATH", ""),
+
+    # uncompressed local or range-capable HTTP sources are split into newline aligned byte ranges,
+    # loaded by this many processes with own loop and pool of POSTGRES_MAX_CONNECTION_POOL_SIZE / READ_PROCESSES
+    READ_PROCESSES=int(os.getenv("READ_PROCESSES", 1)),
+
+    # event loop implementation, asyncio or uvloop, and threads of its default executor writing files (0 keeps
+    # stock size), CPU-bound decoding and extraction stay in the loop thread
+    EVENT_LOOP=os.getenv("EVENT_LOOP", "asyncio"),
+    EXECUTOR_WORKERS=int(os.getenv("EXECUTOR_WORKERS", 0)),
+
+    # rows and flushes per second of every entity (0 unlimited), shared by its processes, THROTTLE_SHARE of them
+    # taken by this one; flushes slower than THROTTLE_TARGET_LATENCY (0 disables) multiply limits by THROTTLE_BACKOFF,
+    # limits are changed at runtime by writing JSON to THROTTLE_CONTROL_PATH, e.g. {"rows_per_second": 500}
+    THROTTLE_ROWS_PER_SECOND=float(os.getenv("THROTTLE_ROWS_PER_SECOND", 0)),
+    THROTTLE_FLUSHES_PER_SECOND=float(os.getenv("THROTTLE_FLUSHES_PER_SECOND", 0)),
+    THROTTLE_BURST_SECONDS=float(os.getenv("THROTTLE_BURST_SECONDS", 1)),
+    THROTTLE_TARGET_LATENCY=float(os.getenv("THROTTLE_TARGET_LATENCY", 0)),
+    THROTTLE_BACKOFF=float(os.getenv("THROTTLE_BACKOFF", 0.5)),
+    THROTTLE_CONTROL_PATH=os.getenv("THROTTLE_CONTROL_PATH", ""),
+    THROTTLE_SHARE=float(os.getenv("THROTTLE_SHARE", 1)),
+
+    # bytes of queued source lines plus batch rows of an entity, 0 disables; over the budget the download waits
+    # and the batch is flushed right away (`backpressure`) or new rows are spilled to SPILL_PATH (`spill`)
+    MEMORY_BUDGET_MB=float(os.getenv("MEMORY_BUDGET_MB", 0)),
+    MEMORY_BUDGET_MODE=os.getenv("MEMORY_BUDGET_MODE", "backpressure"),
+    SPILL_PATH=os.getenv("SPILL_PATH", ".cache/spill"),
+
     MAX_QUEUE_SIZE=int(os.getenv("MAX_QUEUE_SIZE", 100)),
     QUEUE_WORKERS_AMOUNT=int(os.getenv("QUEUE_WORKERS_AMOUNT", 2)),
 
-    BATCHER_SLEEP_TIME=int(os.getenv("BATCHER_SLEEP_TIME", 1)),
+    BATCHER_SLEEP_TIME=float(os.getenv("BATCHER_SLEEP_TIME", 1)),
+    # rows flushed at once, adapted at runtime from flush latency within the bounds
+    ADAPTIVE_BATCH_SIZE=bool(int(os.getenv("ADAPTIVE_BATCH_SIZE", 1))),
+    BATCH_SIZE=int(os.getenv("BATCH_SIZE", 1000)),
+    BATCH_SIZE_MIN=int(os.getenv("BATCH_SIZE_MIN", 100)),
+    BATCH_SIZE_MAX=int(os.getenv("BATCH_SIZE_MAX", 20000)),
+    BATCH_SIZE_INCREASE=int(os.getenv("BATCH_SIZE_INCREASE", 500)),
+    BATCH_SIZE_DECREASE=float(os.getenv("BATCH_SIZE_DECREASE", 0.5)),
+    BATCH_TARGET_LATENCY=float(os.getenv("BATCH_TARGET_LATENCY", 0.5)),
+    # flushes share one transaction until it holds COMMIT_ROWS records or is COMMIT_SECONDS old
+    COMMIT_ROWS=int(os.getenv("COMMIT_ROWS", 50000)),
+    COMMIT_SECONDS=float(os.getenv("COMMIT_SECONDS", 5)),
+    # drop resources repeating `id` seen earlier in the run, Bloom filter sized for DEDUPE_CAPACITY ids per entity,
+    # byte ranges of READ_PROCESSES have filters of their own, duplicates across ranges aren't dropped
+    DEDUPE=bool(int(os.getenv("DEDUPE", 0))),
+    DEDUPE_CAPACITY=int(os.getenv("DEDUPE_CAPACITY", 1000000)),
+    DEDUPE_ERROR_RATE=float(os.getenv("DEDUPE_ERROR_RATE", 0.001)),
+    # rows refused by the database are written to `<REJECT_PATH>/<table>.ndjson` with the error, empty disables
+    REJECT_PATH=os.getenv("REJECT_PATH", "rejects"),
+    # rejected source items are counted by reason, only first few of every reason are logged
+    REJECTION_LOG_SAMPLES=int(os.getenv("REJECTION_LOG_SAMPLES", 5)),
+    # rejected source items are written to `<DEAD_LETTER_PATH>/<table>.ndjson` with the reason, empty disables
+    DEAD_LETTER_PATH=os.getenv("DEAD_LETTER_PATH", ""),
+
+    # progress line of the entity being loaded is logged every PROGRESS_INTERVAL seconds (0 disables),
+    # status of all entities is written to PROGRESS_STATUS_PATH as JSON (empty disables)
+    PROGRESS_INTERVAL=float(os.getenv("PROGRESS_INTERVAL", 10)),
+    PROGRESS_STATUS_PATH=os.getenv("PROGRESS_STATUS_PATH", ""),
+
+    # `--profile` samples the event loop thread every PROFILE_INTERVAL seconds, per-entity pstats and
+    # collapsed stacks are written to PROFILE_PATH, PROFILE_TOP functions are shown in final report
+    PROFILE=bool(int(os.getenv("PROFILE", 0))),
+    PROFILE_PATH=os.getenv("PROFILE_PATH", "profile"),
+    PROFILE_INTERVAL=float(os.getenv("PROFILE_INTERVAL", 0.005)),
+    PROFILE_TOP=int(os.getenv("PROFILE_TOP", 15)),
+
+    # spans of entities, workers and batches are written to TRACE_PATH as OTLP/JSON lines (empty disables),
+    # a span of single item only for TRACE_RECORD_SAMPLE_RATE part of them
+    TRACE_PATH=os.getenv("TRACE_PATH", ""),
+    TRACE_RECORD_SAMPLE_RATE=float(os.getenv("TRACE_RECORD_SAMPLE_RATE", 0.001)),
+    TRACE_BATCH_SAMPLE_RATE=float(os.getenv("TRACE_BATCH_SAMPLE_RATE", 1)),
+
+    # peak RSS of every entity is sampled at batch boundaries, MEMORY_TRACE adds `tracemalloc` snapshots,
+    # MEMORY_TOP allocation sites are written to `<MEMORY_REPORT_PATH>/<entity>.json`
+    MEMORY_TRACE=bool(int(os.getenv("MEMORY_TRACE", 0))),
+    MEMORY_TRACE_FRAMES=int(os.getenv("MEMORY_TRACE_FRAMES", 1)),
+    MEMORY_TOP=int(os.getenv("MEMORY_TOP", 10)),
+    MEMORY_REPORT_PATH=os.getenv("MEMORY_REPORT_PATH", "memory"),
+
+    # decode only top-level keys used by batchers instead of whole resources, on by default when `pysimdjson`
+    # is installed, without it whole resources are decoded anyway and filtering them only adds work
+    SELECTIVE_EXTRACTION=bool(int(os.getenv(
+        "SELECTIVE_EXTRACTION", int(importlib.util.find_spec("simdjson") is not None),
+    ))),
+    # record time spent in every field extractor, reported in final report
+    EXTRACTION_TIMING=bool(int(os.getenv("EXTRACTION_TIMING", 0))),
 
     CACHE_TTL=int(os.getenv("CACHE_TTL", 30)),
+
+    # `etl-tool tune` trials run on samples of every entity in a scratch database
+    TUNED_SETTINGS_PATH=os.getenv("TUNED_SETTINGS_PATH", "tuned_settings.json"),
+    TUNE_DATABASE_NAME=os.getenv("TUNE_DATABASE_NAME", "etl_tune"),
+    TUNE_SAMPLE_SIZE=int(os.getenv("TUNE_SAMPLE_SIZE", 2000)),
 )
+
+
+def load_entity_settings(path: str) -> dict:
+    """Per-entity settings written by `etl-tool tune`, they override the ones above for their entity."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+settings['ENTITY_SETTINGS'] = load_entity_settings(str(settings['TUNED_SETTINGS_PATH']))
@@ -0,0 +1,107 @@
+import json
+import zlib
+from typing import Any, List, Optional, Union
+
+from .sinks.statements import merge_statements
+
+
+# statistics computed by the database at the end of a run, complete in the shard finishing last
+DATABASE_STATS = (
+    'patients_genders', 'most_popular_procedures', 'popular_start_encounters_days', 'popular_end_encounters_days',
+)
+
+
+class Shard:
+    """
+    Hash partition `index` (0-based) of `count` loaded by one process.
+
+    Resources are assigned by CRC32 of their patient's id, so resources referencing a patient are
+    loaded by the process that loaded the patient and references resolve within the shard.
+    """
+
+    def __init__(self, index: int, count: int) -> None:
+        if not 0 <= index < count:
+            raise ValueError(f"shard {index + 1} out of range 1..{count}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def from_spec(cls, spec: str) -> Optional['Shard']:
+        """Parses `k/N` with 1-based `k`, empty spec loads everything."""
+        if not spec:
+            return None
+        try:
+            k, n = (int(part) for part in spec.split("/"))
+        except ValueError:
+            raise ValueError(f"invalid shard {spec!r}, expected k/N, e.g. 1/4")
+        return cls(k - 1, n)
+
+    def owns(self, key: Optional[str]) -> bool:
+        # resources without the key all go to the first shard
+        if key is None:
+            return self.index == 0
+        return zlib.crc32(key.encode()) % self.count == self.index
+
+    def owns_item(self, item: Union[str, bytes]) -> bool:
+        """Items rejected before their key is known are spread by CRC32 of the whole item."""
+        data = item.encode() if isinstance(item, str) else item
+        return zlib.crc32(data) % self.count == self.index
+
+    def __str__(self) -> str:
+        return f"{self.index + 1}/{self.count}"
+
+
+def merge_values(values: List[Any]) -> Any:
+    """Sums numbers, merges dicts key by key and concatenates lists, other values are taken from the first one."""
+    present = [value for value in values if value is not None]
+    if not present:
+        return None
+    first = present[0]
+    if isinstance(first, bool):
+        return any(present)
+    if isinstance(first, (int, float)):
+        return sum(present)
+    if isinstance(first, dict):
+        keys = dict.fromkeys(key for value in present for key in value)
+        return {key: merge_values([value.get(key) for value in present]) for key in keys}
+    if isinstance(first, list):
+        return [item for value in present for item in value]
+    return first
+
+
+def merge_stats(shards: List[dict]) -> dict:
+    """Statistics of all shards of a run as if it was loaded by one process."""
+    latest = max(shards, key=lambda stats: stats.get('finished_at', 0))
+    merged: dict = {}
+    for key in dict.fromkeys(key for stats in shards for key in stats):
+        values = [stats.get(key) for stats in shards]
+        if key in DATABASE_STATS:
+            merged[key] = latest.get(key)
+        elif key == 'statements':
+            merged[key] = merge_statements([value for value in values if value])
+        elif key in ('shard', 'finished_at'):
+            continue
+        else:
+            merged[key] = merge_values(values)
+            # shards load an entity in parallel
+            if isinstance(merged[key], dict) and 'seconds' in merged[key]:
+                merged[key]['seconds'] = max(value.get('seconds', 0) for value in values if value)
+            # every shard reads all items, those none of the merged shards owns are left
+            if isinstance(merged[key], dict) and 'read_items' in merged[key]:
+                merged[key]['read_items'] = max(value.get('read_items', 0) for value in values if value)
+                merged[key]['skipped_items'] = merged[key]['read_items'] - merged[key].get('processed_items', 0)
+    merged['shards'] = [stats.get('shard') for stats in shards]
+    return merged
+
+
+def write_stats(path: str, stats: dict) -> None:
+    with open(path, "w") as file:
+        json.dump(stats, file, indent=4, default=str)
+
+
+def read_stats(paths: List[str]) -> List[dict]:
+    shards = []
+    for path in paths:
+        with open(path) as file:
+            shards.append(json.load(file))
+    return shards
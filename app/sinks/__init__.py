@@ -0,0 +1,14 @@
+from .base import Sink, Transaction
+from .files import EXPORT_FORMATS, FileSink
+from .memory import MemorySink
+from .postgres import DB_PROFILES, DatabaseProfile, PostgresSink
+from .statements import StatementStats, format_statements, timed_connection
+
+
+SINKS = ("postgres", "memory", "files")
+
+
+__all__ = [
+    "DB_PROFILES", "DatabaseProfile", "EXPORT_FORMATS", "FileSink", "MemorySink", "PostgresSink",
+    "SINKS", "Sink", "StatementStats", "Transaction", "format_statements", "timed_connection",
+]
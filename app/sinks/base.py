@@ -0,0 +1,69 @@
+from typing import List, Optional
+
+import sqlalchemy as sa
+from asyncpg.pool import Pool
+
+
+class Transaction:
+    """
+    Inserts committed together, rows become visible to other readers only on `commit`.
+
+    Default transaction has nothing to group, every insert is stored by the sink immediately.
+    """
+
+    def __init__(self, sink: 'Sink') -> None:
+        self._sink = sink
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        """Stores rows, a failed insert leaves rows inserted before in this transaction untouched."""
+        return await self._sink.insert(table, rows)
+
+    async def commit(self) -> None:
+        pass
+
+    async def rollback(self) -> None:
+        pass
+
+
+class Sink:
+    """
+    Storage batchers write rows into.
+
+    Besides inserting rows every sink resolves `source_id` of already stored resources into row ids,
+    that's how references between entities are turned into foreign keys.
+    """
+
+    name: str
+    # sinks backed by PostgreSQL expose their pool, it's used for post-run statistics
+    pool: Optional[Pool] = None
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        """Stores rows, returns number of inserted records."""
+        raise NotImplementedError
+
+    def max_batch_rows(self, table: sa.Table) -> Optional[int]:
+        """Largest number of rows single insert can hold, None when unlimited."""
+        return None
+
+    def rejects_rows(self, error: Exception) -> bool:
+        """Whether failed insert was caused by the rows themselves, e.g. constraint violation, not by the sink."""
+        return False
+
+    async def begin(self) -> Transaction:
+        """Starts transaction grouping several inserts."""
+        return Transaction(self)
+
+    async def get_id(self, table: sa.Table, source_id: str) -> Optional[int]:
+        """Returns id of stored row with given `source_id`, None when there is no such row."""
+        raise NotImplementedError
+
+    async def get_id_after(self, table: sa.Table, source_id: str, after: int) -> Optional[int]:
+        """Returns id greater than `after` of stored row with given `source_id`, None when there is no such row."""
+        raise NotImplementedError
+
+    async def last_id(self, table: sa.Table) -> int:
+        """Returns largest id of stored rows, 0 when there are none."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
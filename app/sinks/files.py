@@ -0,0 +1,217 @@
+import asyncio
+import csv
+import datetime
+import decimal
+import gzip
+import logging
+import os
+from collections import defaultdict
+from typing import IO, Any, DefaultDict, Dict, List, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from .memory import MemorySink
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None  # type: ignore
+
+
+logger = logging.getLogger(__name__)
+
+
+EXPORT_FORMATS = ("parquet", "csv")
+
+
+def _arrow_type(column: sa.Column) -> Any:
+    if isinstance(column.type, postgresql.INTEGER):
+        return pa.int64()
+    if isinstance(column.type, postgresql.TIMESTAMP):
+        return pa.timestamp('us', tz='UTC') if column.type.timezone else pa.timestamp('us')
+    if isinstance(column.type, postgresql.DATE):
+        return pa.date32()
+    if isinstance(column.type, postgresql.NUMERIC):
+        return pa.float64()
+    return pa.string()
+
+
+class InvalidRow(ValueError):
+    """Row the database would refuse, a NULL in NOT NULL column or a value not fitting its column type."""
+
+
+def _python_types(column: sa.Column) -> Tuple[type, ...]:
+    if isinstance(column.type, postgresql.INTEGER):
+        return (int,)
+    if isinstance(column.type, postgresql.TIMESTAMP):
+        return (datetime.datetime,)
+    if isinstance(column.type, postgresql.DATE):
+        return (datetime.date,)
+    if isinstance(column.type, postgresql.NUMERIC):
+        return (int, float, decimal.Decimal)
+    return (str,)
+
+
+def validate(table: sa.Table, rows: List[dict]) -> None:
+    """Checks rows against column types and nullability of `table`, raises `InvalidRow` like an insert would."""
+    for column in table.columns:
+        types = _python_types(column)
+        # ids are assigned by the sink
+        nullable = column.nullable or column.primary_key
+        for row in rows:
+            if (value := row.get(column.name)) is None:
+                if not nullable:
+                    raise InvalidRow(f"null value in column {column.name} of {table.name}")
+            elif isinstance(value, bool) or not isinstance(value, types):
+                raise InvalidRow(f"invalid value {value!r} for column {column.name} of {table.name}")
+
+
+def _as_date(value: Any) -> Any:
+    # DATE columns are filled with datetimes, database truncates them the same way
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+class FileSink(MemorySink):
+    """
+    Writes rows of every table into compressed files in `path`, ids are assigned like by `MemorySink`.
+
+    Rows are buffered and written in row groups of `row_group_size` rows, as Parquet when `pyarrow`
+    is installed, as gzipped CSV otherwise.
+    """
+
+    name = "files"
+
+    def __init__(self, path: str, export_format: str, row_group_size: int) -> None:
+        super().__init__()
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"unknown export format: {export_format}")
+        if export_format == "parquet" and pa is None:
+            logger.warning("pyarrow is not installed, exporting CSV files")
+            export_format = "csv"
+
+        self.path = path
+        self.export_format = export_format
+        self.row_group_size = row_group_size
+
+        # rows of CSV files, Parquet ones are buffered converted
+        self._buffers: DefaultDict[str, List[dict]] = defaultdict(list)
+        self._arrow_buffers: Dict[str, Any] = {}
+        self._schemas: Dict[str, Any] = {}
+        self._writers: Dict[str, Any] = {}
+        self._files: Dict[str, IO] = {}
+        self._tables: Dict[str, sa.Table] = {}
+        self._locks: DefaultDict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, table: sa.Table) -> str:
+        extension = "parquet" if self.export_format == "parquet" else "csv.gz"
+        return os.path.join(self.path, f"{table.name}.{extension}")
+
+    def _schema(self, table: sa.Table) -> Any:
+        if (schema := self._schemas.get(table.name)) is None:
+            schema = self._schemas[table.name] = pa.schema(
+                [
+                    pa.field(column.name, _arrow_type(column), nullable=column.nullable)
+                    for column in table.columns
+                ]
+            )
+        return schema
+
+    def _to_arrow(self, table: sa.Table, rows: List[dict]) -> Any:
+        """Rows converted to the table schema, raises `pa.ArrowInvalid` on values not fitting their column."""
+        dates = [column.name for column in table.columns if isinstance(column.type, postgresql.DATE)]
+        columns = {
+            column.name: [
+                _as_date(row.get(column.name)) if column.name in dates else row.get(column.name) for row in rows
+            ]
+            for column in table.columns
+        }
+        return pa.Table.from_pydict(columns, schema=self._schema(table))
+
+    def _write_parquet(self, table: sa.Table, rows: Any) -> None:
+        if (writer := self._writers.get(table.name)) is None:
+            writer = self._writers[table.name] = pq.ParquetWriter(
+                self.file_path(table), self._schema(table), compression='zstd',
+            )
+        writer.write_table(rows)
+
+    def _write_csv(self, table: sa.Table, rows: List[dict]) -> None:
+        if (writer := self._writers.get(table.name)) is None:
+            file = self._files[table.name] = gzip.open(self.file_path(table), 'wt', newline='')
+            writer = self._writers[table.name] = csv.DictWriter(file, fieldnames=[c.name for c in table.columns])
+            writer.writeheader()
+
+        dates = [column.name for column in table.columns if isinstance(column.type, postgresql.DATE)]
+        for row in rows:
+            writer.writerow({key: _as_date(value) if key in dates else value for key, value in row.items()})
+
+    def _write(self, table: sa.Table, rows: Any) -> None:
+        if self.export_format == "parquet":
+            self._write_parquet(table, rows)
+        else:
+            self._write_csv(table, rows)
+
+    def _buffered(self, table: sa.Table) -> int:
+        if self.export_format == "parquet":
+            return len(self._arrow_buffers[table.name]) if table.name in self._arrow_buffers else 0
+        return len(self._buffers[table.name])
+
+    def _row_group(self, table: sa.Table) -> Any:
+        if self.export_format == "parquet":
+            return self._arrow_buffers[table.name].slice(0, self.row_group_size)
+        return self._buffers[table.name][:self.row_group_size]
+
+    def _drop_row_group(self, table: sa.Table) -> None:
+        if self.export_format == "parquet":
+            self._arrow_buffers[table.name] = self._arrow_buffers[table.name].slice(self.row_group_size)
+        else:
+            del self._buffers[table.name][:self.row_group_size]
+
+    async def _write_row_groups(self, table: sa.Table, partial: bool = False) -> None:
+        """Writes buffered rows, the last incomplete row group only when `partial` is set."""
+        async with self._locks[table.name]:
+            while (buffered := self._buffered(table)) >= self.row_group_size or (partial and buffered):
+                # compression and file writes don't block the event loop
+                await asyncio.get_event_loop().run_in_executor(None, self._write, table, self._row_group(table))
+                # rows stay buffered until they're written
+                self._drop_row_group(table)
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        self._tables[table.name] = table
+        # rows the database would refuse fail the insert before ids are assigned, the batcher isolates them
+        validate(table, rows)
+        if self.export_format == "parquet":
+            converted = self._to_arrow(table, rows)
+            ids = pa.array([row['id'] for row in self._assign_ids(table, rows)], pa.int64())
+            index = converted.schema.get_field_index('id')
+            converted = converted.set_column(index, converted.schema.field(index), ids)
+            if (buffered := self._arrow_buffers.get(table.name)) is not None:
+                converted = pa.concat_tables([buffered, converted])
+            self._arrow_buffers[table.name] = converted
+        else:
+            self._buffers[table.name].extend(self._assign_ids(table, rows))
+
+        if self._buffered(table) >= self.row_group_size:
+            await self._write_row_groups(table)
+
+        return len(rows)
+
+    def rejects_rows(self, error: Exception) -> bool:
+        if isinstance(error, InvalidRow):
+            return True
+        return pa is not None and isinstance(error, (pa.ArrowInvalid, pa.ArrowTypeError))
+
+    async def close(self) -> None:
+        for table in self._tables.values():
+            await self._write_row_groups(table, partial=True)
+
+        for writer in self._writers.values():
+            if self.export_format == "parquet":
+                writer.close()
+        for file in self._files.values():
+            file.close()
+
+        logger.info("Exported files written to %s", self.path)
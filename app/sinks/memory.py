@@ -0,0 +1,54 @@
+from collections import defaultdict
+from typing import DefaultDict, Dict, List, Optional
+
+import sqlalchemy as sa
+
+from .base import Sink
+
+
+class MemorySink(Sink):
+    """
+    Keeps rows in process memory, ids are assigned like by `SERIAL` columns.
+
+    Lets the whole parse and transform pipeline run, be tested and profiled without PostgreSQL server.
+    """
+
+    name = "memory"
+
+    def __init__(self) -> None:
+        self.tables: DefaultDict[str, List[dict]] = defaultdict(list)
+        self._ids: DefaultDict[str, Dict[str, int]] = defaultdict(dict)
+        self._latest_ids: DefaultDict[str, Dict[str, int]] = defaultdict(dict)
+        self._last_id: DefaultDict[str, int] = defaultdict(int)
+
+    def _assign_ids(self, table: sa.Table, rows: List[dict]) -> List[dict]:
+        """Returns copies of rows with ids, registering them for `get_id` lookups."""
+        ids, latest_ids = self._ids[table.name], self._latest_ids[table.name]
+        result = []
+
+        for row in rows:
+            if (id_ := row.get('id')) is None:
+                id_ = self._last_id[table.name] + 1
+            self._last_id[table.name] = max(self._last_id[table.name], id_)
+
+            result.append({**row, 'id': id_})
+            # like `fetchval` lookup, first stored row wins when source_id is repeated
+            ids.setdefault(row['source_id'], id_)
+            latest_ids[row['source_id']] = max(latest_ids.get(row['source_id'], 0), id_)
+
+        return result
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        self.tables[table.name].extend(self._assign_ids(table, rows))
+        return len(rows)
+
+    async def get_id(self, table: sa.Table, source_id: str) -> Optional[int]:
+        return self._ids[table.name].get(source_id)
+
+    async def get_id_after(self, table: sa.Table, source_id: str, after: int) -> Optional[int]:
+        if (id_ := self._latest_ids[table.name].get(source_id)) is not None and id_ > after:
+            return id_
+        return None
+
+    async def last_id(self, table: sa.Table) -> int:
+        return self._last_id[table.name]
@@ -0,0 +1,157 @@
+from typing import Any, Dict, List, Optional
+
+import asyncpg
+import sqlalchemy as sa
+from asyncpg.pool import Pool
+
+from app.tables import db
+
+from .base import Sink, Transaction
+
+
+DB_PROFILES = ("safe", "bulk")
+# PostgreSQL protocol limit of bind parameters in a single query
+MAX_QUERY_ARGUMENTS = 32767
+
+
+class DatabaseProfile:
+    """
+    Per-connection setup of the pool.
+
+    `safe` keeps server defaults. `bulk` turns `synchronous_commit` off (a crash may lose the last
+    commits, never corrupts data), raises `work_mem` and statement cache size, and opens the whole
+    pool upfront. With `set_local` its parameters are set by `SET LOCAL` in every flush transaction
+    instead of once per session, e.g. behind a transaction pooler.
+    """
+
+    def __init__(
+        self, name: str, parameters: Optional[Dict[str, str]] = None,
+        statement_cache_size: Optional[int] = None, warm: bool = False, set_local: bool = False,
+    ) -> None:
+        self.name = name
+        self.parameters = parameters or {}
+        self.statement_cache_size = statement_cache_size
+        self.warm = warm
+        self.set_local = set_local
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> 'DatabaseProfile':
+        name = settings['DB_PROFILE']
+        if name == "safe":
+            return cls(name)
+        if name == "bulk":
+            return cls(
+                name,
+                parameters={'synchronous_commit': 'off', 'work_mem': settings['BULK_WORK_MEM']},
+                statement_cache_size=settings['BULK_STATEMENT_CACHE_SIZE'],
+                warm=True,
+                set_local=settings['BULK_SET_LOCAL'],
+            )
+        raise ValueError(f"unknown database profile {name!r}, expected one of {DB_PROFILES}")
+
+    def pool_options(self, min_size: int, max_size: int) -> dict:
+        """Keyword arguments for `create_pool`."""
+        options: dict = {'min_size': max_size if self.warm else min_size, 'max_size': max_size}
+        if self.statement_cache_size is not None:
+            options['statement_cache_size'] = self.statement_cache_size
+        if self.parameters and not self.set_local:
+            options['init'] = self.init
+        return options
+
+    async def _set(self, conn: asyncpg.Connection, is_local: bool) -> None:
+        for name, value in self.parameters.items():
+            await conn.execute("SELECT set_config($1, $2, $3)", name, value, is_local)
+
+    async def init(self, conn: asyncpg.Connection) -> None:
+        await self._set(conn, is_local=False)
+
+    async def begin(self, conn: asyncpg.Connection) -> None:
+        """Applies parameters to the current transaction only."""
+        await self._set(conn, is_local=True)
+
+
+async def _insert(conn: asyncpg.Connection, table: sa.Table, rows: List[dict]) -> int:
+    query = (
+        table.insert()
+        .values(rows)
+    )
+    res = await conn.execute(query)
+    return int(res.split()[2])
+
+
+class PostgresTransaction(Transaction):
+    """Holds pool connection until commit, every insert runs in its own savepoint."""
+
+    def __init__(self, sink: 'PostgresSink', conn: asyncpg.Connection, transaction: Any) -> None:
+        super().__init__(sink)
+        self._pool = sink.pool
+        self._conn = conn
+        self._transaction = transaction
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        async with self._conn.transaction():
+            return await _insert(self._conn, table, rows)
+
+    async def commit(self) -> None:
+        try:
+            await self._transaction.commit()
+        finally:
+            await self._pool.release(self._conn)
+
+    async def rollback(self) -> None:
+        try:
+            await self._transaction.rollback()
+        finally:
+            await self._pool.release(self._conn)
+
+
+class PostgresSink(Sink):
+
+    name = "postgres"
+    pool: Pool
+
+    def __init__(self, pool: Pool, profile: Optional[DatabaseProfile] = None) -> None:
+        self.pool = pool
+        self.profile = profile or DatabaseProfile("safe")
+
+    async def insert(self, table: sa.Table, rows: List[dict]) -> int:
+        async with self.pool.acquire() as conn:
+            if self.profile.set_local and self.profile.parameters:
+                async with conn.transaction():
+                    await self.profile.begin(conn)
+                    return await _insert(conn, table, rows)
+            return await _insert(conn, table, rows)
+
+    def max_batch_rows(self, table: sa.Table) -> Optional[int]:
+        # every value of multi-row insert is a query argument
+        return MAX_QUERY_ARGUMENTS // len(table.columns)
+
+    def rejects_rows(self, error: Exception) -> bool:
+        return isinstance(error, (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError))
+
+    async def begin(self) -> Transaction:
+        conn = await self.pool.acquire()
+        try:
+            transaction = conn.transaction()
+            await transaction.start()
+            if self.profile.set_local:
+                await self.profile.begin(conn)
+        except BaseException:
+            await self.pool.release(conn)
+            raise
+        return PostgresTransaction(self, conn, transaction)
+
+    async def get_id(self, table: sa.Table, source_id: str) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            return await db.get_id(conn, table, source_id)
+
+    async def get_id_after(self, table: sa.Table, source_id: str, after: int) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            return await db.get_id_after(conn, table, source_id, after)
+
+    async def last_id(self, table: sa.Table) -> int:
+        async with self.pool.acquire() as conn:
+            return await db.last_id(conn, table)
+
+    async def close(self) -> None:
+        await self.pool.close()
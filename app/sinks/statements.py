@@ -0,0 +1,229 @@
+import bisect
+import functools
+import logging
+import re
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
+
+import asyncpg
+from asyncpgsa.connection import SAConnection, compile_query
+
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of latency buckets in seconds, the last one catches the rest
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, float("inf"))
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# rows of multi-row inserts and numbered savepoints don't make a new shape
+_VALUES = re.compile(r"\(\$\d+(?:,\s*\$\d+)*\)(?:\s*,\s*\(\$\d+(?:,\s*\$\d+)*\))*")
+_PARAMETERS = re.compile(r"\$\d+")
+_NUMBERED = re.compile(r"_\d+\b")
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_shape(query: str) -> str:
+    """Statement text with parameters and row lists collapsed, statements of one shape share a plan."""
+    shape = _VALUES.sub("(...)", query)
+    shape = _PARAMETERS.sub("$?", shape)
+    shape = _NUMBERED.sub("_N", shape)
+    return " ".join(shape.split())
+
+
+def _affected_rows(status: Union[str, bytes]) -> int:
+    # command tags end with the row count, e.g. `INSERT 0 1000`, `SELECT 4`
+    if isinstance(status, bytes):
+        status = status.decode()
+    last = status.rsplit(" ", 1)[-1]
+    return int(last) if last.isdigit() else 0
+
+
+class LatencyHistogram:
+    """Latencies counted in fixed buckets, quantiles are estimated by bucket upper bounds."""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    @classmethod
+    def from_stats(cls, stats: dict) -> 'LatencyHistogram':
+        histogram = cls()
+        for bound, count in stats["buckets"].items():
+            histogram.counts[histogram.buckets.index(float(bound))] += count
+        histogram.count = stats["count"]
+        histogram.total = stats["total"]
+        histogram.max = stats["max"]
+        return histogram
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def get_stats(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {
+                str(bound): count for bound, count in zip(self.buckets, self.counts) if count
+            },
+        }
+
+
+class StatementStats:
+    """
+    Latency histogram, count and affected rows of every statement shape run on the pool.
+
+    Statements slower than `slow_threshold` seconds are logged, the first slow one of every
+    shape with its `EXPLAIN` plan.
+    """
+
+    def __init__(self, slow_threshold: float = 1.0) -> None:
+        self.slow_threshold = slow_threshold
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.rows: Dict[str, int] = {}
+        self.slow: Dict[str, int] = {}
+        self.plans: Dict[str, Optional[str]] = {}
+        self._explaining: Set[str] = set()
+
+    def record(self, query: str, seconds: float, rows: int) -> Optional[str]:
+        """Records statement run, returns its shape when it's slow and its plan isn't known yet."""
+        shape = statement_shape(query)
+        if (histogram := self.histograms.get(shape)) is None:
+            histogram = self.histograms[shape] = LatencyHistogram()
+            self.rows[shape] = 0
+        histogram.observe(seconds)
+        self.rows[shape] += rows
+
+        if not self.slow_threshold or seconds < self.slow_threshold:
+            return None
+        self.slow[shape] = self.slow.get(shape, 0) + 1
+        logger.warning("Slow statement, %.3f s, %s rows: %.500s", seconds, rows, shape)
+
+        if shape in self.plans or shape in self._explaining or not shape.upper().startswith(EXPLAINABLE):
+            return None
+        self._explaining.add(shape)
+        return shape
+
+    def explained(self, shape: str, plan: Optional[str]) -> None:
+        self._explaining.discard(shape)
+        self.plans[shape] = plan
+        if plan is not None:
+            logger.warning("Plan of slow statement %.500s:\n%s", shape, plan)
+
+    def get_stats(self) -> dict:
+        stats: Dict[str, Dict[str, Any]] = {}
+        for shape, histogram in self.histograms.items():
+            stats[shape] = {**histogram.get_stats(), "rows": self.rows[shape]}
+            if shape in self.slow:
+                stats[shape]["slow"] = self.slow[shape]
+                stats[shape]["plan"] = self.plans.get(shape)
+        return stats
+
+
+def merge_statements(shards: List[dict]) -> dict:
+    """Statement stats of several processes, histograms are merged and quantiles computed again."""
+    merged: Dict[str, dict] = {}
+    histograms: Dict[str, LatencyHistogram] = {}
+    for stats in shards:
+        for shape, entry in stats.items():
+            histogram = LatencyHistogram.from_stats(entry)
+            if shape not in merged:
+                histograms[shape] = histogram
+                merged[shape] = {"rows": 0}
+            else:
+                histograms[shape].merge(histogram)
+            merged[shape]["rows"] += entry["rows"]
+            if "slow" in entry:
+                merged[shape]["slow"] = merged[shape].get("slow", 0) + entry["slow"]
+                merged[shape]["plan"] = merged[shape].get("plan") or entry.get("plan")
+
+    return {shape: {**histograms[shape].get_stats(), **entry} for shape, entry in merged.items()}
+
+
+class TimedConnection(SAConnection):
+    """Connection recording every statement in `statements` of its class."""
+
+    statements: StatementStats
+
+    async def _execute(self, query: Any, args: Any, *options: Any, **kwargs: Any) -> Any:
+        # compiled once here, `SAConnection` passes the text through
+        query, compiled_args = compile_query(query, dialect=self._dialect)
+        args = compiled_args or args
+
+        started_at = time.perf_counter()
+        result = await super()._execute(query, args, *options, **kwargs)
+        seconds = time.perf_counter() - started_at
+
+        # `execute` with arguments asks for `(records, status, completed)`
+        rows = _affected_rows(result[1]) if isinstance(result, tuple) else len(result)
+        if (shape := self.statements.record(query, seconds, rows)) is not None:
+            await self._explain(shape, query, args)
+        return result
+
+    async def execute(self, script: Any, *args: Any, **kwargs: Any) -> str:
+        script, compiled_args = compile_query(script, dialect=self._dialect)
+        if compiled_args or args:
+            # timed by `_execute`
+            return await super().execute(script, *(compiled_args or args), **kwargs)
+
+        started_at = time.perf_counter()
+        status = await super().execute(script, **kwargs)
+        self.statements.record(script, time.perf_counter() - started_at, _affected_rows(status))
+        return status
+
+    async def _explain(self, shape: str, query: str, args: Any) -> None:
+        plan: Optional[str] = None
+        try:
+            # own savepoint, failed `EXPLAIN` mustn't abort the transaction of the statement
+            if self.is_in_transaction():
+                async with self.transaction():
+                    records = await super()._execute(f"EXPLAIN {query}", args, 0, None)
+            else:
+                records = await super()._execute(f"EXPLAIN {query}", args, 0, None)
+            plan = "\n".join(record[0] for record in records)
+        except asyncpg.PostgresError as error:
+            logger.debug("Slow statement couldn't be explained: %s", error)
+        self.statements.explained(shape, plan)
+
+
+def timed_connection(statements: StatementStats) -> Type[TimedConnection]:
+    """Connection class for `create_pool` recording statements in `statements`."""
+    return type("TimedConnection", (TimedConnection,), {"statements": statements})
+
+
+def format_statements(stats: dict, limit: int = 10) -> List[str]:
+    """Report lines of `limit` statement shapes taking most time."""
+    lines = []
+    ordered = sorted(stats.items(), key=lambda item: item[1]["total"], reverse=True)
+    for shape, entry in ordered[:limit]:
+        lines.append(
+            f"{entry['count']:8} {entry['rows']:9} {entry['mean'] * 1000:9.2f} {entry['p95'] * 1000:9.2f} "
+            f"{entry['max'] * 1000:9.2f} {entry.get('slow', 0):5}  {shape:.100}"
+        )
+    return lines
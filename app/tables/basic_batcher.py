@@ -1,11 +1,26 @@
 import asyncio
-import copy
+import json
 import logging
-from typing import List
+import os
+import time
+from typing import Any, Dict, List, Optional, Union
 
 import sqlalchemy as sa
-from asyncpg.connection import Connection
-from asyncpg.pool import Pool
+from aiocache import cached
+
+from app.memory import MemoryBudget, MemoryTracker, rows_size
+from app.rejects import DeadLetterFile, RejectFile
+from app.row_cache import RowCacheWriter, RowSpill
+from app.settings import settings
+from app.sharding import Shard, merge_values
+from app.sinks import Sink, Transaction
+from app.tracing import NULL_TRACER, Tracer
+
+from . import db, extract
+from .batch_size import BatchSizer
+from .dedupe import Deduplicator
+from .mapping import Mapping, Rejected, Timings
+from .throttle import Throttle
 
 
 logger = logging.getLogger(__name__)
@@ -13,45 +28,420 @@ logger = logging.getLogger(__name__)
 
 class Batcher:
 
-    def __init__(self, pool: Pool, settings: dict, table: sa.Table) -> None:
+    mapping: Mapping
+    # column of mapped rows deciding the shard, resources of a patient share it
+    shard_key = 'patient_id'
+
+    def __init__(self, sink: Sink, settings: dict, table: sa.Table) -> None:
         self._valid_batch: List[dict] = []
-        self._pool = pool
+        self._sink = sink
         self.settings = settings
         self.table = table
 
+        # items read from the source, those of this shard are processed and the rest skipped
+        self.read_items = 0
         self.processed_items = 0
+        # items left to other shards
+        self.skipped_items = 0
+        # records of committed transactions only
         self.inserted_records = 0
+        self.failed_records = 0
+
+        # several flushes share one transaction, bounded by COMMIT_ROWS and COMMIT_SECONDS
+        self._transaction: Optional[Transaction] = None
+        self._transaction_started_at = 0.0
+        self._uncommitted_records = 0
+        self._flush_lock = asyncio.Lock()
+
+        # rows refused by the sink are isolated by bisecting failed flushes
+        self.reject_file: Optional[RejectFile] = None
+        if settings['REJECT_PATH']:
+            self.reject_file = RejectFile(os.path.join(settings['REJECT_PATH'], f"{table.name}.ndjson"))
+        self._rows_rejected = False
+
+        # rejected items by reason, first REJECTION_LOG_SAMPLES of every reason are logged
+        self.rejections: Dict[str, int] = {}
+        self.dead_letter: Optional[DeadLetterFile] = None
+        if settings['DEAD_LETTER_PATH']:
+            self.dead_letter = DeadLetterFile(os.path.join(settings['DEAD_LETTER_PATH'], f"{table.name}.ndjson"))
+
+        # with `--shard k/N` only resources of this hash partition are loaded
+        self.shard = Shard.from_spec(settings['SHARD'])
+
+        # repeated resources are dropped before they reach the batch
+        self.deduplicator: Optional[Deduplicator] = None
+        if settings['DEDUPE']:
+            self.deduplicator = Deduplicator(settings['DEDUPE_CAPACITY'], settings['DEDUPE_ERROR_RATE'])
+        self._uncommitted_ids: List[str] = []
+        # rows stored by earlier runs have ids up to this one, they aren't duplicates
+        self._last_id_before_run: Optional[int] = None
+
+        self.batch_sizer = BatchSizer.from_settings(table.name, settings, sink.max_batch_rows(table))
+        # rows and flushes per second limited to spare a shared database
+        self.throttle = Throttle.from_settings(settings)
+
+        # source bytes read, before and after decompression
+        self.transfer: dict = {}
+        # stats of worker processes loading byte ranges of the source for this batcher
+        self.worker_stats: List[dict] = []
+
+        # queued lines and batch rows are bounded, rows over the budget are flushed right away or spilled
+        self.budget = MemoryBudget.from_settings(settings)
+        self.spill: Optional[RowSpill] = None
+        if self.budget is not None and self.budget.spill:
+            self.spill = RowSpill(os.path.join(settings['SPILL_PATH'], f"{table.name}-{os.getpid()}.msgpack"))
+        self._batch_bytes = 0
+
+        # memory is sampled at batch boundaries
+        self.memory: Optional[MemoryTracker] = None
+        # spans of every batch and of sampled items
+        self.tracer: Tracer = NULL_TRACER
+
+        # mapped rows are written here before references are resolved
+        self.cache_writer: Optional[RowCacheWriter] = None
+
+        self.timings: Optional[Timings] = {} if settings['EXTRACTION_TIMING'] else None
+        self._extract = self.mapping.compile(self.timings)
+        self._references = self.mapping.references
 
     async def work(self) -> None:
         while True:
             await self.proccess_batch()
-            await asyncio.sleep(self.settings['BATCHER_SLEEP_TIME'])
+            if self._backlog():
+                await asyncio.sleep(0)
+                continue
+            # buffered rows are flushed as soon as the download starts waiting for the memory budget,
+            # lines already waiting are released by queue workers flushing or spilling their rows
+            if self.budget is not None:
+                await self.budget.wait_pressure(self.settings['BATCHER_SLEEP_TIME'])
+            else:
+                await asyncio.sleep(self.settings['BATCHER_SLEEP_TIME'])
+
+    def _backlog(self) -> bool:
+        """Full batch, spilled rows or the download are waiting for a flush."""
+        return (
+            len(self._valid_batch) >= self.batch_sizer.size
+            or (self.spill is not None and self.spill.pending > 0)
+            or (bool(self._valid_batch) and self._over_budget())
+        )
 
     async def proccess_batch(self) -> None:
-        if self._valid_batch:
-            valid_patients_list = copy.deepcopy(self._valid_batch)
-            del self._valid_batch[:]
-
-            query = (
-                self.table.insert()
-                .values(valid_patients_list)
-            )
-            async with self._pool.acquire() as conn:
-                res = await conn.execute(query)
-
-            res_split = res.split()
-            real_insert_count = res_split[2]
-            self.inserted_records += int(real_insert_count)
-            logger.debug(
-                "%s records in this batch, total: %s",
-                real_insert_count, self.inserted_records,
-            )
-
-    async def process(self, conn: Connection, item: str) -> None:
+        async with self._flush_lock:
+            # spilled rows are newer than the batch, rows are added after them until the spill is drained
+            if self.spill is not None and self.spill.pending and len(self._valid_batch) < self.batch_sizer.size:
+                self._buffer_rows(self.spill.read(self.batch_sizer.size - len(self._valid_batch)))
+
+            if self._valid_batch:
+                if self.memory is not None:
+                    self.memory.sample(len(self._valid_batch))
+                size = self.batch_sizer.size
+                valid_patients_list = self._valid_batch[:size]
+                self._release_rows(len(valid_patients_list))
+                del self._valid_batch[:size]
+                if self.throttle is not None:
+                    await self.throttle.acquire(len(valid_patients_list))
+                started_at = time.monotonic()
+                with self.tracer.batch("flush", table=self.table.name, rows=len(valid_patients_list)) as span:
+                    await self._flush(valid_patients_list)
+                    if self.throttle is not None:
+                        self.throttle.observe(time.monotonic() - started_at)
+                    span.set(failed_records=self.failed_records, uncommitted_records=self._uncommitted_records)
+
+            if self._transaction is not None and self._commit_due():
+                with self.tracer.batch("commit", table=self.table.name, rows=self._uncommitted_records):
+                    await self._commit()
+
+    async def finish(self) -> None:
+        """Flushes remaining rows and commits open transaction."""
+        while self._valid_batch or (self.spill is not None and self.spill.pending):
+            await self.proccess_batch()
+        async with self._flush_lock:
+            await self._commit()
+        if self.spill is not None:
+            self.spill.close()
+        if self.reject_file is not None:
+            self.reject_file.close()
+        if self.dead_letter is not None:
+            await self.dead_letter.close()
+
+    async def abort(self) -> None:
+        """Rolls back open transaction of a failed load, its records count as failed."""
+        if (transaction := self._transaction) is not None:
+            self._transaction = None
+            records, self._uncommitted_records = self._uncommitted_records, 0
+            if self.deduplicator is not None:
+                self.deduplicator.committed(self._uncommitted_ids)
+            self._uncommitted_ids = []
+            self.failed_records += records
+            try:
+                await transaction.rollback()
+            except Exception as error:
+                logger.error("Rollback of %s records of %s failed: %s", records, self.table.name, error)
+            logger.error("%s records of %s rolled back, load aborted", records, self.table.name)
+        if self.reject_file is not None:
+            self.reject_file.close()
+        if self.dead_letter is not None:
+            await self.dead_letter.close()
+        if self.spill is not None:
+            self.spill.close()
+
+    @property
+    def flushes_in_flight(self) -> int:
+        # flushes of a batcher are serialised
+        return int(self._flush_lock.locked())
+
+    def _commit_due(self) -> bool:
+        return (
+            self._uncommitted_records >= self.settings['COMMIT_ROWS']
+            or time.monotonic() - self._transaction_started_at >= self.settings['COMMIT_SECONDS']
+        )
+
+    async def _flush(self, rows: List[dict]) -> None:
+        if self._transaction is None:
+            self._transaction = await self._sink.begin()
+            self._transaction_started_at = time.monotonic()
+
+        started_at = time.monotonic()
+        failed_records = self.failed_records
+        uncommitted_records = self._uncommitted_records
+        if self.deduplicator is not None:
+            self._uncommitted_ids.extend(row['source_id'] for row in rows)
+        try:
+            await self._insert(self._transaction, rows)
+        except Exception as error:
+            # halves inserted or rejected by bisection before the error are already counted
+            handled = (self._uncommitted_records - uncommitted_records) + (self.failed_records - failed_records)
+            self.failed_records += len(rows) - handled
+            logger.error("%s records failed to insert into %s: %s", len(rows) - handled, self.table.name, error)
+            return
+
+        # bisecting says nothing about the batch size
+        if self.failed_records == failed_records:
+            self.batch_sizer.update(len(rows), time.monotonic() - started_at)
+        logger.debug(
+            "%s records in this batch, uncommitted: %s",
+            len(rows), self._uncommitted_records,
+        )
+
+    async def _insert(self, transaction: Transaction, rows: List[dict]) -> None:
+        """Inserts rows, failed insert is split in halves until rows refused by the sink are isolated."""
+        try:
+            self._uncommitted_records += await transaction.insert(self.table, rows)
+        except Exception as error:
+            if not self._sink.rejects_rows(error):
+                raise
+            if len(rows) == 1:
+                self._reject(rows[0], error)
+                return
+
+            middle = len(rows) // 2
+            await self._insert(transaction, rows[:middle])
+            await self._insert(transaction, rows[middle:])
+
+    def _reject(self, row: dict, error: Exception) -> None:
+        self.failed_records += 1
+        logger.debug("%s row %s rejected: %s", self.table.name, row.get('source_id'), error)
+        if self.reject_file is not None:
+            self.reject_file.write(row, str(error))
+        elif not self._rows_rejected:
+            logger.warning("Rows of %s refused by the database aren't kept, REJECT_PATH is empty", self.table.name)
+        self._rows_rejected = True
+
+    async def _commit(self) -> None:
+        if (transaction := self._transaction) is None:
+            return
+        self._transaction = None
+        records, self._uncommitted_records = self._uncommitted_records, 0
+        if self.deduplicator is not None:
+            self.deduplicator.committed(self._uncommitted_ids)
+            self._uncommitted_ids = []
+
+        try:
+            await transaction.commit()
+        except Exception as error:
+            self.failed_records += records
+            logger.error("%s records of %s lost, commit failed: %s", records, self.table.name, error)
+            return
+
+        self.inserted_records += records
+        logger.debug("%s records committed, total: %s", records, self.inserted_records)
+
+    def decode(self, item: str) -> Any:
+        if self.settings['SELECTIVE_EXTRACTION']:
+            return extract.loads(item, self.mapping.keys)
+        return json.loads(item)
+
+    # TODO: Move cache to redis or any database. In memory cache is not shared between queue workers.
+    @cached(ttl=settings['CACHE_TTL'])  # type: ignore
+    async def get_id(self, table_name: str, source_id: str) -> Optional[int]:
+        return await self._sink.get_id(db.metadata.tables[table_name], source_id)
+
+    async def resolve_references(self, rows: List[dict]) -> None:
+        """Replaces referenced resources `source_id` with ids, all rows of a resource share references."""
+        for reference in self._references:
+            if (source_id := rows[0][reference.column]) is not None:
+                id_ = await self.get_id(reference.table, source_id)
+            else:
+                id_ = None
+
+            if not id_ and reference.required:
+                raise Rejected(reference.column)
+
+            for row in rows:
+                row[reference.column] = id_
+
+    async def process(self, item: str) -> None:
+        self.read_items += 1
+
+        with self.tracer.record("process", table=self.table.name, size=len(item)) as span:
+            # skip items that are not valid JSON
+            try:
+                with self.tracer.span("decode"):
+                    resource = self.decode(item)
+            except json.JSONDecodeError:
+                self._reject_unsharded("invalid JSON", item)
+                span.set(rejected="invalid JSON")
+                return
+
+            try:
+                with self.tracer.span("extract"):
+                    rows = self._extract(resource)
+            except Rejected as rejected:
+                self._reject_unsharded(f"no valid {rejected.reason}", item)
+                span.set(rejected=f"no valid {rejected.reason}")
+                return
+            if not rows:
+                # without rows there is no shard key, only the shard owning the item counts it
+                self._reject_unsharded("no valid rows", item)
+                span.set(rejected="no valid rows")
+                return
+
+            if self.cache_writer is not None:
+                self.cache_writer.write(rows)
+
+            span.set(rows=len(rows))
+            await self._add(rows, item)
+
+    async def replay(self, rows: List[dict]) -> None:
+        """Processes rows of a single resource read from the row cache."""
+        self.read_items += 1
+        await self._add(rows)
+
+    def _reject_unsharded(self, reason: str, item: Union[str, bytes]) -> None:
+        """Rejects item without shard key, only the shard owning the item by its hash counts it."""
+        if self.shard is not None and not self.shard.owns_item(item):
+            self.skipped_items += 1
+            return
         self.processed_items += 1
+        self.reject(reason, item)
+
+    def reject(self, reason: str, item: Union[str, bytes, None] = None, rows: Optional[List[dict]] = None) -> None:
+        count = self.rejections.get(reason, 0) + 1
+        self.rejections[reason] = count
+
+        if count <= self.settings['REJECTION_LOG_SAMPLES']:
+            logger.info("%s item rejected, %s: %.200r", self.table.name, reason, item if rows is None else rows)
+        if self.dead_letter is not None:
+            self.dead_letter.write(reason, item, rows if item is None else None)
+
+    async def _is_duplicate(self, source_id: str) -> bool:
+        if self.deduplicator is None:
+            return False
+        if self._last_id_before_run is None:
+            # asked for by the first resources of the batcher before any is inserted, the first answer is kept
+            last_id = await self._sink.last_id(self.table)
+            if self._last_id_before_run is None:
+                self._last_id_before_run = last_id
+        after = self._last_id_before_run
+        return await self.deduplicator.is_duplicate(
+            source_id, lambda source_id: self._sink.get_id_after(self.table, source_id, after),
+        )
+
+    async def _add(self, rows: List[dict], item: Union[str, bytes, None] = None) -> None:
+        # shard key is compared before references are resolved to ids
+        if self.shard is not None and rows and not self.shard.owns(rows[0][self.shard_key]):
+            self.skipped_items += 1
+            return
+        self.processed_items += 1
+
+        try:
+            if rows:
+                with self.tracer.span("resolve_references"):
+                    await self.resolve_references(rows)
+        except Rejected as rejected:
+            self.reject(f"unresolved {rejected.reason}", item, rows)
+            return
+
+        # only accepted resources count as seen, all rows of a fanned out one share its `source_id`
+        if rows and await self._is_duplicate(rows[0]['source_id']):
+            return
+
+        if self.spill is not None and (self.spill.pending or self._over_budget()):
+            self.spill.write(rows)
+            if not self._flush_lock.locked():
+                await self.proccess_batch()
+            return
+
+        self._buffer_rows(rows)
+        # full batch is flushed right away, `work` flushes the rest periodically
+        if len(self._valid_batch) >= self.batch_sizer.size or self._over_budget():
+            # spilling workers don't wait for a running flush, `work` flushes their rows after it
+            if self.spill is None or not self._flush_lock.locked():
+                await self.proccess_batch()
+
+    def _over_budget(self) -> bool:
+        return self.budget is not None and self.budget.exceeded
+
+    def _buffer_rows(self, rows: List[dict]) -> None:
+        self._valid_batch.extend(rows)
+        if self.budget is not None and rows:
+            size = rows_size(rows)
+            self._batch_bytes += size
+            self.budget.charge(size)
+
+    def _release_rows(self, count: int) -> None:
+        # rows of the batch are charged by their average size
+        if self.budget is None or not count:
+            return
+        size = self._batch_bytes * count // len(self._valid_batch)
+        self._batch_bytes -= size
+        self.budget.release(size)
 
     def get_stats(self) -> dict:
-        return {
+        stats: dict = {
             "processed_items": self.processed_items,
             "inserted_records": self.inserted_records,
+            "failed_records": self.failed_records,
         }
+        if self.shard is not None:
+            stats["read_items"] = self.read_items
+            stats["skipped_items"] = self.skipped_items
+        if self.timings is not None:
+            stats["extraction_timings"] = {name: entry[1] for name, entry in self.timings.items()}
+        if self.deduplicator is not None:
+            stats["duplicates"] = self.deduplicator.duplicates
+            stats["dedupe_false_positives"] = self.deduplicator.false_positives
+            stats["dedupe_memory"] = self.deduplicator.memory
+        if self.rejections:
+            stats["rejections"] = dict(self.rejections)
+        if self.dead_letter is not None and self.dead_letter.count:
+            stats["dead_letter_file"] = self.dead_letter.path
+        if self.reject_file is not None and self.reject_file.count:
+            stats["reject_file"] = self.reject_file.path
+        if self.batch_sizer.adaptive:
+            stats["batch_sizes"] = list(self.batch_sizer.history)
+        if self.transfer:
+            stats["transfer"] = dict(self.transfer)
+        if self.throttle is not None:
+            stats["throttle"] = self.throttle.get_stats()
+        if self.budget is not None:
+            stats["memory_budget"] = self.budget.get_stats()
+            if self.spill is not None:
+                stats["memory_budget"]["spilled_rows"] = self.spill.spilled_rows
+                stats["memory_budget"]["spill_peak_size"] = self.spill.peak_size
+        if self.memory is not None:
+            stats["memory"] = self.memory.get_stats()
+        if self.worker_stats:
+            stats = merge_values([stats, *self.worker_stats])
+            stats["processes"] = len(self.worker_stats)
+        return stats
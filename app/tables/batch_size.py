@@ -0,0 +1,73 @@
+import logging
+import time
+from typing import List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSizer:
+    """
+    Target batch size tuned from measured flush latency, additive increase / multiplicative decrease.
+
+    Full batches flushed within `target_latency` grow the size by `increase` rows, slower ones shrink it
+    by `decrease` factor, as long as throughput dropped too. Size always stays within `minimum` and `maximum`.
+    """
+
+    def __init__(
+        self, name: str, initial: int, minimum: int, maximum: int,
+        target_latency: float, increase: int, decrease: float, adaptive: bool = True,
+    ) -> None:
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.adaptive = adaptive
+
+        self.size = min(max(initial, minimum), maximum)
+        self._throughput = 0.0
+        self._started_at = time.monotonic()
+        # (seconds since start, size) for every change
+        self.history: List[Tuple[float, int]] = [(0.0, self.size)]
+
+    @classmethod
+    def from_settings(cls, name: str, settings: dict, limit: Optional[int] = None) -> 'BatchSizer':
+        """`limit` caps configured bounds, e.g. by the number of query arguments a sink accepts."""
+        maximum = settings['BATCH_SIZE_MAX'] if limit is None else min(settings['BATCH_SIZE_MAX'], limit)
+        return cls(
+            name,
+            initial=settings['BATCH_SIZE'],
+            minimum=min(settings['BATCH_SIZE_MIN'], maximum),
+            maximum=maximum,
+            target_latency=settings['BATCH_TARGET_LATENCY'],
+            increase=settings['BATCH_SIZE_INCREASE'],
+            decrease=settings['BATCH_SIZE_DECREASE'],
+            adaptive=settings['ADAPTIVE_BATCH_SIZE'],
+        )
+
+    def update(self, rows: int, seconds: float) -> None:
+        """Records flush of `rows` taking `seconds`, only full batches tell anything about the size."""
+        if not self.adaptive or rows < self.size:
+            return
+
+        throughput = rows / seconds if seconds > 0 else float('inf')
+        if seconds <= self.target_latency:
+            size = min(self.size + self.increase, self.maximum)
+            reason = "within target latency"
+        elif throughput < self._throughput:
+            size = max(int(self.size * self.decrease), self.minimum)
+            reason = "over target latency, throughput dropped"
+        else:
+            size = self.size
+            reason = "over target latency, throughput still growing"
+        self._throughput = throughput
+
+        logger.debug(
+            "%s batch size %s -> %s: %s rows in %.3f s (%.0f rows/s), %s",
+            self.name, self.size, size, rows, seconds, throughput, reason,
+        )
+        if size != self.size:
+            self.size = size
+            self.history.append((round(time.monotonic() - self._started_at, 3), size))
@@ -1,3 +1,31 @@
+from typing import Optional
+
+import sqlalchemy as sa
+from asyncpg.connection import Connection
 from sqlalchemy import MetaData
 
 metadata = MetaData()
+
+
+async def get_id(conn: Connection, table: sa.Table, source_id: str) -> Optional[int]:
+    query = (
+        table.select()
+        .where(table.c.source_id == source_id)
+        .with_only_columns([table.c.id])
+    )
+    return await conn.fetchval(query)
+
+
+async def get_id_after(conn: Connection, table: sa.Table, source_id: str, after: int) -> Optional[int]:
+    query = (
+        table.select()
+        .where(sa.and_(table.c.source_id == source_id, table.c.id > after))
+        .with_only_columns([table.c.id])
+        .limit(1)
+    )
+    return await conn.fetchval(query)
+
+
+async def last_id(conn: Connection, table: sa.Table) -> int:
+    query = sa.select([sa.func.coalesce(sa.func.max(table.c.id), 0)])
+    return await conn.fetchval(query)
@@ -0,0 +1,81 @@
+import math
+import sys
+from typing import Awaitable, Callable, Iterable, Optional, Set
+
+
+_MASK_32 = 0xffffffff
+_MASK_64 = 0xffffffffffffffff
+
+
+class BloomFilter:
+    """
+    Set of strings with false positives only, sized for `capacity` items at `error_rate`.
+
+    Bit positions come from built-in `hash`, good enough within a single process (~1.8 bytes per item at 0.1 %).
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key: str) -> bool:
+        """Adds key, returns whether it might have been added before."""
+        h = hash(key) & _MASK_64
+        # double hashing, positions h1 + i * h2
+        h1, h2 = h & _MASK_32, (h >> 32) | 1
+        bits, size = self.bits, self.size
+        present = True
+
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                present = False
+        return present
+
+
+class Deduplicator:
+    """
+    Detects resources whose `source_id` was already seen during the run.
+
+    Bloom filter rules out most new ids right away. Its positives are checked exactly, first against
+    ids not committed yet (`pending`), then by `lookup` among rows stored by this run. Memory used is
+    the filter and pending ids, at most COMMIT_ROWS of them.
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.pending: Set[str] = set()
+        self.duplicates = 0
+        self.false_positives = 0
+
+    async def is_duplicate(self, source_id: str, lookup: Callable[[str], Awaitable[Optional[int]]]) -> bool:
+        if not self.bloom.add(source_id):
+            self.pending.add(source_id)
+            return False
+
+        if source_id in self.pending:
+            self.duplicates += 1
+            return True
+
+        # claimed before awaiting, so a concurrent copy is caught by `pending`
+        self.pending.add(source_id)
+        if await lookup(source_id) is not None:
+            self.pending.discard(source_id)
+            self.duplicates += 1
+            return True
+
+        self.false_positives += 1
+        return False
+
+    def committed(self, source_ids: Iterable[str]) -> None:
+        """Ids of committed (or lost) rows are found by `lookup` from now on."""
+        self.pending.difference_update(source_ids)
+
+    @property
+    def memory(self) -> int:
+        """Approximate bytes used."""
+        return sys.getsizeof(self.bloom.bits) + sys.getsizeof(self.pending) + sum(map(sys.getsizeof, self.pending))
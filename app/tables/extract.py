@@ -0,0 +1,47 @@
+import json
+from typing import AbstractSet, Any, Union
+
+try:
+    import simdjson
+except ImportError:  # pragma: no cover
+    simdjson = None  # type: ignore
+
+
+# single parser is enough, documents are fully converted before `loads` returns
+_parser = simdjson.Parser() if simdjson is not None else None
+_MISSING = object()
+
+
+def _convert(value: Any) -> Any:
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
+def loads(item: Union[str, bytes], keys: AbstractSet[str]) -> Any:
+    """
+    Decodes JSON object, materialising only values of top-level `keys`.
+
+    With `pysimdjson` installed the document is parsed lazily and every other value (narratives, `meta`,
+    extensions, ...) is never turned into Python objects. Without it, or for anything simdjson can't
+    represent, full `json.loads` is used, so invalid documents raise `json.JSONDecodeError` either way.
+    """
+    if _parser is not None:
+        try:
+            document = _parser.parse(item)
+        except ValueError:
+            pass
+        else:
+            if isinstance(document, simdjson.Object):
+                result = {}
+                for key in keys:
+                    if (value := document.get(key, _MISSING)) is not _MISSING:
+                        result[key] = _convert(value)
+                return result
+
+    document = json.loads(item)
+    if isinstance(document, dict):
+        return {key: value for key, value in document.items() if key in keys}
+    return document
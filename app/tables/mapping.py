@@ -0,0 +1,265 @@
+import datetime
+import time
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple, Union
+
+
+class Rejected(Exception):
+    """Resource can't be mapped into a valid row, `reason` names the field that failed."""
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Where:
+    """Path step selecting first list item whose `key` equals `value`, e.g. extension by its url."""
+
+    def __init__(self, key: str, value: Any) -> None:
+        self.key = key
+        self.value = value
+
+
+Step = Union[str, int, Where]
+Path = Union[str, Tuple[Step, ...]]
+Getter = Callable[[Any], Any]
+Apply = Callable[[dict, dict], None]
+Timings = Dict[str, List[float]]
+
+
+def _compile_step(step: Step) -> Getter:
+    if isinstance(step, str):
+        def get_key(value: Any) -> Any:
+            return value.get(step) if isinstance(value, dict) else None
+        return get_key
+
+    if isinstance(step, int):
+        index = step
+
+        def get_index(value: Any) -> Any:
+            return value[index] if isinstance(value, list) and len(value) > index else None
+        return get_index
+
+    key, expected = step.key, step.value
+
+    def get_where(value: Any) -> Any:
+        if not isinstance(value, list):
+            return None
+        for item in value:
+            if isinstance(item, dict) and item.get(key) == expected:
+                return item
+        return None
+    return get_where
+
+
+def compile_path(path: Path) -> Getter:
+    """Compiles path into a getter returning None as soon as any step is missing or of unexpected type."""
+    steps = (path,) if isinstance(path, str) else path
+
+    if len(steps) == 1 and isinstance(steps[0], str):
+        key = steps[0]
+
+        def get_one(value: Any) -> Any:
+            return value.get(key) if isinstance(value, dict) else None
+        return get_one
+
+    getters = [_compile_step(step) for step in steps]
+
+    def get(value: Any) -> Any:
+        for getter in getters:
+            if value is None:
+                return None
+            value = getter(value)
+        return value
+    return get
+
+
+def _compile_paths(paths: Sequence[Path]) -> Getter:
+    getters = [compile_path(path) for path in paths]
+    if len(getters) == 1:
+        return getters[0]
+
+    # alternative sources, first present one wins
+    def get_first(value: Any) -> Any:
+        for getter in getters:
+            if (result := getter(value)) is not None:
+                return result
+        return None
+    return get_first
+
+
+_get_first_coding = compile_path(('coding', 0))
+
+
+def first_coding(concept: Any) -> Tuple[Optional[str], Optional[str]]:
+    """Returns code and system of the first coding of CodeableConcept."""
+    coding = _get_first_coding(concept)
+    if not isinstance(coding, dict):
+        return None, None
+    return coding.get('code'), coding.get('system')
+
+
+def iso_datetime(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value)
+
+
+def date(format_: str) -> Callable[[str], datetime.datetime]:
+    def parse(value: str) -> datetime.datetime:
+        return datetime.datetime.strptime(value, format_)
+    return parse
+
+
+def strip_prefix(prefix: str) -> Callable[[str], str]:
+    def strip(value: str) -> str:
+        return value.replace(prefix, "")
+    return strip
+
+
+class Field:
+    """
+    Single column read from the first present of `paths`.
+
+    `convert` is applied to present values, values it fails on are treated as missing.
+    Missing `required` field rejects the whole resource.
+    """
+
+    def __init__(
+        self, column: str, *paths: Path,
+        convert: Optional[Callable[[Any], Any]] = None, required: bool = False,
+    ) -> None:
+        self.column = column
+        self.paths = paths or (column,)
+        self.convert = convert
+        self.required = required
+
+    @property
+    def keys(self) -> FrozenSet[str]:
+        return frozenset(path if isinstance(path, str) else path[0] for path in self.paths)  # type: ignore
+
+    def compile(self) -> Apply:
+        get = _compile_paths(self.paths)
+        column, convert, required = self.column, self.convert, self.required
+
+        def apply(resource: dict, row: dict) -> None:
+            value = get(resource)
+            if value is not None and convert is not None:
+                try:
+                    value = convert(value)
+                except (TypeError, ValueError):
+                    value = None
+            if value is None and required:
+                raise Rejected(column)
+            row[column] = value
+        return apply
+
+
+class Coding(Field):
+    """Code and system columns taken from the first coding of CodeableConcept at `paths`."""
+
+    def __init__(self, columns: Tuple[str, str], *paths: Path, required: bool = False) -> None:
+        super().__init__(columns[0], *paths, required=required)
+        self.columns = columns
+
+    def compile(self) -> Apply:
+        get = _compile_paths(self.paths)
+        (code_column, system_column), required = self.columns, self.required
+
+        def apply(resource: dict, row: dict) -> None:
+            code, system = first_coding(get(resource))
+            if required and (code is None or system is None):
+                raise Rejected(code_column)
+            row[code_column] = code
+            row[system_column] = system
+        return apply
+
+
+class Reference(Field):
+    """
+    Foreign key column, holds referenced resource `source_id` until batcher resolves it
+    to the id of a row in `table`.
+    """
+
+    def __init__(self, column: str, path: Path, prefix: str, table: str, required: bool = False) -> None:
+        super().__init__(column, path, convert=strip_prefix(prefix), required=required)
+        self.table = table
+
+
+class FanOut:
+    """Resource mapped into one row per item returned by `select`, each item filling `fields`."""
+
+    def __init__(self, *fields: Field, select: Callable[[dict], Iterable[dict]], keys: Iterable[str]) -> None:
+        self.fields = fields
+        self.select = select
+        self.keys = frozenset(keys)
+
+
+def _timed(name: str, function: Callable, timings: Timings) -> Callable:
+    entry = timings.setdefault(name, [0, 0.0])
+
+    def timed(*args: Any) -> Any:
+        started_at = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            entry[0] += 1
+            entry[1] += time.perf_counter() - started_at
+    return timed
+
+
+class Mapping:
+    """Declarative mapping of FHIR resource into table rows, compiled once per batcher."""
+
+    def __init__(self, *fields: Field, fan_out: Optional[FanOut] = None) -> None:
+        self.fields = fields
+        self.fan_out = fan_out
+
+    @property
+    def keys(self) -> FrozenSet[str]:
+        """Top-level resource keys read by this mapping."""
+        keys: FrozenSet[str] = frozenset(key for field in self.fields for key in field.keys)
+        if self.fan_out is not None:
+            keys |= self.fan_out.keys
+        return keys
+
+    @property
+    def references(self) -> List[Reference]:
+        return [field for field in self.fields if isinstance(field, Reference)]
+
+    def compile(self, timings: Optional[Timings] = None) -> Callable[[dict], List[dict]]:
+        """
+        Returns function mapping resource into list of rows, raising `Rejected` for invalid resources.
+
+        With `timings` every field extractor records its calls count and total time there.
+        """
+        fields = [field.compile() for field in self.fields]
+        if timings is not None:
+            fields = [_timed(field.column, apply, timings) for field, apply in zip(self.fields, fields)]
+
+        if self.fan_out is None:
+            def extract(resource: dict) -> List[dict]:
+                row: dict = {}
+                for apply in fields:
+                    apply(resource, row)
+                return [row]
+            return extract
+
+        select = self.fan_out.select
+        item_fields = [field.compile() for field in self.fan_out.fields]
+        if timings is not None:
+            select = _timed('fan_out', select, timings)
+            item_fields = [
+                _timed(field.column, apply, timings) for field, apply in zip(self.fan_out.fields, item_fields)
+            ]
+
+        def extract_many(resource: dict) -> List[dict]:
+            base: dict = {}
+            for apply in fields:
+                apply(resource, base)
+
+            rows = []
+            for item in select(resource):
+                row = dict(base)
+                for apply in item_fields:
+                    apply(item, row)
+                rows.append(row)
+            return rows
+        return extract_many
@@ -1,20 +1,14 @@
-import json
 import logging
-import datetime
-from typing import Optional, Tuple
+from typing import List
 
 import sqlalchemy as sa
-from aiocache import cached
-from asyncpg.connection import Connection
-from asyncpg.pool import Pool
 from sqlalchemy.dialects import postgresql
 
-from app.settings import settings
+from app.sinks import Sink
 
 from .basic_batcher import Batcher
 from .db import metadata
-
-from . import encounters, patients
+from .mapping import Coding, FanOut, Field, Mapping, Reference, Rejected, first_coding, iso_datetime
 
 
 logger = logging.getLogger(__name__)
@@ -39,131 +33,45 @@ observations_table = sa.Table(
     sa.Column('type_code', postgresql.TEXT, nullable=False),
     sa.Column('type_code_system', postgresql.TEXT, nullable=False),
     sa.Column('value', postgresql.NUMERIC, nullable=False),
-    sa.Column('unit_code', postgresql.TEXT, nullable=False),
-    sa.Column('unit_code_system', postgresql.TEXT, nullable=False),
+    sa.Column('unit_code', postgresql.TEXT),
+    sa.Column('unit_code_system', postgresql.TEXT),
+)
+
+
+def observation_values(observation: dict) -> List[dict]:
+    """Observation carries either a single coded value or components, each with its own code and value."""
+    type_code, type_code_system = first_coding(observation.get("code"))
+    if type_code is not None and type_code_system is not None:
+        if observation.get("valueQuantity") is None:
+            raise Rejected('value')
+        return [observation]
+
+    components = observation.get("component") or []
+    values = [comp for comp in components if isinstance(comp, dict) and comp.get("valueQuantity") is not None]
+    if not values:
+        raise Rejected('component')
+    return values
+
+
+observations_mapping = Mapping(
+    Field('source_id', 'id', convert=str, required=True),
+    Reference('patient_id', ('subject', 'reference'), prefix="Patient/", table='patients', required=True),
+    Reference('encounter_id', ('context', 'reference'), prefix="Encounter/", table='encounters'),
+    Field('observation_date', 'effectiveDateTime', convert=iso_datetime, required=True),
+    fan_out=FanOut(
+        Coding(('type_code', 'type_code_system'), 'code'),
+        Field('value', ('valueQuantity', 'value')),
+        Field('unit_code', ('valueQuantity', 'unit')),
+        Field('unit_code_system', ('valueQuantity', 'system')),
+        select=observation_values,
+        keys=('code', 'valueQuantity', 'component'),
+    ),
 )
 
 
 class ObservationsBatching(Batcher):
 
-    def __init__(self, pool: Pool, settings: dict) -> None:
-        super().__init__(pool, settings, observations_table)
-
-    @staticmethod
-    def _find_code(code_: Optional[dict]) -> Tuple[Optional[str], Optional[str]]:
-        if not code_:
-            return None, None
-
-        try:
-            coding = code_.get("coding")
-            code = coding[0].get("code")  # type: ignore
-            system = coding[0].get("system")  # type: ignore
-            return code, system
-        except (AttributeError, IndexError):
-            return None, None
-
-        return None, None
-
-    # TODO: Move cache to redis or any database. In memory cache is not shared between queue workers.
-    @cached(ttl=settings['CACHE_TTL'])  # type: ignore
-    async def get_patient_id(self, patient_id_reference: str) -> str:
-        async with self._pool.acquire() as conn:
-            return await patients.get_patient_id(conn, patient_id_reference)
-
-    @cached(ttl=settings['CACHE_TTL'])  # type: ignore
-    async def get_encounter_id(self, encounter_id_reference: str) -> str:
-        async with self._pool.acquire() as conn:
-            return await encounters.get_encounter_id(conn, encounter_id_reference)
-
-    async def process(self, conn: Connection, item: str) -> None:
-        await super().process(conn, item)
-
-        # skip items that are not valid JSON
-        try:
-            observation = json.loads(item)
-        except json.JSONDecodeError:
-            logger.info("invalid JSON")
-            return
-
-        # source_id is required
-        if (source_id := observation.get('id')) is None:
-            return
-
-        # patient_id is required
-        if (subject := observation.get("subject")) is None:
-            return
-        else:
-            if (patient_id_reference := subject.get("reference")) is None:
-                return
-            else:
-                patient_id_reference = patient_id_reference.replace("Patient/", "")
-
-        if not (patient_id := await self.get_patient_id(patient_id_reference)):
-            return
-
-        # encounter_id is optional
-        encounter_id = None
-        if (subject := observation.get("context")) is not None:
-            if (encounter_id_reference := subject.get("reference")) is not None:
-                encounter_id_reference = encounter_id_reference.replace("Encounter/", "")
-                encounter_id = await self.get_encounter_id(encounter_id_reference)
-
-        # observation_date is required
-        if (observation_date_raw := observation.get("effectiveDateTime")) is None:
-            return
-
-        try:
-            observation_date = datetime.datetime.fromisoformat(observation_date_raw)
-        except ValueError:
-            return
-
-        data = []
-
-        # type_code and type_code_system are required
-        type_code, type_code_system = ObservationsBatching._find_code(observation.get("code"))
-        if type_code is not None and type_code_system is not None:
-            if (value_quantity := observation.get("valueQuantity")) is None:
-                return
-            value = value_quantity.get("value")
-            unit_code = value_quantity.get("unit")
-            unit_code_system = value_quantity.get("system")
-            data.append({
-                'type_code': type_code,
-                'type_code_system': type_code_system,
-                'value': value,
-                'unit_code': unit_code,
-                'unit_code_system': unit_code_system,
-            })
-        else:
-            if not (components := observation.get("component")):
-                return
-            else:
-                for comp in components:
-                    type_code, type_code_system = ObservationsBatching._find_code(comp.get("code"))
-                    if (value_quantity := comp.get("valueQuantity")) is None:
-                        continue
-                    value = value_quantity.get("value")
-                    unit_code = value_quantity.get("unit")
-                    unit_code_system = value_quantity.get("system")
-                    data.append({
-                        'type_code': type_code,
-                        'type_code_system': type_code_system,
-                        'value': value,
-                        'unit_code': unit_code,
-                        'unit_code_system': unit_code_system,
-                    })
-
-        for row in data:
-            valid_encounter = {
-                'source_id': str(source_id),
-                'patient_id': patient_id,
-                'encounter_id': encounter_id,
-                'observation_date': observation_date,
-                'type_code': row.get("type_code"),
-                'type_code_system': row.get("type_code_system"),
-                'value': row.get("value"),
-                'unit_code': row.get("unit_code"),
-                'unit_code_system': row.get("unit_code_system"),
-            }
-
-            self._valid_batch.append(valid_encounter)
+    mapping = observations_mapping
+
+    def __init__(self, sink: Sink, settings: dict) -> None:
+        super().__init__(sink, settings, observations_table)
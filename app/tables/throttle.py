@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+# backed off limits don't go below this part of the configured ones
+MIN_FACTOR = 0.05
+# every flush within target latency restores this part of the configured limits
+RECOVERY_STEP = 0.05
+# control file is checked for changes at most this often, in seconds
+CONTROL_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """
+    Tokens refilled at `rate` per second up to `burst`, `rate` 0 is unlimited.
+
+    Taking more tokens than available leaves the bucket in debt, the caller sleeps until it's repaid,
+    so requests larger than `burst` still pass at `rate` on average.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self._rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated_at = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate: float) -> None:
+        # tokens of the old rate are refilled first
+        self._refill()
+        self._rate = rate
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self._rate:
+            self.tokens = min(self.tokens + (now - self._updated_at) * self._rate, self.burst)
+        self._updated_at = now
+
+    def delay(self, tokens: float) -> float:
+        """Takes `tokens`, returns seconds to wait before using them."""
+        if not self._rate:
+            return 0.0
+        self._refill()
+        self.tokens -= tokens
+        return -self.tokens / self._rate if self.tokens < 0 else 0.0
+
+
+class Throttle:
+    """
+    Rows and flushes per second of a batcher, limited by token buckets before every flush.
+
+    Waiting batcher holds its flush lock, queue workers adding rows wait for it and the download
+    waits for the full queue, so the source is read only as fast as rows are flushed.
+
+    With `target_latency` slower flushes multiply limits by `backoff` and faster ones restore them
+    step by step, without a rows limit the average rate until the first slow flush becomes one.
+    Limits are totals of all processes loading an entity, this one takes `share` of them. They can be
+    changed at runtime by `control_path` JSON file, e.g. `{"rows_per_second": 500}`, 0 is unlimited
+    and missing keys keep current values.
+    """
+
+    def __init__(
+        self, rows_per_second: float = 0.0, flushes_per_second: float = 0.0, burst_seconds: float = 1.0,
+        target_latency: float = 0.0, backoff: float = 0.5, control_path: str = "", share: float = 1.0,
+    ) -> None:
+        self.burst_seconds = burst_seconds
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.control_path = control_path
+        self.share = share
+
+        self.configured_rows = rows_per_second
+        self.configured_flushes = flushes_per_second
+        self.factor = 1.0
+        self.rows = TokenBucket(0.0, 0.0)
+        self.flushes = TokenBucket(0.0, 0.0)
+        self._apply()
+        self.rows.tokens, self.flushes.tokens = self.rows.burst, self.flushes.burst
+
+        self.waited = 0.0
+        self.backoffs = 0
+        self.reloads = 0
+        self._acquired_rows = 0
+        self._started_at = time.monotonic()
+        self._control_checked_at = 0.0
+        self._control_mtime: Optional[float] = None
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> Optional['Throttle']:
+        """Throttle of the settings, None when nothing limits flushes."""
+        if not (
+            settings['THROTTLE_ROWS_PER_SECOND'] or settings['THROTTLE_FLUSHES_PER_SECOND']
+            or settings['THROTTLE_TARGET_LATENCY'] or settings['THROTTLE_CONTROL_PATH']
+        ):
+            return None
+        return cls(
+            rows_per_second=settings['THROTTLE_ROWS_PER_SECOND'],
+            flushes_per_second=settings['THROTTLE_FLUSHES_PER_SECOND'],
+            burst_seconds=settings['THROTTLE_BURST_SECONDS'],
+            target_latency=settings['THROTTLE_TARGET_LATENCY'],
+            backoff=settings['THROTTLE_BACKOFF'],
+            control_path=settings['THROTTLE_CONTROL_PATH'],
+            share=settings['THROTTLE_SHARE'],
+        )
+
+    def _apply(self) -> None:
+        for bucket, configured in ((self.rows, self.configured_rows), (self.flushes, self.configured_flushes)):
+            bucket.rate = configured * self.share * self.factor
+            # at least one flush passes without waiting
+            bucket.burst = max(bucket.rate * self.burst_seconds, 1.0) if bucket.rate else 0.0
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    async def acquire(self, rows: int) -> None:
+        """Waits until a flush of `rows` fits the limits."""
+        self._check_control()
+        delay = max(self.flushes.delay(1), self.rows.delay(rows))
+        self._acquired_rows += rows
+        if delay > 0:
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    def observe(self, seconds: float) -> None:
+        """Records flush latency, limits back off above target latency and recover below it."""
+        if not self.target_latency:
+            return
+        if seconds > self.target_latency:
+            if not self.configured_rows:
+                elapsed = time.monotonic() - self._started_at
+                self.configured_rows = self._acquired_rows / elapsed / self.share if elapsed > 0 else 0.0
+            factor = max(self.factor * self.backoff, MIN_FACTOR)
+            self.backoffs += 1
+            logger.debug(
+                "Flush took %.3f s, over target %.3f s, throttle backs off to %.0f%%",
+                seconds, self.target_latency, factor * 100,
+            )
+        else:
+            factor = min(self.factor + RECOVERY_STEP, 1.0)
+        if factor != self.factor:
+            self.factor = factor
+            self._apply()
+
+    def _check_control(self) -> None:
+        if not self.control_path or time.monotonic() - self._control_checked_at < CONTROL_INTERVAL:
+            return
+        self._control_checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.control_path).st_mtime
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        self.reload()
+
+    def reload(self) -> None:
+        """Reads limits from the control file."""
+        try:
+            with open(self.control_path) as file:
+                control = json.load(file)
+            rows = control.get("rows_per_second")
+            flushes = control.get("flushes_per_second")
+            rows = self.configured_rows if rows is None else float(rows)
+            flushes = self.configured_flushes if flushes is None else float(flushes)
+        except (OSError, ValueError, TypeError, AttributeError) as error:
+            logger.warning("Throttle control file %s ignored: %s", self.control_path, error)
+            return
+
+        self.configured_rows, self.configured_flushes = rows, flushes
+        self.reloads += 1
+        self._apply()
+        logger.info(
+            "Throttle limits changed by %s: %s rows/s, %s flushes/s",
+            self.control_path, rows or "unlimited", flushes or "unlimited",
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "rows_per_second": self.rows.rate,
+            "flushes_per_second": self.flushes.rate,
+            "waited": self.waited,
+            "backoffs": self.backoffs,
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,202 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from types import TracebackType
+from typing import IO, Any, List, Optional, Type, Union
+
+
+logger = logging.getLogger(__name__)
+
+# spans are written to the file in groups of this many
+EXPORT_BUFFER_SIZE = 1000
+
+# status codes of OpenTelemetry spans
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+
+def _attribute(key: str, value: Any) -> dict:
+    # OTLP/JSON encodes 64-bit integers as strings
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class _NullSpan:
+    """Span of a record that isn't sampled, costs a `with` statement."""
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Unsampled(_NullSpan):
+    """Marks context of a record left out by sampling, its batch spans go to the nearest sampled span."""
+
+    def __init__(self, parent: Optional['Span']) -> None:
+        self.parent = parent
+        self._token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> '_Unsampled':
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self._token is not None:
+            _current.reset(self._token)
+
+
+class Span:
+
+    def __init__(
+        self, tracer: 'Tracer', name: str, parent: Optional['Span'], attributes: dict,
+    ) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.trace_id: str = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id: str = f"{random.getrandbits(64):016x}"
+        self.parent_id: str = parent.span_id if parent is not None else ""
+        self.attributes = attributes
+        self.status = STATUS_UNSET
+        self.message = ""
+        self.start = 0
+        self.end = 0
+        self._token: Optional[contextvars.Token] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> 'Span':
+        self.start = time.time_ns()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(
+        self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], tb: Optional[TracebackType],
+    ) -> None:
+        self.end = time.time_ns()
+        if self._token is not None:
+            _current.reset(self._token)
+        # cancelled workers and batchers end normally
+        if exc is not None and isinstance(exc, Exception):
+            self.status = STATUS_ERROR
+            self.message = f"{exc_type.__name__ if exc_type else 'Exception'}: {exc}"
+        self.tracer.export(self)
+
+    def to_otlp(self) -> dict:
+        span: dict = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            # SPAN_KIND_INTERNAL
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status},
+        }
+        if self.message:
+            span["status"]["message"] = self.message
+        return span
+
+
+AnySpan = Union[Span, _NullSpan]
+
+# span of the running task, tasks inherit the span they were created in
+_current: contextvars.ContextVar[Union[Span, _Unsampled, None]] = contextvars.ContextVar("span", default=None)
+
+
+def _sampled_parent() -> Optional[Span]:
+    if isinstance(parent := _current.get(), _Unsampled):
+        return parent.parent
+    return parent
+
+
+class Tracer:
+    """
+    Spans exported to a JSON-lines file in OTLP/JSON format, every line is an `ExportTraceServiceRequest`
+    like ones written by the OpenTelemetry collector file exporter.
+
+    `span` is a child of the current span and is skipped in records left out by sampling, `record`
+    samples a span of a single source item with `record_rate`, `batch` samples one with `batch_rate`
+    and always parents it to the nearest sampled span. Without `path` nothing is traced.
+    """
+
+    def __init__(self, path: str = "", record_rate: float = 0.0, batch_rate: float = 1.0) -> None:
+        self.path = path
+        self.record_rate = record_rate
+        self.batch_rate = batch_rate
+        self.exported = 0
+        self._buffer: List[dict] = []
+        self._file: Optional[IO[str]] = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a")
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def span(self, name: str, **attributes: Any) -> AnySpan:
+        if self._file is None:
+            return NULL_SPAN
+        if isinstance(parent := _current.get(), _Unsampled):
+            return NULL_SPAN
+        return Span(self, name, parent, attributes)
+
+    def record(self, name: str, **attributes: Any) -> AnySpan:
+        if self._file is None:
+            return NULL_SPAN
+        if random.random() >= self.record_rate:
+            return _Unsampled(_sampled_parent())
+        return Span(self, name, _sampled_parent(), attributes)
+
+    def batch(self, name: str, **attributes: Any) -> AnySpan:
+        if self._file is None or random.random() >= self.batch_rate:
+            return NULL_SPAN
+        return Span(self, name, _sampled_parent(), attributes)
+
+    def export(self, span: Span) -> None:
+        self._buffer.append(span.to_otlp())
+        if len(self._buffer) >= EXPORT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._file is None or not self._buffer:
+            return
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", "etl-tool")]},
+                "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": self._buffer}],
+            }],
+        }
+        self._file.write(json.dumps(request) + "\n")
+        self._file.flush()
+        self.exported += len(self._buffer)
+        self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.debug("%s spans written to %s", self.exported, self.path)
+
+
+NULL_TRACER = Tracer()
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+import aiohttp
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from . import download
+from .sinks import Sink
+from .tables import encounters, observations, patients, procedures
+from .tables.basic_batcher import Batcher
+from .tables.mapping import Mapping, Rejected
+
+
+logger = logging.getLogger(__name__)
+
+
+# dependency order, every entity is loaded into scratch database before entities referencing it are tuned
+ENTITIES = ("patients", "encounters", "procedures", "observations")
+
+BATCHERS = {
+    "patients": patients.PatientsBatching,
+    "encounters": encounters.EncountersBatching,
+    "procedures": procedures.ProceduresBatching,
+    "observations": observations.ObservationsBatching,
+}
+
+SEARCH_SPACE: Dict[str, Sequence] = {
+    'QUEUE_WORKERS_AMOUNT': (1, 2, 4, 8),
+    'MAX_QUEUE_SIZE': (50, 100, 500, 1000),
+    'BATCHER_SLEEP_TIME': (0.05, 0.2, 0.5, 1.0),
+}
+
+# samples of entities referencing others are picked from this many times their size of first lines
+SAMPLE_SCAN_FACTOR = 100
+# entity isn't tuned when its sample inserts a smaller part of rows, trials would time rejections
+MIN_INSERTED_SHARE = 0.1
+
+
+def _connect(settings: dict, database: str) -> psycopg2.extensions.connection:
+    conn = psycopg2.connect(
+        database=database,
+        host=settings['POSTGRES_DATABASE_HOST'],
+        user=settings['POSTGRES_DATABASE_USERNAME'],
+        password=settings['POSTGRES_DATABASE_PASSWORD'],
+    )
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def prepare_database(settings: dict) -> None:
+    """Creates scratch database when missing and applies fresh schema."""
+    database = settings['POSTGRES_DATABASE_NAME']
+
+    with _connect(settings, "postgres") as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT FROM pg_database WHERE datname = %s", (database,))
+        if cur.fetchone() is None:
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(database)))
+    conn.close()
+
+    with _connect(settings, database) as conn:
+        for path in ("sql_scripts/purge_tables.sql", "sql_scripts/schema.sql"):
+            with open(path, "r") as file:
+                conn.cursor().execute(file.read())
+    conn.close()
+
+
+def truncate(settings: dict, table: str) -> None:
+    with _connect(settings, settings['POSTGRES_DATABASE_NAME']) as conn:
+        conn.cursor().execute(sql.SQL("TRUNCATE {} RESTART IDENTITY CASCADE").format(sql.Identifier(table)))
+    conn.close()
+
+
+def loaded_ids(settings: dict, table: str) -> Set[str]:
+    with _connect(settings, settings['POSTGRES_DATABASE_NAME']) as conn:
+        cur = conn.cursor()
+        cur.execute(sql.SQL("SELECT source_id FROM {}").format(sql.Identifier(table)))
+        ids = {source_id for source_id, in cur.fetchall()}
+    conn.close()
+    return ids
+
+
+def referencing(mapping: Mapping, loaded: Dict[str, Set[str]]) -> Callable[[bytes], bool]:
+    """Whether line is a resource whose required references are all among `loaded` ids of their tables."""
+    references = [reference for reference in mapping.references if reference.required]
+    extract = Mapping(*references).compile()
+
+    def accept(line: bytes) -> bool:
+        try:
+            row = extract(json.loads(line))[0]
+        except (ValueError, TypeError, AttributeError, Rejected):
+            return False
+        return all(row[reference.column] in loaded[reference.table] for reference in references)
+    return accept
+
+
+async def read_sample(url: str, size: int, accept: Optional[Callable[[bytes], bool]] = None) -> List[bytes]:
+    """First `size` lines of the source, with `accept` the first accepted among `size * SAMPLE_SCAN_FACTOR`."""
+    sample: List[bytes] = []
+    async with aiohttp.ClientSession(auto_decompress=False) as session:
+        lines = download.read_lines(session, url)
+        try:
+            scanned = 0
+            async for line in lines:
+                scanned += 1
+                if accept is None or accept(line):
+                    sample.append(line)
+                if len(sample) >= size or scanned >= size * SAMPLE_SCAN_FACTOR:
+                    break
+        finally:
+            await lines.aclose()  # type: ignore
+    return sample
+
+
+class Tuner:
+    """
+    Searches queue, worker and batcher settings of every entity by timed trials.
+
+    Each parameter is searched in turn with the others fixed at their best value so far (coordinate
+    descent), `rounds` times over all of them. Trial loads the sample into an emptied table.
+    Samples of entities referencing others are picked among resources referencing their loaded samples.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, settings: dict, command_line_args: argparse.Namespace,
+        sample_size: int, rounds: int = 1, repeats: int = 1,
+    ) -> None:
+        self._loop = loop
+        # trials run on scratch database, tuned values of previous runs are ignored
+        self.settings = {
+            **settings,
+            'SINK': "postgres",
+            'POSTGRES_DATABASE_NAME': settings['TUNE_DATABASE_NAME'],
+            'ENTITY_SETTINGS': {},
+            'ROW_CACHE': False,
+            # trials measure unthrottled loads
+            'THROTTLE_ROWS_PER_SECOND': 0,
+            'THROTTLE_FLUSHES_PER_SECOND': 0,
+            'THROTTLE_TARGET_LATENCY': 0,
+            'THROTTLE_CONTROL_PATH': "",
+        }
+        self.command_line_args = command_line_args
+        self.sample_size = sample_size
+        self.rounds = rounds
+        self.repeats = repeats
+
+        self.trials: Dict[str, List[dict]] = {}
+
+    async def trial(self, entity: str, sample: List[bytes], parameters: dict) -> float:
+        """Returns the best of `repeats` loading times of the sample, in seconds."""
+        # App module runs the tuner, it can't be imported at module level
+        from . import App
+
+        times = []
+        inserted_records = 0
+        for _ in range(self.repeats):
+            truncate(self.settings, entity)
+
+            app = App(self._loop, {**self.settings, **parameters}, self.command_line_args)
+            sink: Sink = await app.create_sink()
+            batcher: Batcher = BATCHERS[entity](sink, app.entity_settings(entity))
+            try:
+                started_at = time.monotonic()
+                await app._load_data(batcher, "", sample)
+                times.append(time.monotonic() - started_at)
+                inserted_records = batcher.inserted_records
+            finally:
+                await sink.close()
+
+        seconds = min(times)
+        self.trials[entity].append({**parameters, 'seconds': round(seconds, 4), 'inserted_records': inserted_records})
+        logger.debug("%s trial %s: %.4f s", entity, parameters, seconds)
+        return seconds
+
+    async def tune_entity(self, entity: str, sample: List[bytes]) -> Optional[dict]:
+        """Best settings found for the entity, None when its sample inserts almost nothing."""
+        self.trials[entity] = []
+        best = {name: self.settings[name] for name in SEARCH_SPACE}
+        best_seconds = await self.trial(entity, sample, best)
+        tried = {tuple(best.items())}
+
+        inserted_records = self.trials[entity][-1]['inserted_records']
+        if not sample or inserted_records < len(sample) * MIN_INSERTED_SHARE:
+            logger.warning(
+                f"{entity.capitalize()} not tuned, sample of {len(sample)} items inserted {inserted_records} records"
+            )
+            return None
+
+        for _ in range(self.rounds):
+            for name, values in SEARCH_SPACE.items():
+                for value in values:
+                    candidate = {**best, name: value}
+                    if (key := tuple(candidate.items())) in tried:
+                        continue
+                    tried.add(key)
+                    if (seconds := await self.trial(entity, sample, candidate)) < best_seconds:
+                        best, best_seconds = candidate, seconds
+
+        logger.info(f"{entity.capitalize()} tuned in {len(tried)} trials: {best}, {best_seconds:.4f} s")
+        # leave sample loaded, next entities reference its rows
+        await self.trial(entity, sample, best)
+        return best
+
+    async def run(self, entities: Sequence[str] = ENTITIES) -> Dict[str, dict]:
+        prepare_database(self.settings)
+
+        tuned = {}
+        for entity in entities:
+            sample = await read_sample(
+                self.settings[f'{entity.upper()}_PATH'], self.sample_size, self.sample_filter(entity),
+            )
+            logger.info(f"Tuning {entity} on {len(sample)} items")
+            if (best := await self.tune_entity(entity, sample)) is not None:
+                tuned[entity] = best
+        return tuned
+
+    def sample_filter(self, entity: str) -> Optional[Callable[[bytes], bool]]:
+        """Accepts resources referencing rows of samples loaded before, None for entities referencing nothing."""
+        mapping = BATCHERS[entity].mapping
+        tables = {reference.table for reference in mapping.references if reference.required}
+        if not tables:
+            return None
+        return referencing(mapping, {table: loaded_ids(self.settings, table) for table in tables})
+
+
+def write_entity_settings(path: str, tuned: Dict[str, dict]) -> None:
+    with open(path, "w") as file:
+        json.dump(tuned, file, indent=4, sort_keys=True)
@@ -19,6 +19,16 @@ setup(
         'SQLAlchemy',
     ],
     extras_require={
+        'speedups': [
+            'pysimdjson',
+            'uvloop; sys_platform != "win32"',
+            'zstandard',
+        ],
+        'export': [
+            'pyarrow',
+            # pyarrow converts tz-aware timestamps with it on Python < 3.9
+            'pytz',
+        ],
         'dev': [
             'aioresponses',
             'flake8',
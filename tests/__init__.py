@@ -11,6 +11,7 @@ from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from app import init_app
 from app.settings import settings
+from app.sinks import MemorySink
 
 
 SLEEP_PERIOD = 1
@@ -150,6 +151,37 @@ async def run_observations_test(loop: asyncio.AbstractEventLoop, payload: List[d
     )
 
 
+async def run_memory_app(
+    loop: asyncio.AbstractEventLoop,
+    payload: List[dict],
+    entity: str,
+    sink: MemorySink,
+) -> None:
+    asyncio.set_event_loop(loop)
+    with aioresponses() as mocked:
+        mocked.get(settings[f'{entity.upper()}_PATH'], status=200, body=ndjson.dumps(payload))
+        test_app = init_app(
+            loop=loop, settings={**settings, 'SINK': 'memory'},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+
+        await asyncio.wait_for(getattr(test_app, f'resolve_{entity}')(sink), timeout=SLEEP_PERIOD)
+
+
+def seed(*names: str) -> None:
+    """Inserts rows from `tests/seed/<name>.sql` files."""
+    with psycopg2.connect(
+        database=settings['POSTGRES_DATABASE_NAME'],
+        host=settings['POSTGRES_DATABASE_HOST'],
+        user=settings['POSTGRES_DATABASE_USERNAME'],
+        password=settings['POSTGRES_DATABASE_PASSWORD'],
+    ) as conn:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        for name in names:
+            with open(f"tests/seed/{name}.sql", "r") as f:
+                conn.cursor().execute(f.read())
+
+
 def get_data(table: str) -> dict:
     with psycopg2.connect(
         database=settings['POSTGRES_DATABASE_NAME'],
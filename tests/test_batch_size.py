@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from app.settings import settings
+from app.sinks import MemorySink, PostgresSink
+from app.tables.batch_size import BatchSizer
+from app.tables.observations import observations_table
+from app.tables.patients import PatientsBatching
+
+
+def sizer(**kwargs: object) -> BatchSizer:
+    options: dict = dict(initial=1000, minimum=100, maximum=2000, target_latency=0.5, increase=500, decrease=0.5)
+    options.update(kwargs)
+    return BatchSizer("test", **options)
+
+
+def test_batch_size_increases_additively_up_to_maximum() -> None:
+    batch_sizer = sizer()
+
+    for _ in range(3):
+        batch_sizer.update(batch_sizer.size, 0.1)
+
+    assert [size for _, size in batch_sizer.history] == [1000, 1500, 2000]
+
+
+def test_batch_size_decreases_multiplicatively_down_to_minimum() -> None:
+    batch_sizer = sizer(initial=300)
+
+    batch_sizer.update(300, 0.1)
+    # slower, with lower throughput
+    batch_sizer.update(800, 1.0)
+    batch_sizer.update(400, 1.0)
+    batch_sizer.update(200, 2.5)
+
+    assert [size for _, size in batch_sizer.history] == [300, 800, 400, 200, 100]
+
+
+def test_batch_size_ignores_partial_batches() -> None:
+    batch_sizer = sizer()
+
+    batch_sizer.update(10, 5.0)
+
+    assert batch_sizer.size == 1000
+
+
+def test_batch_size_fixed_when_not_adaptive() -> None:
+    batch_sizer = sizer(adaptive=False)
+
+    batch_sizer.update(1000, 0.1)
+
+    assert batch_sizer.size == 1000
+
+
+def test_batch_size_limited_by_sink() -> None:
+    limit = PostgresSink(pool=None).max_batch_rows(observations_table)  # type: ignore
+    batch_sizer = BatchSizer.from_settings("observations", {**settings, 'BATCH_SIZE_MAX': 100000}, limit)
+
+    assert batch_sizer.maximum * len(observations_table.columns) <= 32767
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed_right_away() -> None:
+    sink = MemorySink()
+    batcher = PatientsBatching(sink, {**settings, 'BATCH_SIZE': 2, 'BATCH_SIZE_MIN': 1, 'ADAPTIVE_BATCH_SIZE': False})
+
+    for i in range(5):
+        await batcher.process(json.dumps({"id": str(i)}))
+
+    assert len(sink.tables["patients"]) == 4
+
+    await batcher.finish()
+    assert len(sink.tables["patients"]) == 5
+    assert batcher.get_stats()["inserted_records"] == 5
@@ -0,0 +1,124 @@
+import argparse
+import json
+from asyncio import AbstractEventLoop
+
+import pytest
+
+from app import init_app
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tables.dedupe import BloomFilter
+from app.tables.observations import ObservationsBatching
+from app.tables.patients import PatientsBatching, patients_table
+
+from . import get_data
+
+
+def test_bloom_filter() -> None:
+    bloom = BloomFilter(10000, 0.01)
+
+    # up to capacity, positives of new ids stay below error rate
+    assert sum(bloom.add(f"id-{i}") for i in range(10000)) < 0.01 * 10000
+    # no false negatives
+    assert all(bloom.add(f"id-{i}") for i in range(10000))
+
+
+def observation(source_id: str) -> bytes:
+    return json.dumps({
+        "id": source_id,
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "effectiveDateTime": "2020-10-01",
+        "component": [
+            {"code": {"coding": [{"code": "c0", "system": "s0"}]}, "valueQuantity": {"value": 1}},
+            {"code": {"coding": [{"code": "c1", "system": "s1"}]}, "valueQuantity": {"value": 2}},
+        ],
+    }).encode()
+
+
+@pytest.mark.asyncio
+async def test_duplicates_dropped_with_components() -> None:
+    sink = MemorySink()
+    await sink.insert(patients_table, [{"source_id": "patient-uuid-1"}])
+    batcher = ObservationsBatching(sink, {**settings, 'DEDUPE': True})
+
+    for source_id in ("1", "2", "1"):
+        await batcher.process(observation(source_id))
+    await batcher.proccess_batch()
+    # repeated after commit
+    await batcher.finish()
+    await batcher.process(observation("2"))
+    await batcher.finish()
+
+    assert [row["source_id"] for row in sink.tables["observations"]] == ["1", "1", "2", "2"]
+    stats = batcher.get_stats()
+    assert stats["duplicates"] == 2
+    assert stats["dedupe_memory"] > 0
+    assert batcher.deduplicator is not None and batcher.deduplicator.pending == set()
+
+
+@pytest.mark.asyncio
+async def test_rows_of_earlier_runs_are_not_duplicates() -> None:
+    sink = MemorySink()
+    await sink.insert(patients_table, [{"source_id": str(i)} for i in range(200)])
+    # tiny filter, most ids are positives checked exactly
+    batcher = PatientsBatching(sink, {**settings, 'DEDUPE': True, 'DEDUPE_CAPACITY': 10, 'DEDUPE_ERROR_RATE': 0.5})
+
+    for i in range(200):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+
+    assert len(sink.tables["patients"]) == 400
+    assert batcher.get_stats()["duplicates"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rows_of_earlier_runs_are_not_duplicates_in_postgres(loop: AbstractEventLoop, database: None) -> None:
+    test_app = init_app(loop=loop, settings=settings, command_line_args=argparse.Namespace(verbose=False))
+    sink = await test_app.create_sink()
+    await sink.insert(patients_table, [{"source_id": str(i)} for i in range(100)])
+    batcher = PatientsBatching(sink, {
+        **settings, 'DEDUPE': True, 'DEDUPE_CAPACITY': 10, 'DEDUPE_ERROR_RATE': 0.5, 'BATCH_SIZE': 10,
+        'ADAPTIVE_BATCH_SIZE': False, 'COMMIT_ROWS': 10,
+    })
+
+    for i in range(100):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+    # repeated after their rows were committed
+    for i in range(100):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+
+    assert len(get_data("patients")) == 200
+    assert batcher.get_stats()["duplicates"] == 100
+
+    await sink.close()
+
+
+@pytest.mark.asyncio
+async def test_dedupe_false_positives_are_kept() -> None:
+    sink = MemorySink()
+    # tiny filter, most new ids are positives checked exactly
+    batcher = PatientsBatching(sink, {**settings, 'DEDUPE': True, 'DEDUPE_CAPACITY': 10, 'DEDUPE_ERROR_RATE': 0.5})
+
+    for i in range(200):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+
+    assert len(sink.tables["patients"]) == 200
+    stats = batcher.get_stats()
+    assert stats["duplicates"] == 0
+    assert stats["dedupe_false_positives"] > 0
+
+
+@pytest.mark.asyncio
+async def test_dedupe_disabled() -> None:
+    sink = MemorySink()
+    batcher = PatientsBatching(sink, {**settings, 'DEDUPE': False})
+
+    for _ in range(2):
+        await batcher.process(json.dumps({"id": "1"}))
+    await batcher.finish()
+
+    assert len(sink.tables["patients"]) == 2
+    assert "duplicates" not in batcher.get_stats()
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import gzip
+import json
+from asyncio import AbstractEventLoop
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+from yarl import URL
+
+from app import download, init_app
+from app.settings import settings
+from app.sinks import MemorySink
+
+
+PAYLOAD = [
+    {"id": "source-1", "gender": "male", "birthDate": "1999-01-01"},
+    {"id": "source-2", "gender": "female", "birthDate": "1999-02-01"},
+]
+
+
+async def run_download_app(loop: AbstractEventLoop, cache_path: Path, status: int, body: str = "") -> dict:
+    url = settings['PATIENTS_PATH']
+    sink = MemorySink()
+
+    with aioresponses() as mocked:
+        mocked.get(url, status=status, body=body, headers={"ETag": '"etag-1"'})
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'SINK': 'memory', 'DOWNLOAD_CACHE': True, 'DOWNLOAD_CACHE_PATH': str(cache_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(sink), timeout=1)
+        request_headers = mocked.requests[('GET', URL(url))][0].kwargs['headers']
+
+    return {"rows": sink.tables["patients"], "request_headers": request_headers}
+
+
+@pytest.mark.asyncio
+async def test_download_cache_not_modified(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    first = await run_download_app(loop, tmp_path, 200, ndjson.dumps(PAYLOAD))
+    assert "If-None-Match" not in first["request_headers"]
+
+    second = await run_download_app(loop, tmp_path, 304)
+    assert second["request_headers"]["If-None-Match"] == '"etag-1"'
+
+    assert [row["source_id"] for row in second["rows"]] == ["source-1", "source-2"]
+    assert second["rows"] == first["rows"]
+
+
+@pytest.mark.asyncio
+async def test_download_cache_skips_responses_without_validators(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps(PAYLOAD))
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'SINK': 'memory', 'DOWNLOAD_CACHE': True, 'DOWNLOAD_CACHE_PATH': str(tmp_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(MemorySink()), timeout=1)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+async def iterate(chunks: List[bytes]) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(chunks: List[bytes], content_encoding: Optional[str] = None) -> Tuple[List[bytes], dict]:
+    transfer: dict = {}
+    lines = [line async for line in download.decode_lines(iterate(chunks), content_encoding, transfer)]
+    return lines, transfer
+
+
+def split(data: bytes, size: int) -> List[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [1, 3, 1000])
+async def test_decode_lines_file_level_gzip(size: int) -> None:
+    body = ndjson.dumps(PAYLOAD).encode()
+    # concatenated gzip members, as produced by appending to `.ndjson.gz`
+    compressed = gzip.compress(body + b"\n") + gzip.compress(body)
+
+    lines, transfer = await collect(split(compressed, size))
+
+    assert [json.loads(line)["id"] for line in lines] == ["source-1", "source-2"] * 2
+    assert transfer == {"compressed_bytes": len(compressed), "uncompressed_bytes": 2 * len(body) + 1}
+
+
+@pytest.mark.asyncio
+async def test_decode_lines_content_encoding_and_file_level() -> None:
+    body = ndjson.dumps(PAYLOAD).encode()
+
+    lines, _ = await collect(split(gzip.compress(gzip.compress(body)), 7), "gzip")
+
+    assert [json.loads(line)["id"] for line in lines] == ["source-1", "source-2"]
+
+
+@pytest.mark.asyncio
+async def test_decode_lines_zstd() -> None:
+    zstandard = pytest.importorskip("zstandard")
+    body = ndjson.dumps(PAYLOAD).encode()
+
+    lines, _ = await collect(split(zstandard.ZstdCompressor().compress(body), 5), "zstd")
+
+    assert [json.loads(line)["id"] for line in lines] == ["source-1", "source-2"]
+
+
+@pytest.mark.asyncio
+async def test_decode_lines_uncompressed_and_short() -> None:
+    assert (await collect([b'{"id"', b': 1}\n{}']))[0] == [b'{"id": 1}', b'{}']
+    assert (await collect([b'{}']))[0] == [b'{}']
+
+
+@pytest.mark.asyncio
+async def test_decode_lines_truncated() -> None:
+    with pytest.raises(ValueError):
+        await collect([gzip.compress(b'{"id": 1}\n' * 100)[:-10]])
+
+
+@pytest.mark.asyncio
+async def test_download_gzip_content_encoding(loop: AbstractEventLoop) -> None:
+    sink = MemorySink()
+    body = gzip.compress(ndjson.dumps(PAYLOAD).encode())
+
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=body, headers={"Content-Encoding": "gzip"})
+        test_app = init_app(
+            loop=loop, settings={**settings, 'SINK': 'memory'}, command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(sink), timeout=1)
+
+    assert [row["source_id"] for row in sink.tables["patients"]] == ["source-1", "source-2"]
+    assert test_app.stats["patients"]["transfer"]["compressed_bytes"] == len(body)
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from app import eventloop
+from app.eventloop import loop_name, new_event_loop
+
+
+def test_new_event_loop_asyncio() -> None:
+    loop = new_event_loop("asyncio")
+    try:
+        assert loop_name(loop) == "asyncio"
+    finally:
+        loop.close()
+
+
+def test_new_event_loop_uvloop() -> None:
+    pytest.importorskip("uvloop")
+    loop = new_event_loop("uvloop")
+    try:
+        assert loop_name(loop) == "uvloop"
+        assert loop.run_until_complete(asyncio.sleep(0, result=1)) == 1
+    finally:
+        loop.close()
+
+
+def test_new_event_loop_without_uvloop(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(eventloop, "uvloop", None)
+    loop = new_event_loop("uvloop")
+    try:
+        assert loop_name(loop) == "asyncio"
+    finally:
+        loop.close()
+
+
+def test_new_event_loop_unknown() -> None:
+    with pytest.raises(ValueError):
+        new_event_loop("trio")
+
+
+def test_new_event_loop_executor_workers() -> None:
+    loop = new_event_loop("asyncio", executor_workers=2)
+    try:
+        # default executor runs `None` executor jobs
+        assert loop._default_executor._max_workers == 2  # type: ignore
+        assert loop.run_until_complete(loop.run_in_executor(None, sum, [1, 2])) == 3
+    finally:
+        loop.close()
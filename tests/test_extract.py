@@ -0,0 +1,90 @@
+import json
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.tables import extract
+from app.tables.encounters import EncountersBatching
+from app.tables.observations import ObservationsBatching
+from app.tables.patients import PatientsBatching
+from app.tables.procedures import ProceduresBatching
+
+
+NARRATIVE = {
+    "status": "generated",
+    "div": '<div xmlns="http://www.w3.org/1999/xhtml">{"id": "fake"} [<b>75.3 mm</b>] \\ </div>',
+}
+META = {"versionId": "1", "lastUpdated": "2020-10-01T00:00:00Z", "profile": ["http://example.com/profile"]}
+
+PAYLOADS = [
+    {"id": "2"},
+    {"invalid_key": "2"},
+    {"id": 9724, "text": NARRATIVE, "meta": META},
+    {
+        "id": "2", "birthDate": "1999-01-01", "gender": "female",
+        "address": [{"country": "UK"}, {"country": "Invalid"}],
+        "extension": [{"url": "http:invalid.com", "valueCodeableConcept": {"coding": [{"code": "11"}]}}],
+        "text": NARRATIVE,
+    },
+    {
+        "id": "2",
+        "meta": META,
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+        "type": [{"coding": [{"code": "code_value", "system": "system_value"}]}],
+        "text": NARRATIVE,
+    },
+    {
+        "id": "21",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "context": {"reference": "Encounter/encounter-uuid-1"},
+        "performedPeriod": {"start": "2010-12-12"},
+        "code": {"coding": [{"code": "code_value", "system": "system_value"}]},
+    },
+    {
+        "id": "21",
+        "extension": [{"url": "http://example.com/ext", "valueString": "}]"}],
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "context": None,
+        "effectiveDateTime": "2020-10-01",
+        "component": [
+            {
+                "code": {"coding": [{"code": "code_value0", "system": "system_value0"}]},
+                "valueQuantity": {"value": 75.3, "unit": "mm", "system": "metric"},
+            },
+            {
+                "code": {"coding": [{"code": "code_value1", "system": "system_value1"}]},
+                "valueQuantity": {"value": 3, "unit": "km", "system": "metric0"},
+            },
+        ],
+        "text": NARRATIVE,
+    },
+]
+
+BATCHERS = [PatientsBatching, EncountersBatching, ProceduresBatching, ObservationsBatching]
+
+
+@pytest.mark.parametrize("batcher", BATCHERS)
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_extract_matches_full_parse(batcher: type, payload: dict) -> None:
+    item = json.dumps(payload).encode()
+
+    full = {key: value for key, value in json.loads(item).items() if key in batcher.mapping.keys}
+
+    assert extract.loads(item, batcher.mapping.keys) == full
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_extract_matches_full_parse_without_simdjson(payload: dict, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(extract, "_parser", None)
+    item = json.dumps(payload)
+
+    full = {key: value for key, value in json.loads(item).items() if key in ObservationsBatching.mapping.keys}
+
+    assert extract.loads(item, ObservationsBatching.mapping.keys) == full
+
+
+@pytest.mark.parametrize("item", [b'{"id": "2"', b'not json', b'{"id": "2"}{"id": "3"}'])
+def test_extract_invalid_json(item: bytes) -> None:
+    with pytest.raises(json.JSONDecodeError):
+        extract.loads(item, PatientsBatching.mapping.keys)
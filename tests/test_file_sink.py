@@ -0,0 +1,153 @@
+import argparse
+import csv
+import gzip
+import json
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import pytest
+
+from app import init_app
+from app.settings import settings
+from app.sinks import FileSink, Sink
+from app.tables.observations import ObservationsBatching
+from app.tables.patients import patients_table
+
+
+from . import get_data, run_memory_app
+
+
+ENCOUNTERS_PAYLOAD = [
+    {
+        "id": "source-1",
+        "subject": {"reference": "Patient/2"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    },
+    {
+        "id": "source-2",
+        "subject": {"reference": "Patient/uuid-non-existing"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    },
+]
+
+
+@pytest.mark.asyncio
+async def test_file_sink_parquet(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = FileSink(str(tmp_path), "parquet", row_group_size=2)
+
+    await run_memory_app(loop, [{"id": "2", "birthDate": "1999-01-01"}, {"id": "3"}, {"id": "4"}], "patients", sink)
+    await run_memory_app(loop, ENCOUNTERS_PAYLOAD, "encounters", sink)
+    await sink.close()
+
+    patients = pq.read_table(sink.file_path(patients_table))
+    assert patients.column("source_id").to_pylist() == ["2", "3", "4"]
+    assert str(patients.column("birth_date")[0]) == "1999-01-01"
+    assert pq.ParquetFile(sink.file_path(patients_table)).num_row_groups == 2
+
+    encounters = pq.read_table(tmp_path / "encounters.parquet").to_pylist()
+    assert len(encounters) == 1
+    assert encounters[0]["patient_id"] == 1
+    assert str(encounters[0]["start_date"]) == "2011-10-31 20:05:23+00:00"
+
+
+@pytest.mark.asyncio
+async def test_file_sink_csv(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    sink = FileSink(str(tmp_path), "csv", row_group_size=100)
+
+    await run_memory_app(loop, [{"id": "2", "birthDate": "1999-01-01"}], "patients", sink)
+    await run_memory_app(loop, ENCOUNTERS_PAYLOAD, "encounters", sink)
+    await sink.close()
+
+    with gzip.open(tmp_path / "patients.csv.gz", "rt") as file:
+        patients = list(csv.DictReader(file))
+    assert patients[0]["id"] == "1"
+    assert patients[0]["birth_date"] == "1999-01-01"
+
+    with gzip.open(tmp_path / "encounters.csv.gz", "rt") as file:
+        encounters = list(csv.DictReader(file))
+    assert [(row["source_id"], row["patient_id"]) for row in encounters] == [("source-1", "1")]
+
+
+@pytest.mark.asyncio
+async def test_file_sink_parquet_rejects_invalid_rows(tmp_path: Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = FileSink(str(tmp_path), "parquet", row_group_size=4)
+    await sink.insert(patients_table, [{"source_id": "patient-1"}])
+    batcher = ObservationsBatching(sink, {
+        **settings, 'BATCH_SIZE': 2, 'BATCH_SIZE_MIN': 1, 'ADAPTIVE_BATCH_SIZE': False, 'REJECT_PATH': "",
+    })
+
+    for i in range(8):
+        await batcher.process(json.dumps({
+            "id": str(i),
+            "subject": {"reference": "Patient/patient-1"},
+            "effectiveDateTime": "2020-10-01",
+            "code": {"coding": [{"code": "code", "system": "system"}]},
+            "valueQuantity": {"value": "abc" if i == 5 else i, "unit": "mm", "system": "metric"},
+        }))
+    await batcher.finish()
+    await sink.close()
+
+    # rows flushed with the invalid one in its batch and row group are kept
+    observations = pq.read_table(tmp_path / "observations.parquet")
+    assert observations.column("source_id").to_pylist() == ["0", "1", "2", "3", "4", "6", "7"]
+    stats = batcher.get_stats()
+    assert (stats["inserted_records"], stats["failed_records"]) == (7, 1)
+
+
+QUANTITIES = [
+    {"value": 0, "unit": "mm", "system": "metric"},
+    # NOT NULL value is missing
+    {"unit": "mm", "system": "metric"},
+    {"value": "abc", "unit": "mm", "system": "metric"},
+    {"value": 3, "unit": "mm", "system": "metric"},
+    # unit is optional
+    {"value": 4},
+]
+
+
+async def load_quantities(sink: Sink) -> dict:
+    batcher = ObservationsBatching(sink, {
+        **settings, 'BATCH_SIZE': 5, 'BATCH_SIZE_MIN': 1, 'ADAPTIVE_BATCH_SIZE': False, 'REJECT_PATH': "",
+    })
+    for i, quantity in enumerate(QUANTITIES):
+        await batcher.process(json.dumps({
+            "id": str(i),
+            "subject": {"reference": "Patient/patient-1"},
+            "effectiveDateTime": "2020-10-01",
+            "code": {"coding": [{"code": "code", "system": "system"}]},
+            "valueQuantity": quantity,
+        }))
+    await batcher.finish()
+    return batcher.get_stats()
+
+
+@pytest.mark.asyncio
+async def test_file_sink_csv_rejects_invalid_rows(tmp_path: Path) -> None:
+    sink = FileSink(str(tmp_path), "csv", row_group_size=4)
+    await sink.insert(patients_table, [{"source_id": "patient-1"}])
+
+    stats = await load_quantities(sink)
+    await sink.close()
+
+    with gzip.open(tmp_path / "observations.csv.gz", "rt") as file:
+        observations = list(csv.DictReader(file))
+    assert [row["source_id"] for row in observations] == ["0", "3", "4"]
+    assert (observations[2]["unit_code"], observations[2]["unit_code_system"]) == ("", "")
+    assert (stats["inserted_records"], stats["failed_records"]) == (3, 2)
+
+
+@pytest.mark.asyncio
+async def test_postgres_sink_accepts_rows_files_sink_accepts(
+    loop: AbstractEventLoop, database: None, tmp_path: Path,
+) -> None:
+    test_app = init_app(loop=loop, settings=settings, command_line_args=argparse.Namespace(verbose=False))
+    sink = await test_app.create_sink()
+    await sink.insert(patients_table, [{"source_id": "patient-1"}])
+
+    stats = await load_quantities(sink)
+    await sink.close()
+
+    assert sorted(row["source_id"] for row in get_data("observations")) == ["0", "3", "4"]
+    assert (stats["inserted_records"], stats["failed_records"]) == (3, 2)
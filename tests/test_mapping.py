@@ -0,0 +1,84 @@
+import datetime
+
+import pytest
+
+from app.tables.encounters import encounters_mapping
+from app.tables.mapping import Rejected
+from app.tables.observations import observations_mapping
+from app.tables.patients import ETHNICITY_CODE_URL, RACE_CODE_URL, patients_mapping
+from app.tables.procedures import procedures_mapping
+
+
+def test_mapping_patient() -> None:
+    extract = patients_mapping.compile()
+
+    rows = extract({
+        "id": 9724, "birthDate": "1999-01-01", "gender": "male",
+        "address": [{"country": "UK"}],
+        "extension": [
+            {"url": RACE_CODE_URL, "valueCodeableConcept": {"coding": [{"code": "r", "system": "rs"}]}},
+            {"url": ETHNICITY_CODE_URL, "valueCodeableConcept": {"coding": []}},
+        ],
+    })
+
+    assert rows == [{
+        "source_id": "9724",
+        "birth_date": datetime.datetime(1999, 1, 1),
+        "gender": "male",
+        "country": "UK",
+        "race_code": "r",
+        "race_code_system": "rs",
+        "ethnicity_code": None,
+        "ethnicity_code_system": None,
+    }]
+
+
+def test_mapping_references_are_stripped() -> None:
+    extract = encounters_mapping.compile()
+
+    rows = extract({
+        "id": "2",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    })
+
+    assert rows[0]["patient_id"] == "patient-uuid-1"
+    assert rows[0]["type_code"] is None
+
+
+@pytest.mark.parametrize("resource, reason", [
+    ({"subject": {"reference": "Patient/1"}}, "source_id"),
+    ({"id": "1", "subject": {}}, "patient_id"),
+    ({"id": "1", "subject": {"reference": "Patient/1"}, "performedDateTime": "2020-10-01afsfa"}, "procedure_date"),
+    ({"id": "1", "subject": {"reference": "Patient/1"}, "performedPeriod": {}}, "procedure_date"),
+    ({"id": "1", "subject": {"reference": "Patient/1"}, "performedDateTime": "2020-10-01"}, "type_code"),
+])
+def test_mapping_rejects_invalid_procedure(resource: dict, reason: str) -> None:
+    extract = procedures_mapping.compile()
+
+    with pytest.raises(Rejected) as error:
+        extract(resource)
+
+    assert error.value.reason == reason
+
+
+def test_mapping_observation_components_fan_out() -> None:
+    timings: dict = {}
+    extract = observations_mapping.compile(timings)
+
+    rows = extract({
+        "id": "21",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "effectiveDateTime": "2020-10-01",
+        "component": [
+            {"code": {"coding": [{"code": "c0", "system": "s0"}]}, "valueQuantity": {"value": 75.3, "unit": "mm"}},
+            {"code": {"coding": [{"code": "c1", "system": "s1"}]}},
+            {"code": {"coding": [{"code": "c2", "system": "s2"}]}, "valueQuantity": {"value": 3, "system": "m"}},
+        ],
+    })
+
+    assert [row["type_code"] for row in rows] == ["c0", "c2"]
+    assert [row["value"] for row in rows] == [75.3, 3]
+    assert all(row["source_id"] == "21" and row["encounter_id"] is None for row in rows)
+    assert timings["fan_out"][0] == 1
+    assert timings["type_code"][0] == 2
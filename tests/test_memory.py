@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import tracemalloc
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.memory import MemoryBudget, MemoryTracker, current_rss, rows_size
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tables.patients import PatientsBatching
+
+
+def test_memory_tracker_snapshots_growth() -> None:
+    tracker = MemoryTracker("patients", trace=True, top=3)
+    tracker.start()
+    try:
+        tracker.sample(0)
+        held = [bytearray(1024) for _ in range(2000)]
+        tracker.sample(len(held))
+        # no snapshot while traced memory doesn't grow
+        tracker.sample(1)
+    finally:
+        tracker.stop()
+
+    stats = tracker.get_stats()
+    assert not tracemalloc.is_tracing()
+    assert stats["samples"] == 4
+    assert stats["batch_rows_at_snapshot"] == 2000
+    assert stats["traced_peak"] >= 2000 * 1024
+    assert "test_memory.py" in stats["top_sites"][0]["site"]
+    assert stats["top_sites"][0]["count"] >= 2000
+    assert stats["peak_rss"] >= current_rss() // 2
+
+
+def test_memory_tracker_without_trace() -> None:
+    tracker = MemoryTracker("patients")
+    tracker.start()
+    tracker.stop()
+
+    assert set(tracker.get_stats()) == {"peak_rss", "start_rss", "samples"}
+
+
+@pytest.mark.asyncio
+async def test_memory_report_per_entity(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps([{"id": str(i)} for i in range(20)]))
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'MEMORY_TRACE': True, 'MEMORY_REPORT_PATH': str(tmp_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(MemorySink()), timeout=1)
+
+    memory = test_app.stats["patients"]["memory"]
+    assert memory["samples"] >= 2
+    assert memory["traced_peak"] > 0
+    assert json.loads((tmp_path / "patients.json").read_text())["peak_rss"] == memory["peak_rss"]
+
+
+class SlowSink(MemorySink):
+
+    async def insert(self, table, rows):  # type: ignore
+        await asyncio.sleep(0.005)
+        return await super().insert(table, rows)
+
+
+@pytest.mark.asyncio
+async def test_memory_budget_waits_for_release() -> None:
+    budget = MemoryBudget(100)
+    await budget.acquire(80)
+    # nothing charged, oversized items pass
+    waiting = asyncio.ensure_future(budget.acquire(50))
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    assert budget.exceeded
+
+    budget.release(80)
+    await asyncio.wait_for(waiting, timeout=1)
+    assert (budget.used, budget.peak, budget.waits) == (50, 80, 1)
+
+
+def test_rows_size() -> None:
+    rows = [{"source_id": "a" * 100, "patient_id": 1}] * 3
+
+    assert rows_size(rows) == 3 * rows_size(rows[:1]) > 300
+    assert rows_size([]) == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mode", ["backpressure", "spill"])
+async def test_memory_budget_bounds_slow_sink(loop: AbstractEventLoop, tmp_path: Path, mode: str) -> None:
+    lines = [json.dumps({"id": str(i), "gender": "female"}).encode() for i in range(1000)]
+    test_settings = {
+        **settings, 'BATCH_SIZE': 100, 'BATCH_SIZE_MIN': 1, 'ADAPTIVE_BATCH_SIZE': False, 'DEDUPE': False,
+        'MEMORY_BUDGET_MB': 0.05, 'MEMORY_BUDGET_MODE': mode, 'SPILL_PATH': str(tmp_path),
+        'BATCHER_SLEEP_TIME': 0.01, 'QUEUE_WORKERS_AMOUNT': 4, 'MAX_QUEUE_SIZE': 1000, 'PROGRESS_INTERVAL': 0,
+    }
+    test_app = init_app(loop=loop, settings=test_settings, command_line_args=argparse.Namespace(verbose=False))
+    sink = SlowSink()
+    batcher = PatientsBatching(sink, test_settings)
+
+    await asyncio.wait_for(test_app._load_data(batcher, "", lines), timeout=10)
+
+    budget = batcher.get_stats()["memory_budget"]
+    # a row of every queue worker may be charged over the limit
+    assert budget["peak"] < budget["limit"] * 1.1
+    assert [row["source_id"] for row in sink.tables["patients"]] == [str(i) for i in range(1000)]
+    if mode == "spill":
+        assert budget["spilled_rows"] > 0
+        assert list(tmp_path.iterdir()) == []
+    else:
+        assert budget["waits"] > 0
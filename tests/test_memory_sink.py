@@ -0,0 +1,70 @@
+from asyncio import AbstractEventLoop
+
+import pytest
+
+from app.sinks import MemorySink
+from app.tables.encounters import encounters_table
+from app.tables.patients import patients_table
+
+
+from . import run_memory_app
+
+
+@pytest.fixture
+async def sink() -> MemorySink:
+    sink = MemorySink()
+    # same seeds as tests/seed/*.sql
+    await sink.insert(patients_table, [
+        {"id": 7, "source_id": "patient-uuid-1"},
+        {"id": 15, "source_id": "patient-uuid-2"},
+    ])
+    await sink.insert(encounters_table, [{"id": 3, "source_id": "encounter-uuid-1", "patient_id": 7}])
+    return sink
+
+
+@pytest.mark.asyncio
+async def test_memory_sink_patients(loop: AbstractEventLoop) -> None:
+    sink = MemorySink()
+    payload = [{"id": "2"}, {"id": "uuid-abcd12"}, {"not_id": "1"}]
+
+    await run_memory_app(loop, payload, "patients", sink)
+
+    data = sink.tables["patients"]
+    assert [row["source_id"] for row in data] == ["2", "uuid-abcd12"]
+    assert [row["id"] for row in data] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_memory_sink_encounters_references(loop: AbstractEventLoop, sink: MemorySink) -> None:
+    period = {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"}
+    payload = [
+        {"id": "source-1", "subject": {"reference": "Patient/uuid-non-existing"}, "period": period},
+        {"id": "source-2", "subject": {"reference": "Patient/patient-uuid-1"}, "period": period},
+        {"id": "source-3", "subject": {"reference": "Patient/patient-uuid-2"}, "period": period},
+    ]
+
+    await run_memory_app(loop, payload, "encounters", sink)
+
+    data = sink.tables["encounters"][1:]
+    assert [(row["source_id"], row["patient_id"]) for row in data] == [("source-2", 7), ("source-3", 15)]
+    assert [row["id"] for row in data] == [4, 5]
+
+
+@pytest.mark.asyncio
+async def test_memory_sink_observations(loop: AbstractEventLoop, sink: MemorySink) -> None:
+    payload = [{
+        "id": "21",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "context": {"reference": "Encounter/encounter-non-existing"},
+        "effectiveDateTime": "2020-10-01",
+        "code": {"coding": [{"code": "code_value", "system": "system_value"}]},
+        "valueQuantity": {"value": 75.3, "unit": "mm", "system": "metric"},
+    }]
+
+    await run_memory_app(loop, payload, "observations", sink)
+
+    data = sink.tables["observations"]
+    assert len(data) == 1
+    assert data[0]["patient_id"] == 7
+    assert data[0]["encounter_id"] is None
+    assert data[0]["value"] == 75.3
@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import json
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import asyncpg
+import psycopg2
+import pytest
+from asyncpg.pool import Pool
+from _pytest.monkeypatch import MonkeyPatch
+
+from app import init_app
+from app.settings import settings
+from app.sinks import DatabaseProfile, PostgresSink
+from app.tables.observations import ObservationsBatching
+from app.tables.patients import patients_table
+
+from . import get_data, seed
+
+
+def count_connections() -> int:
+    """Connections to the test database, other than the one counting them."""
+    conn = psycopg2.connect(
+        database=settings['POSTGRES_DATABASE_NAME'],
+        host=settings['POSTGRES_DATABASE_HOST'],
+        user=settings['POSTGRES_DATABASE_USERNAME'],
+        password=settings['POSTGRES_DATABASE_PASSWORD'],
+    )
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND pid != pg_backend_pid()"
+            )
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def bulk_settings(set_local: bool) -> dict:
+    return {**settings, 'DB_PROFILE': 'bulk', 'BULK_SET_LOCAL': set_local, 'POSTGRES_MAX_CONNECTION_POOL_SIZE': 3}
+
+
+@pytest.mark.asyncio
+async def test_bulk_profile_session(loop: AbstractEventLoop, database: None) -> None:
+    test_app = init_app(loop=loop, settings=bulk_settings(False), command_line_args=argparse.Namespace(verbose=False))
+    connections = count_connections()
+    sink = await test_app.create_sink()
+
+    assert test_app.stats['db_profile'] == 'bulk'
+    # whole pool is opened before the first flush
+    assert count_connections() == connections + 3
+
+    assert sink.pool is not None
+    async with sink.pool.acquire() as conn:
+        assert await conn.fetchval("SHOW synchronous_commit") == "off"
+        assert await conn.fetchval("SHOW work_mem") == "64MB"
+
+    await sink.close()
+
+
+@pytest.mark.asyncio
+async def test_bulk_profile_set_local(loop: AbstractEventLoop, database: None) -> None:
+    test_app = init_app(loop=loop, settings=bulk_settings(True), command_line_args=argparse.Namespace(verbose=False))
+    sink = await test_app.create_sink()
+    assert isinstance(sink, PostgresSink) and sink.profile.set_local
+
+    assert await sink.insert(patients_table, [{"source_id": "1"}, {"source_id": "2"}]) == 2
+
+    async with sink.pool.acquire() as conn:
+        assert await conn.fetchval("SHOW synchronous_commit") == "on"
+
+    await sink.close()
+
+
+def test_unknown_profile() -> None:
+    with pytest.raises(ValueError):
+        DatabaseProfile.from_settings({**settings, 'DB_PROFILE': 'fast'})
+
+
+def observation(source_id: str, value: object) -> bytes:
+    return json.dumps({
+        "id": source_id,
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "effectiveDateTime": "2020-10-01",
+        "code": {"coding": [{"code": "code_value", "system": "system_value"}]},
+        "valueQuantity": {"value": value, "unit": "mm", "system": "metric"},
+    }).encode()
+
+
+@pytest.mark.asyncio
+async def test_flushes_share_transaction(loop: AbstractEventLoop, database: None, tmp_path: Path) -> None:
+    seed("patients")
+    test_app = init_app(
+        loop=loop, settings={**settings, 'COMMIT_ROWS': 100, 'COMMIT_SECONDS': 60, 'REJECT_PATH': str(tmp_path)},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    batcher = ObservationsBatching(sink, test_app._settings)
+
+    await batcher.process(observation("1", 75.3))
+    await batcher.proccess_batch()
+    # numeric column rejects this one, only its flush is rolled back
+    await batcher.process(observation("2", "abc"))
+    await batcher.proccess_batch()
+    await batcher.process(observation("3", 3))
+    await batcher.proccess_batch()
+
+    assert get_data("observations") == []
+    assert batcher.inserted_records == 0
+    assert batcher.failed_records == 1
+
+    await batcher.finish()
+
+    assert [row["source_id"] for row in get_data("observations")] == ["1", "3"]
+    assert batcher.get_stats()["inserted_records"] == 2
+
+    await sink.close()
+
+
+@pytest.mark.asyncio
+async def test_commit_by_rows(loop: AbstractEventLoop, database: None) -> None:
+    seed("patients")
+    test_app = init_app(
+        loop=loop, settings={**settings, 'COMMIT_ROWS': 2, 'COMMIT_SECONDS': 60},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    batcher = ObservationsBatching(sink, test_app._settings)
+
+    for source_id in ("1", "2", "3"):
+        await batcher.process(observation(source_id, 1))
+        await batcher.proccess_batch()
+
+    assert batcher.inserted_records == 2
+    assert len(get_data("observations")) == 2
+
+    await batcher.finish()
+    assert len(get_data("observations")) == 3
+
+    await sink.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_bisected(loop: AbstractEventLoop, database: None, tmp_path: Path) -> None:
+    seed("patients")
+    test_app = init_app(
+        loop=loop, settings={**settings, 'REJECT_PATH': str(tmp_path)},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    batcher = ObservationsBatching(sink, test_app._settings)
+
+    for i in range(8):
+        # non-numeric and NULL value
+        value = "abc" if i == 2 else None if i == 5 else i
+        await batcher.process(observation(str(i), value))
+    await batcher.finish()
+
+    assert sorted(row["source_id"] for row in get_data("observations")) == ["0", "1", "3", "4", "6", "7"]
+    assert batcher.get_stats()["inserted_records"] == 6
+    assert batcher.get_stats()["failed_records"] == 2
+
+    rejects = [json.loads(line) for line in (tmp_path / "observations.ndjson").read_text().splitlines()]
+    assert [reject["row"]["source_id"] for reject in rejects] == ["2", "5"]
+    assert rejects[0]["row"]["observation_date"] == "2020-10-01 00:00:00"
+    assert "value" in rejects[1]["error"]
+
+    await sink.close()
+
+
+async def assert_pool_released(pool: Pool, size: int) -> None:
+    """Every connection is back in the pool and has no open transaction."""
+    connections = [await pool.acquire(timeout=1) for _ in range(size)]
+    try:
+        assert not any(conn.is_in_transaction() for conn in connections)
+    finally:
+        for conn in connections:
+            await pool.release(conn)
+
+
+@pytest.mark.asyncio
+async def test_failed_commit_loses_nothing_else(
+    loop: AbstractEventLoop, database: None, monkeypatch: MonkeyPatch,
+) -> None:
+    seed("patients")
+    test_app = init_app(
+        loop=loop, settings={**settings, 'COMMIT_ROWS': 100, 'COMMIT_SECONDS': 60},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    assert isinstance(sink, PostgresSink) and sink.pool is not None
+    batcher = ObservationsBatching(sink, test_app._settings)
+
+    async def fail(self: object) -> None:
+        raise asyncpg.PostgresConnectionError("connection lost")
+
+    monkeypatch.setattr(asyncpg.transaction.Transaction, "commit", fail)
+    await test_app._load_data(batcher, "", sample=[observation(str(i), i) for i in range(5)])
+
+    assert get_data("observations") == []
+    assert batcher.inserted_records == 0
+    assert batcher.failed_records == 5
+    await assert_pool_released(sink.pool, test_app._settings['POSTGRES_MAX_CONNECTION_POOL_SIZE'])
+
+    await sink.close()
+
+
+@pytest.mark.asyncio
+async def test_aborted_load_is_rolled_back(loop: AbstractEventLoop, database: None) -> None:
+    seed("patients")
+    test_app = init_app(
+        loop=loop, settings={**settings, 'COMMIT_ROWS': 100, 'COMMIT_SECONDS': 60, 'BATCH_SIZE': 2},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    assert isinstance(sink, PostgresSink) and sink.pool is not None
+    batcher = ObservationsBatching(sink, test_app._settings)
+
+    async def hang() -> None:
+        await asyncio.Event().wait()
+
+    # load is cancelled after its flushes, before the final commit
+    batcher.finish = hang  # type: ignore
+    task = loop.create_task(test_app._load_data(batcher, "", sample=[observation(str(i), i) for i in range(6)]))
+    while batcher._uncommitted_records < 6:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert get_data("observations") == []
+    assert batcher.inserted_records == 0
+    assert batcher.failed_records == 6
+    assert batcher._transaction is None
+    await assert_pool_released(sink.pool, test_app._settings['POSTGRES_MAX_CONNECTION_POOL_SIZE'])
+
+    await sink.close()
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import pstats
+import sys
+import time
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.profiling import SamplingProfiler
+from app.settings import settings
+from app.sinks import MemorySink
+
+
+def busy(seconds: float) -> None:
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+def test_sampling_profiler_artefacts(tmp_path: Path) -> None:
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    busy(0.2)
+    profiler.stop()
+
+    files = profiler.write(str(tmp_path), "patients")
+
+    assert files == [str(tmp_path / "patients.pstats"), str(tmp_path / "patients.collapsed")]
+    stats = pstats.Stats(files[0])
+    assert any(name == "busy" for _, _, name in stats.stats)  # type: ignore
+    collapsed = (tmp_path / "patients.collapsed").read_text().splitlines()
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in collapsed) == profiler.total
+    label, own, inclusive = profiler.top(1)[0]
+    assert label.startswith("busy (test_profiling.py:") and own > 0.5 and inclusive >= own
+
+
+def test_sampling_profiler_stack_is_root_first() -> None:
+    profiler = SamplingProfiler()
+    profiler.sample(sys._getframe())
+
+    (stack,) = profiler.samples
+    assert stack[-1][2] == "test_sampling_profiler_stack_is_root_first"
+    assert "pytest_pyfunc_call" in [name for _, _, name in stack[:-1]]
+
+
+@pytest.mark.asyncio
+async def test_profile_per_entity(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps([{"id": str(i)} for i in range(20)]))
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'PROFILE': True, 'PROFILE_INTERVAL': 0.001, 'PROFILE_PATH': str(tmp_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(MemorySink()), timeout=1)
+
+    profile = test_app.profiles["patients"]
+    assert (tmp_path / "patients.collapsed").exists()
+    assert len(profile["top"]) <= settings['PROFILE_TOP']
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import json
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.progress import Progress
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tables.patients import PatientsBatching
+
+
+@pytest.mark.asyncio
+async def test_progress_status(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    status_path = tmp_path / "progress.json"
+    body = ndjson.dumps([{"id": str(i)} for i in range(50)])
+
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=body, headers={"Content-Length": str(len(body))})
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'PROGRESS_INTERVAL': 0.01, 'PROGRESS_STATUS_PATH': str(status_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(MemorySink()), timeout=1)
+
+    status = json.loads(status_path.read_text())["patients"]
+    assert status["state"] == "done"
+    assert status["lines"] == 50
+    assert status["rows_inserted"] == 50
+    assert status["bytes_read"] == status["bytes_total"] == len(body)
+    assert status["queue_depth"] == 0
+
+
+def test_progress_snapshot(tmp_path: Path) -> None:
+    batcher = PatientsBatching(MemorySink(), settings)
+    batcher.read_items = 10
+    batcher.transfer.update(compressed_bytes=250, content_length=1000)
+    queue: asyncio.Queue = asyncio.Queue()
+    queue.put_nowait(b"{}")
+
+    progress = Progress("patients", batcher, queue, 0, {}, str(tmp_path / "progress.json"))
+    snapshot = progress.report()
+
+    assert snapshot["queue_depth"] == 1
+    assert snapshot["flushes_in_flight"] == 0
+    assert snapshot["eta"] is not None and snapshot["eta"] >= 0
+    assert progress.format(snapshot).startswith("Patients: 0.0 MiB / 0.0 MiB, 10 lines")
+    assert json.loads((tmp_path / "progress.json").read_text())["patients"]["lines"] == 10
+
+
+def test_dump_stats(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    test_app = init_app(
+        loop=loop, settings={**settings, 'PROGRESS_STATUS_PATH': str(tmp_path / "progress.json")},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    test_app.stats['patients'] = {"processed_items": 1}
+    test_app.progress = Progress(
+        "encounters", PatientsBatching(MemorySink(), settings), None, 0,
+        test_app.progress_status, str(tmp_path / "progress.json"),
+    )
+
+    test_app.dump_stats()
+
+    assert json.loads((tmp_path / "progress.json").read_text())["encounters"]["state"] == "running"
@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import gzip
+from asyncio import AbstractEventLoop
+from pathlib import Path
+from typing import List
+
+import aiohttp
+import ndjson
+import pytest
+
+from app import init_app
+from app.ranges import read_range_lines, source_size, split
+from app.settings import settings
+from app.sinks import MemorySink
+
+from . import get_data
+
+
+def ENCOUNTER(i: int) -> dict:
+    return {
+        "id": f"encounter-{i}",
+        "subject": {"reference": f"Patient/{i}"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    }
+
+
+LINES = [b'{"id": "%d"}' % i + b" " * (i % 7) for i in range(100)]
+
+
+async def read_ranges(path: Path, parts: int) -> List[bytes]:
+    lines: List[bytes] = []
+    async with aiohttp.ClientSession() as session:
+        for byte_range in split(path.stat().st_size, parts):
+            lines.extend([line async for line in read_range_lines(session, str(path), byte_range)])
+    return lines
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("parts", [1, 2, 3, 7, 64, 5000])
+@pytest.mark.parametrize("trailing_newline", [True, False])
+async def test_ranges_yield_every_line_once(tmp_path: Path, parts: int, trailing_newline: bool) -> None:
+    path = tmp_path / "source.ndjson"
+    path.write_bytes(b"\n".join(LINES) + (b"\n" if trailing_newline else b""))
+
+    assert await read_ranges(path, parts) == LINES
+
+
+@pytest.mark.asyncio
+async def test_compressed_source_isnt_split(tmp_path: Path) -> None:
+    plain, compressed = tmp_path / "source.ndjson", tmp_path / "source.ndjson.gz"
+    plain.write_bytes(b"\n".join(LINES))
+    compressed.write_bytes(gzip.compress(b"\n".join(LINES)))
+
+    async with aiohttp.ClientSession() as session:
+        assert await source_size(session, str(plain)) == plain.stat().st_size
+        assert await source_size(session, f"file://{plain}") == plain.stat().st_size
+        assert await source_size(session, str(compressed)) is None
+
+
+@pytest.mark.asyncio
+async def test_load_ranges_in_processes(loop: AbstractEventLoop, database: None, tmp_path: Path) -> None:
+    patients_path, encounters_path = tmp_path / "patients.ndjson", tmp_path / "encounters.ndjson"
+    patients_path.write_text(ndjson.dumps([{"id": str(i)} for i in range(300)] + [{"not_id": 1}]))
+    encounters_path.write_text(ndjson.dumps([ENCOUNTER(i) for i in range(300)]))
+
+    test_app = init_app(
+        loop=loop,
+        settings={
+            **settings, 'READ_PROCESSES': 3, 'PATIENTS_PATH': str(patients_path),
+            'ENCOUNTERS_PATH': str(encounters_path),
+        },
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    await asyncio.wait_for(test_app.resolve_patients(), timeout=60)
+    # patients loaded by worker processes are found by the next entity
+    await asyncio.wait_for(test_app.resolve_encounters(), timeout=60)
+
+    stats = test_app.stats['patients']
+    assert stats['processes'] == 3
+    assert stats['processed_items'] == 301
+    assert stats['inserted_records'] == 300
+    assert stats['rejections'] == {"no valid source_id": 1}
+    assert stats['transfer']['compressed_bytes'] >= patients_path.stat().st_size
+
+    assert test_app.stats['encounters']['processes'] == 3
+    assert test_app.stats['encounters']['inserted_records'] == 300
+    assert len(get_data("encounters")) == 300
+
+
+@pytest.mark.asyncio
+async def test_memory_sink_isnt_split(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    patients_path, encounters_path = tmp_path / "patients.ndjson", tmp_path / "encounters.ndjson"
+    patients_path.write_text(ndjson.dumps([{"id": str(i)} for i in range(50)]))
+    encounters_path.write_text(ndjson.dumps([ENCOUNTER(i) for i in range(50)]))
+
+    test_app = init_app(
+        loop=loop,
+        settings={
+            **settings, 'SINK': 'memory', 'READ_PROCESSES': 2, 'PATIENTS_PATH': str(patients_path),
+            'ENCOUNTERS_PATH': str(encounters_path),
+        },
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+    sink = await test_app.create_sink()
+    assert isinstance(sink, MemorySink)
+    await asyncio.wait_for(test_app.resolve_patients(sink), timeout=60)
+    await asyncio.wait_for(test_app.resolve_encounters(sink), timeout=60)
+
+    assert 'processes' not in test_app.stats['patients']
+    assert test_app.stats['encounters']['inserted_records'] == 50
+    assert all(row['patient_id'] is not None for row in sink.tables['encounters'])
@@ -0,0 +1,129 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from app.rejects import DeadLetterFile
+from app.settings import settings
+from app.sinks import MemorySink
+from app.sinks.base import Transaction
+from app.tables.encounters import EncountersBatching
+from app.tables.observations import ObservationsBatching
+from app.tables.patients import PatientsBatching, patients_table
+
+
+ENCOUNTER = {
+    "id": "1",
+    "subject": {"reference": "Patient/patient-uuid-1"},
+    "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+}
+
+
+@pytest.mark.asyncio
+async def test_rejections_are_counted_by_reason(tmp_path: Path) -> None:
+    sink = MemorySink()
+    await sink.insert(patients_table, [{"source_id": "patient-uuid-1"}])
+    batcher = EncountersBatching(
+        sink, {**settings, 'DEAD_LETTER_PATH': str(tmp_path), 'REJECTION_LOG_SAMPLES': 1},
+    )
+
+    items = [
+        b'{"id": ',
+        b'not json',
+        json.dumps({**ENCOUNTER, "period": {"start": "2011-11-01"}}).encode(),
+        json.dumps({**ENCOUNTER, "subject": {"reference": "Patient/unknown"}}).encode(),
+        json.dumps(ENCOUNTER).encode(),
+    ]
+    for item in items:
+        await batcher.process(item)
+    await batcher.finish()
+
+    stats = batcher.get_stats()
+    assert stats["rejections"] == {"invalid JSON": 2, "no valid end_date": 1, "unresolved patient_id": 1}
+    assert stats["inserted_records"] == 1
+
+    dead_letters = [json.loads(line) for line in Path(stats["dead_letter_file"]).read_text().splitlines()]
+    assert [entry["reason"] for entry in dead_letters] == [
+        "invalid JSON", "invalid JSON", "no valid end_date", "unresolved patient_id",
+    ]
+    assert dead_letters[0]["item"] == '{"id": '
+    assert json.loads(dead_letters[3]["item"])["subject"] == {"reference": "Patient/unknown"}
+
+
+@pytest.mark.asyncio
+async def test_observation_without_component_values_rejected(tmp_path: Path) -> None:
+    sink = MemorySink()
+    await sink.insert(patients_table, [{"source_id": "patient-uuid-1"}])
+    batcher = ObservationsBatching(sink, {**settings, 'DEAD_LETTER_PATH': str(tmp_path)})
+
+    await batcher.process(json.dumps({
+        "id": "1",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "effectiveDateTime": "2020-10-01",
+        "component": [{"code": {"coding": [{"code": "c0", "system": "s0"}]}}],
+    }))
+    await batcher.finish()
+
+    stats = batcher.get_stats()
+    assert stats["rejections"] == {"no valid component": 1}
+    assert stats["processed_items"] == 1
+    assert sink.tables["observations"] == []
+    dead_letters = [json.loads(line) for line in Path(stats["dead_letter_file"]).read_text().splitlines()]
+    assert [entry["reason"] for entry in dead_letters] == ["no valid component"]
+
+
+@pytest.mark.asyncio
+async def test_dead_letter_written_in_order_in_buffers(tmp_path: Path) -> None:
+    dead_letter = DeadLetterFile(str(tmp_path / "items.ndjson"), buffer_size=3)
+    for i in range(10):
+        dead_letter.write("reason", str(i))
+    await dead_letter.close()
+
+    lines = (tmp_path / "items.ndjson").read_text().splitlines()
+    assert [json.loads(line)["item"] for line in lines] == [str(i) for i in range(10)]
+
+
+class FlakySink(MemorySink):
+    """Refuses batches with row "1", loses connection on small batches with row "6"."""
+
+    def __init__(self, commit_fails: bool) -> None:
+        super().__init__()
+        self.commit_fails = commit_fails
+
+    async def insert(self, table, rows):  # type: ignore
+        ids = {row["source_id"] for row in rows}
+        if "1" in ids or ("6" in ids and len(rows) > 2):
+            raise ValueError("invalid row")
+        if "6" in ids:
+            raise ConnectionError("connection lost")
+        return await super().insert(table, rows)
+
+    def rejects_rows(self, error: Exception) -> bool:
+        return isinstance(error, ValueError)
+
+    async def begin(self) -> Transaction:
+        sink = self
+
+        class FlakyTransaction(Transaction):
+            async def commit(self) -> None:
+                if sink.commit_fails:
+                    raise ConnectionError("connection lost")
+
+        return FlakyTransaction(self)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("commit_fails", [False, True])
+async def test_bisection_error_counts_rows_once(commit_fails: bool) -> None:
+    sink = FlakySink(commit_fails)
+    batcher = PatientsBatching(sink, {
+        **settings, 'BATCH_SIZE': 8, 'ADAPTIVE_BATCH_SIZE': False, 'DEDUPE': False, 'REJECT_PATH': "",
+    })
+
+    for i in range(8):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+
+    # "1" rejected, halves of "6" lost with the connection, the rest inserted before it
+    inserted = 0 if commit_fails else 5
+    assert (batcher.inserted_records, batcher.failed_records) == (inserted, 8 - inserted)
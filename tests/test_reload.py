@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+from asyncio import AbstractEventLoop
+from typing import Iterator, List
+
+import ndjson
+import psycopg2
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.reload import ShadowReload
+from app.settings import settings
+
+
+def query(statement: str) -> List[tuple]:
+    with psycopg2.connect(
+        database=settings['POSTGRES_DATABASE_NAME'],
+        host=settings['POSTGRES_DATABASE_HOST'],
+        user=settings['POSTGRES_DATABASE_USERNAME'],
+        password=settings['POSTGRES_DATABASE_PASSWORD'],
+    ) as conn, conn.cursor() as cur:
+        cur.execute(statement)
+        rows = cur.fetchall() if cur.description else []
+    conn.close()
+    return rows
+
+
+def constraints(schema: str) -> List[str]:
+    return [row[0] for row in query(
+        f"SELECT conname FROM pg_constraint WHERE connamespace = '{schema}'::regnamespace "
+        "AND contype IN ('p', 'f') ORDER BY conname"
+    )]
+
+
+@pytest.fixture  # type: ignore
+def generations(database: None) -> Iterator[None]:
+    yield
+    query("DROP SCHEMA IF EXISTS etl_shadow CASCADE; DROP SCHEMA IF EXISTS etl_previous CASCADE")
+
+
+@pytest.mark.asyncio
+async def test_reload_swaps_shadow_tables(loop: AbstractEventLoop, generations: None) -> None:
+    query("INSERT INTO patients (source_id) VALUES ('old-patient')")
+    live_constraints = constraints("public")
+    reload = ShadowReload(settings)
+
+    reload.prepare()
+    # keys are built after the load
+    assert constraints("etl_shadow") == []
+    assert len(reload.deferred) == len(live_constraints)
+
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps([{"id": "new-1"}, {"id": "new-2"}]))
+        test_app = init_app(
+            loop=loop, settings={**settings, 'RELOAD': True},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        sink = await test_app.create_sink()
+        await asyncio.wait_for(test_app.resolve_patients(sink), timeout=5)
+        await sink.close()
+
+    # readers see the old generation during the load
+    assert query("SELECT source_id FROM public.patients") == [("old-patient",)]
+    assert query("SELECT source_id FROM etl_shadow.patients ORDER BY id") == [("new-1",), ("new-2",)]
+
+    reload.finish()
+
+    assert query("SELECT source_id FROM patients ORDER BY id") == [("new-1",), ("new-2",)]
+    assert query("SELECT source_id FROM etl_previous.patients") == [("old-patient",)]
+    assert constraints("public") == live_constraints
+    # new rows keep getting ids from the swapped table's own sequence
+    query("INSERT INTO patients (source_id) VALUES ('new-3')")
+    assert query("SELECT id FROM patients WHERE source_id = 'new-3'") == [(3,)]
+
+    reload.rollback()
+
+    assert query("SELECT source_id FROM patients") == [("old-patient",)]
+    assert query("SELECT count(*) FROM etl_previous.patients") == [(3,)]
+
+
+def test_rollback_without_previous_generation(generations: None) -> None:
+    with pytest.raises(ValueError):
+        ShadowReload(settings).rollback()
+
+    assert query("SELECT count(*) FROM patients") == [(0,)]
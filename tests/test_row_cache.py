@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import datetime
+import os
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import aiohttp
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.row_cache import RowCache, RowSpill
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tables.patients import patients_table
+
+
+async def run_cached_app(loop: AbstractEventLoop, sink: MemorySink, cache_path: Path, body: str, get: bool) -> None:
+    url = settings['ENCOUNTERS_PATH']
+    headers = {"ETag": '"etag-1"', "Content-Length": str(len(body))}
+
+    with aioresponses() as mocked:
+        mocked.head(url, status=200, headers=headers)
+        if get:
+            mocked.get(url, status=200, body=body)
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'SINK': 'memory', 'ROW_CACHE': True, 'ROW_CACHE_PATH': str(cache_path)},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_encounters(sink), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_row_cache_replay(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    payload = [{
+        "id": "source-1",
+        "subject": {"reference": "Patient/patient-uuid-1"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    }]
+    body = ndjson.dumps(payload)
+
+    first_sink = MemorySink()
+    await first_sink.insert(patients_table, [{"id": 7, "source_id": "patient-uuid-1"}])
+    await run_cached_app(loop, first_sink, tmp_path, body, get=True)
+
+    assert len(os.listdir(tmp_path)) == 1
+
+    # replay into "fresh database", where the patient got different id, nothing is downloaded
+    second_sink = MemorySink()
+    await second_sink.insert(patients_table, [{"id": 42, "source_id": "patient-uuid-1"}])
+    await run_cached_app(loop, second_sink, tmp_path, body, get=False)
+
+    first, second = first_sink.tables["encounters"][0], second_sink.tables["encounters"][0]
+    assert first["patient_id"] == 7
+    assert second["patient_id"] == 42
+    assert second["start_date"] == first["start_date"]
+    assert str(second["start_date"]) == "2011-11-01 00:05:23+04:00"
+
+
+@pytest.mark.asyncio
+async def test_row_cache_key_of_local_file(tmp_path: Path) -> None:
+    cache = RowCache(str(tmp_path / "cache"))
+    source = tmp_path / "encounters.ndjson"
+    source.write_text('{"id": "1"}\n')
+
+    key = await cache.key(str(source))
+    assert key is not None
+    assert await cache.key(f"file://{source}") == key
+
+    source.write_text('{"id": "1"}\n{"id": "2"}\n')
+    assert await cache.key(str(source)) not in (None, key)
+
+
+@pytest.mark.asyncio
+async def test_row_cache_key_of_unreachable_source(tmp_path: Path) -> None:
+    cache = RowCache(str(tmp_path))
+    url = settings['ENCOUNTERS_PATH']
+
+    with aioresponses() as mocked:
+        mocked.head(url, exception=aiohttp.ClientConnectionError("refused"))
+        assert await cache.key(url) is None
+    assert await cache.key(f"file://{tmp_path}/missing.ndjson") is None
+
+
+def test_row_spill_reads_rows_in_order(tmp_path: Path) -> None:
+    spill = RowSpill(str(tmp_path / "spill" / "patients.msgpack"))
+    created = datetime.datetime(2020, 10, 1, 12, 30)
+
+    spill.write([{"source_id": "1", "created": created}, {"source_id": "1", "created": None}])
+    spill.write([{"source_id": "2", "created": created}])
+    assert spill.read(1) == [{"source_id": "1", "created": created}, {"source_id": "1", "created": None}]
+
+    # written after reading started
+    spill.write([{"source_id": "3", "created": created}])
+    assert [row["source_id"] for row in spill.read(10)] == ["2", "3"]
+
+    # drained file is removed
+    assert (spill.pending, spill.spilled_rows) == (0, 4)
+    assert not os.path.exists(spill.path)
+    assert spill.read(10) == []
@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import json
+from asyncio import AbstractEventLoop
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.settings import settings
+from app.sharding import Shard, merge_stats
+from app.sinks import MemorySink
+from app.tables.observations import ObservationsBatching
+
+
+PERIOD = {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"}
+
+
+@pytest.mark.parametrize("spec", ["0/2", "3/2", "1", "a/b"])
+def test_shard_invalid_spec(spec: str) -> None:
+    with pytest.raises(ValueError):
+        Shard.from_spec(spec)
+
+
+def test_shards_partition_keys() -> None:
+    shards = [Shard.from_spec(f"{k}/3") for k in (1, 2, 3)]
+    keys = [f"patient-{i}" for i in range(300)] + [None]
+
+    owners = [[shard for shard in shards if shard is not None and shard.owns(key)] for key in keys]
+
+    assert all(len(owner) == 1 for owner in owners)
+    assert {str(owner[0]) for owner in owners} == {"1/3", "2/3", "3/3"}
+
+
+@pytest.mark.asyncio
+async def test_shards_load_disjoint_patients_with_their_encounters(loop: AbstractEventLoop) -> None:
+    patients = [{"id": f"patient-{i}"} for i in range(40)] + [{"not_id": i} for i in range(10)]
+    encounters = [
+        {"id": f"encounter-{i}", "subject": {"reference": f"Patient/patient-{i % 40}"}, "period": PERIOD}
+        for i in range(80)
+    ]
+
+    shard_stats = []
+    loaded = []
+    for spec in ("1/2", "2/2"):
+        sink = MemorySink()
+        with aioresponses() as mocked:
+            mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps(patients))
+            mocked.get(settings['ENCOUNTERS_PATH'], status=200, body=ndjson.dumps(encounters))
+            test_app = init_app(
+                loop=loop, settings={**settings, 'SHARD': spec}, command_line_args=argparse.Namespace(verbose=False),
+            )
+            await asyncio.wait_for(test_app.resolve_patients(sink), timeout=1)
+            await asyncio.wait_for(test_app.resolve_encounters(sink), timeout=1)
+        shard_stats.append({**test_app.stats, 'shard': spec})
+        loaded.append(sink)
+
+    patient_ids = [{row["source_id"] for row in sink.tables["patients"]} for sink in loaded]
+    encounter_ids = [{row["source_id"] for row in sink.tables["encounters"]} for sink in loaded]
+    assert not patient_ids[0] & patient_ids[1]
+    assert patient_ids[0] | patient_ids[1] == {f"patient-{i}" for i in range(40)}
+    assert not encounter_ids[0] & encounter_ids[1]
+    assert len(encounter_ids[0] | encounter_ids[1]) == 80
+    # every encounter found its patient within the shard
+    assert all("rejections" not in stats["encounters"] for stats in shard_stats)
+    # items rejected before their patient is known are owned by one shard
+    assert [stats["patients"]["read_items"] for stats in shard_stats] == [50, 50]
+    assert sum(stats["patients"].get("rejections", {}).get("no valid source_id", 0) for stats in shard_stats) == 10
+
+    merged = merge_stats(shard_stats)
+    assert merged["shards"] == ["1/2", "2/2"]
+    assert merged["patients"]["read_items"] == 50
+    assert merged["patients"]["processed_items"] == 50
+    assert merged["patients"]["inserted_records"] == 40
+    assert merged["patients"]["rejections"] == {"no valid source_id": 10}
+    assert merged["patients"]["skipped_items"] == 0
+    assert merged["encounters"]["processed_items"] == 80
+    assert merged["encounters"]["inserted_records"] == 80
+
+
+@pytest.mark.asyncio
+async def test_item_without_rows_counted_by_one_shard() -> None:
+    item = json.dumps({
+        "id": "observation-1",
+        "subject": {"reference": "Patient/patient-1"},
+        "effectiveDateTime": "2020-10-01",
+        "component": [{"code": {"coding": [{"code": "c0", "system": "s0"}]}}],
+    })
+    batchers = [ObservationsBatching(MemorySink(), {**settings, 'SHARD': f"{k}/2"}) for k in (1, 2)]
+
+    for batcher in batchers:
+        await batcher.process(item)
+
+    assert [batcher.processed_items for batcher in batchers].count(1) == 1
+    assert sum(batcher.processed_items + batcher.skipped_items for batcher in batchers) == 2
+    assert sum(sum(batcher.rejections.values()) for batcher in batchers) == 1
+
+
+def test_merge_stats() -> None:
+    statement = {
+        "count": 2, "total": 0.004, "max": 0.003, "rows": 10,
+        "buckets": {"0.001": 1, "0.005": 1},
+    }
+    shards = [
+        {
+            "shard": "1/2", "finished_at": 2, "db_profile": "bulk",
+            "patients": {"processed_items": 3, "rejections": {"invalid JSON": 1}, "batch_sizes": [[0, 100]]},
+            "patients_genders": {"male": 4},
+            "statements": {"SELECT 1": statement},
+        },
+        {
+            "shard": "2/2", "finished_at": 1, "db_profile": "bulk",
+            "patients": {"processed_items": 4, "rejections": {"invalid JSON": 2, "no valid source_id": 1}},
+            "patients_genders": {"male": 2},
+            "statements": {"SELECT 1": {**statement, "max": 0.5, "buckets": {"0.001": 1, "0.5": 1}}},
+        },
+    ]
+
+    merged = merge_stats(shards)
+
+    assert merged["db_profile"] == "bulk"
+    assert merged["patients"] == {
+        "processed_items": 7, "rejections": {"invalid JSON": 3, "no valid source_id": 1}, "batch_sizes": [[0, 100]],
+    }
+    # computed by the database, the last shard saw all the data
+    assert merged["patients_genders"] == {"male": 4}
+    statement_stats = merged["statements"]["SELECT 1"]
+    assert statement_stats["count"] == 4
+    assert statement_stats["max"] == 0.5
+    assert statement_stats["p50"] == 0.001
+    assert statement_stats["rows"] == 20
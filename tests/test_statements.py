@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+from asyncio import AbstractEventLoop
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.settings import settings
+from app.sinks.statements import LatencyHistogram, statement_shape
+
+
+def test_statement_shape_collapses_rows() -> None:
+    one = statement_shape("INSERT INTO patients (source_id, gender) VALUES ($1, $2)")
+    many = statement_shape("INSERT INTO patients (source_id, gender) VALUES ($1, $2), ($3, $4),\n ($5, $6)")
+
+    assert one == many == "INSERT INTO patients (source_id, gender) VALUES (...)"
+    assert statement_shape("RELEASE SAVEPOINT asyncpg_savepoint_12") == "RELEASE SAVEPOINT asyncpg_savepoint_N"
+
+
+def test_latency_histogram() -> None:
+    histogram = LatencyHistogram()
+    for seconds in [0.0003] * 90 + [0.015] * 9 + [3.0]:
+        histogram.observe(seconds)
+
+    stats = histogram.get_stats()
+    assert stats["count"] == 100
+    assert stats["p50"] == 0.0005
+    assert stats["p95"] == 0.02
+    assert stats["p99"] == 0.02
+    assert stats["max"] == 3.0
+    assert stats["buckets"] == {"0.0005": 90, "0.02": 9, "5.0": 1}
+
+
+@pytest.mark.asyncio
+async def test_statement_stats(loop: AbstractEventLoop, database: None) -> None:
+    payload = [{"id": str(i), "gender": "female"} for i in range(30)]
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps(payload))
+        test_app = init_app(
+            loop=loop, settings={**settings, 'DB_STATEMENT_STATS': True, 'SLOW_STATEMENT_SECONDS': 1e-9},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        sink = await test_app.create_sink()
+        await asyncio.wait_for(test_app.resolve_patients(sink), timeout=2)
+        await test_app.post_run_stats(sink)
+        await sink.close()
+
+    statements = test_app.stats['statements']
+    (insert,) = [entry for shape, entry in statements.items() if shape.startswith("INSERT INTO patients")]
+    assert insert["rows"] == 30
+    assert insert["slow"] == insert["count"]
+    assert "Insert on patients" in insert["plan"]
+
+    (by_gender,) = [entry for shape, entry in statements.items() if "GROUP BY patients.gender" in shape]
+    assert by_gender["count"] == 1 and by_gender["rows"] == 1
+    assert by_gender["plan"] is not None
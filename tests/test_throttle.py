@@ -0,0 +1,135 @@
+import json
+import time
+from pathlib import Path
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tables import throttle as throttle_module
+from app.tables.patients import PatientsBatching
+from app.tables.throttle import Throttle, TokenBucket
+
+
+def test_token_bucket_delays_requests_over_burst() -> None:
+    bucket = TokenBucket(rate=100, burst=10)
+
+    assert bucket.delay(10) == 0
+    # bucket in debt of 50 tokens, repaid in half a second
+    assert bucket.delay(50) == pytest.approx(0.5, abs=0.01)
+
+
+def test_token_bucket_unlimited() -> None:
+    bucket = TokenBucket(rate=0, burst=0)
+
+    assert bucket.delay(10 ** 6) == 0
+
+
+def test_throttle_disabled_by_default() -> None:
+    assert Throttle.from_settings(settings) is None
+
+
+@pytest.mark.asyncio
+async def test_throttle_limits_rows_per_second() -> None:
+    throttle = Throttle(rows_per_second=1000, burst_seconds=0.1)
+
+    started_at = time.monotonic()
+    for _ in range(4):
+        await throttle.acquire(100)
+
+    # first 100 rows fit the burst, 300 more take 0.3 s
+    assert time.monotonic() - started_at == pytest.approx(0.3, abs=0.1)
+    assert throttle.waited == pytest.approx(0.3, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_throttle_limits_flushes_per_second() -> None:
+    throttle = Throttle(flushes_per_second=20)
+
+    started_at = time.monotonic()
+    for _ in range(25):
+        await throttle.acquire(1)
+
+    assert time.monotonic() - started_at == pytest.approx(0.25, abs=0.1)
+
+
+def test_throttle_share_of_limits() -> None:
+    throttle = Throttle(rows_per_second=1000, flushes_per_second=10, share=0.25)
+
+    assert throttle.get_stats()["rows_per_second"] == 250
+    assert throttle.get_stats()["flushes_per_second"] == 2.5
+
+
+def test_throttle_backs_off_and_recovers() -> None:
+    throttle = Throttle(rows_per_second=1000, target_latency=0.5, backoff=0.5)
+
+    throttle.observe(1.0)
+    throttle.observe(1.0)
+    assert throttle.rows.rate == 250
+    assert throttle.backoffs == 2
+
+    for _ in range(5):
+        throttle.observe(0.1)
+    assert throttle.rows.rate == pytest.approx(500)
+
+    for _ in range(100):
+        throttle.observe(0.1)
+    assert throttle.rows.rate == 1000
+
+
+@pytest.mark.asyncio
+async def test_throttle_backs_off_from_measured_rate_without_limit() -> None:
+    throttle = Throttle(target_latency=0.5, backoff=0.5)
+    throttle._started_at -= 1
+    await throttle.acquire(2000)
+
+    throttle.observe(1.0)
+
+    assert throttle.rows.rate == pytest.approx(1000, rel=0.1)
+
+
+@pytest.mark.asyncio
+async def test_throttle_control_file(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle_module, "CONTROL_INTERVAL", 0)
+    control_path = tmp_path / "throttle.json"
+    throttle = Throttle(rows_per_second=1000, control_path=str(control_path))
+
+    # missing file keeps configured limits
+    await throttle.acquire(1)
+    assert throttle.rows.rate == 1000
+
+    control_path.write_text(json.dumps({"flushes_per_second": 5}))
+    await throttle.acquire(1)
+    assert (throttle.rows.rate, throttle.flushes.rate) == (1000, 5)
+
+    control_path.write_text(json.dumps({"rows_per_second": 0, "flushes_per_second": 5}))
+    # mtime has a limited resolution
+    throttle._control_mtime = None
+    await throttle.acquire(1)
+    assert (throttle.rows.rate, throttle.flushes.rate) == (0, 5)
+    assert throttle.reloads == 2
+
+    control_path.write_text("not json")
+    throttle._control_mtime = None
+    await throttle.acquire(1)
+    assert (throttle.rows.rate, throttle.flushes.rate) == (0, 5)
+
+
+@pytest.mark.asyncio
+async def test_batcher_flushes_are_throttled() -> None:
+    sink = MemorySink()
+    batcher = PatientsBatching(sink, {
+        **settings, 'BATCH_SIZE': 10, 'BATCH_SIZE_MIN': 1, 'ADAPTIVE_BATCH_SIZE': False, 'DEDUPE': False,
+        'THROTTLE_FLUSHES_PER_SECOND': 10, 'THROTTLE_BURST_SECONDS': 0.1,
+    })
+
+    started_at = time.monotonic()
+    for i in range(50):
+        await batcher.process(json.dumps({"id": str(i)}))
+    await batcher.finish()
+
+    # first flush passes right away, 4 more at 10 per second
+    assert time.monotonic() - started_at == pytest.approx(0.4, abs=0.15)
+    assert len(sink.tables["patients"]) == 50
+    assert batcher.get_stats()["throttle"]["waited"] > 0
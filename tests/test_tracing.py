@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import json
+from asyncio import AbstractEventLoop
+from pathlib import Path
+from typing import Dict, List
+
+import ndjson
+import pytest
+from aioresponses import aioresponses
+
+from app import init_app
+from app.settings import settings
+from app.sinks import MemorySink
+from app.tracing import NULL_SPAN, Tracer
+
+
+def read_spans(path: Path) -> List[dict]:
+    return [
+        span
+        for line in path.read_text().splitlines()
+        for resource_spans in json.loads(line)["resourceSpans"]
+        for scope_spans in resource_spans["scopeSpans"]
+        for span in scope_spans["spans"]
+    ]
+
+
+def test_unsampled_record_skips_children(tmp_path: Path) -> None:
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), record_rate=0.0)
+
+    with tracer.span("resolve"):
+        with tracer.record("process"):
+            assert tracer.span("decode") is NULL_SPAN
+            with tracer.batch("flush"):
+                pass
+    tracer.close()
+
+    spans = {span["name"]: span for span in read_spans(tmp_path / "trace.jsonl")}
+    assert set(spans) == {"resolve", "flush"}
+    # batch span of an unsampled record goes to the nearest sampled span
+    assert spans["flush"]["parentSpanId"] == spans["resolve"]["spanId"]
+    assert spans["flush"]["traceId"] == spans["resolve"]["traceId"]
+
+
+def test_span_error_status(tmp_path: Path) -> None:
+    tracer = Tracer(str(tmp_path / "trace.jsonl"))
+
+    with pytest.raises(ValueError):
+        with tracer.span("flush", rows=3):
+            raise ValueError("boom")
+    tracer.close()
+
+    (span,) = read_spans(tmp_path / "trace.jsonl")
+    assert span["status"] == {"code": 2, "message": "ValueError: boom"}
+    assert span["attributes"] == [{"key": "rows", "value": {"intValue": "3"}}]
+    assert int(span["endTimeUnixNano"]) >= int(span["startTimeUnixNano"])
+
+
+@pytest.mark.asyncio
+async def test_trace_entity(loop: AbstractEventLoop, tmp_path: Path) -> None:
+    payload = [{"id": str(i)} for i in range(20)] + [{"not_id": "1"}]
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps(payload))
+        test_app = init_app(
+            loop=loop,
+            settings={**settings, 'TRACE_PATH': str(tmp_path / "trace.jsonl"), 'TRACE_RECORD_SAMPLE_RATE': 1.0},
+            command_line_args=argparse.Namespace(verbose=False),
+        )
+        await asyncio.wait_for(test_app.resolve_patients(MemorySink()), timeout=1)
+
+    spans = read_spans(tmp_path / "trace.jsonl")
+    by_name: Dict[str, List[dict]] = {}
+    for span in spans:
+        by_name.setdefault(span["name"], []).append(span)
+
+    (resolve,) = by_name["resolve"]
+    assert resolve["parentSpanId"] == ""
+    assert {"key": "processed_items", "value": {"intValue": "21"}} in resolve["attributes"]
+    assert len({span["traceId"] for span in spans}) == 1
+    assert len(by_name["worker"]) == settings['QUEUE_WORKERS_AMOUNT']
+    assert len(by_name["download"]) == 1
+    assert len(by_name["process"]) == len(by_name["decode"]) == 21
+    assert len(by_name["extract"]) == 21
+    assert sum(int(attribute["value"]["intValue"]) for span in by_name["flush"] for attribute in span["attributes"]
+               if attribute["key"] == "rows") == 20
+
+    worker_ids = {span["spanId"] for span in by_name["worker"]}
+    assert all(span["parentSpanId"] in worker_ids for span in by_name["process"])
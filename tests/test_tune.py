@@ -0,0 +1,80 @@
+import argparse
+from asyncio import AbstractEventLoop
+from pathlib import Path
+
+import ndjson
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from aioresponses import aioresponses
+
+from app import init_app, tune
+from app.settings import load_entity_settings, settings
+
+from . import get_data
+
+
+@pytest.mark.asyncio
+async def test_tune(loop: AbstractEventLoop, database: None, monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(tune, "SEARCH_SPACE", {'QUEUE_WORKERS_AMOUNT': (1, 2), 'BATCHER_SLEEP_TIME': (0.05, 1.0)})
+    patients = [{"id": f"patient-{i}"} for i in range(20)]
+    # first encounters reference patients out of the sample
+    encounters = [{
+        "id": f"encounter-{i}",
+        "subject": {"reference": f"Patient/patient-{15 if i < 10 else 1}"},
+        "period": {"start": "2011-11-01T00:05:23+04:00", "end": "2011-11-04T00:05:23+04:00"},
+    } for i in range(30)]
+
+    tuner = tune.Tuner(
+        loop, {**settings, 'TUNE_DATABASE_NAME': settings['POSTGRES_DATABASE_NAME']},
+        argparse.Namespace(verbose=False), sample_size=10,
+    )
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps(patients))
+        mocked.get(settings['ENCOUNTERS_PATH'], status=200, body=ndjson.dumps(encounters))
+        tuned = await tuner.run(("patients", "encounters"))
+
+    assert set(tuned) == {"patients", "encounters"}
+    assert set(tuned["patients"]) == {'QUEUE_WORKERS_AMOUNT', 'BATCHER_SLEEP_TIME'}
+    # baseline, 2 candidates and the final load
+    assert len(tuner.trials["patients"]) == 4
+    assert {trial['inserted_records'] for trial in tuner.trials["encounters"]} == {10}
+
+    # sample of dependencies stays loaded, encounters are picked among those referencing it
+    assert len(get_data("patients")) == 10
+    assert sorted(row["source_id"] for row in get_data("encounters")) == sorted(
+        f"encounter-{i}" for i in range(10, 20)
+    )
+
+    path = tmp_path / "tuned_settings.json"
+    tune.write_entity_settings(str(path), tuned)
+    assert load_entity_settings(str(path)) == tuned
+
+
+@pytest.mark.asyncio
+async def test_tune_refuses_sample_inserting_nothing(loop: AbstractEventLoop, database: None) -> None:
+    tuner = tune.Tuner(
+        loop, {**settings, 'TUNE_DATABASE_NAME': settings['POSTGRES_DATABASE_NAME']},
+        argparse.Namespace(verbose=False), sample_size=10,
+    )
+    with aioresponses() as mocked:
+        mocked.get(settings['PATIENTS_PATH'], status=200, body=ndjson.dumps([{"not_id": i} for i in range(20)]))
+        tuned = await tuner.run(("patients",))
+
+    assert tuned == {}
+    # only the baseline trial ran
+    assert tuner.trials["patients"] == [{
+        **{name: settings[name] for name in tune.SEARCH_SPACE}, 'seconds': tuner.trials["patients"][0]['seconds'],
+        'inserted_records': 0,
+    }]
+
+
+def test_entity_settings(loop: AbstractEventLoop) -> None:
+    tuned = {"observations": {'QUEUE_WORKERS_AMOUNT': 8}}
+    test_app = init_app(
+        loop=loop, settings={**settings, 'ENTITY_SETTINGS': tuned},
+        command_line_args=argparse.Namespace(verbose=False),
+    )
+
+    assert test_app.entity_settings("observations")['QUEUE_WORKERS_AMOUNT'] == 8
+    assert test_app.entity_settings("patients")['QUEUE_WORKERS_AMOUNT'] == settings['QUEUE_WORKERS_AMOUNT']
+    assert load_entity_settings("missing.json") == {}